@@ -4,7 +4,7 @@ from tqdm.asyncio import tqdm as tqdm_async
 from dataclasses import asdict, dataclass, field
 from datetime import datetime
 from functools import partial
-from typing import Type, cast
+from typing import Optional, Type, cast
 
 
 from .llm import (
@@ -18,8 +18,19 @@ from .operate import (
 )
 
 from .utils import (
+    CALL_PRIORITY,
+    PRIORITY_BULK,
+    ContentEmbeddingStore,
+    EmbeddingCache,
     EmbeddingFunc,
+    KeywordIndex,
+    MinHashIndex,
+    ResponseCache,
     compute_mdhash_id,
+    encode_string_by_tiktoken,
+    get_rate_limiter,
+    get_response_cache,
+    limit_rate,
     limit_async_func_call,
     convert_response_to_json,
     logger,
@@ -35,7 +46,11 @@ from .base import (
 
 from .storage import (
     JsonKVStorage,
+    LogKVStorage,
+    SqliteKVStorage,
     NanoVectorDBStorage,
+    MmapVectorDBStorage,
+    IVFVectorDBStorage,
     NetworkXStorage,
 )
 
@@ -118,6 +133,8 @@ class PathRAG:
     kv_storage: str = field(default="JsonKVStorage")
     vector_storage: str = field(default="NanoVectorDBStorage")
     graph_storage: str = field(default="NetworkXStorage")
+    # also write graph_*.graphml on every save, for tools that read GraphML
+    graph_export_graphml: bool = False
 
     current_log_level = logger.level
     log_level: str = field(default=current_log_level)
@@ -130,6 +147,28 @@ class PathRAG:
 
     entity_extract_max_gleaning: int = 1
     entity_summary_to_max_tokens: int = 500
+    # insert pipeline: chunks extracted at once, and the capacity of the
+    # queues between the chunking, extraction and merge stages
+    entity_extract_max_async: int = 16
+    insert_queue_size: int = 64
+    # MinHash/LSH detection of chunks similar to stored ones, which are then
+    # "link"ed (stored with duplicate_of, not extracted) or "skip"ped
+    chunk_dedup_config: dict = field(
+        default_factory=lambda: {
+            "enabled": False,
+            "threshold": 0.9,
+            "num_perm": 128,
+            "action": "link",
+        }
+    )
+    chunk_dedup_index: Optional[MinHashIndex] = None
+    # pack chunks into one extraction prompt up to this many chunk tokens;
+    # 0 sends every chunk on its own
+    entity_extract_pack_tokens: int = 0
+    # per-chunk extraction output is kept so an interrupted insert resumes
+    # without calling the LLM again; flushed at most every interval seconds
+    enable_extraction_checkpoints: bool = True
+    extraction_checkpoint_interval: float = 5.0
 
 
     node_embedding_algorithm: str = "node2vec"
@@ -146,20 +185,79 @@ class PathRAG:
 
 
     embedding_func: EmbeddingFunc = field(default_factory=lambda: openai_embedding)
+    # names the model behind embedding_func for the persistent embedding caches;
+    # defaults to embedding_func.model_name, and without one they stay off
+    embedding_model_name: Optional[str] = None
     embedding_batch_num: int = 32
     embedding_func_max_async: int = 16
 
+    # LRU of query embeddings shared by the vector storages and the LLM cache;
+    # "persist" only applies once the embedding model is named
+    query_embedding_cache_config: dict = field(
+        default_factory=lambda: {
+            "enabled": True,
+            "max_entries": 10000,
+            "persist": False,
+            "model_name": None,
+        }
+    )
+    query_embedding_cache: Optional[EmbeddingCache] = None
+    # reuse stored vectors for contents that were embedded before; needs a
+    # named embedding model so switching models never reuses stale vectors
+    enable_content_embedding_store: bool = True
+    content_embedding_store: Optional[ContentEmbeddingStore] = None
+
 
     llm_model_func: callable = openai_complete  
     llm_model_name: str = "gpt-4o"  
     llm_model_max_token_size: int = 32768
     llm_model_max_async: int = 16
     llm_model_kwargs: dict = field(default_factory=dict)
+    # provider quotas; limiters are shared by every instance using the same
+    # model name and None leaves that dimension unlimited
+    llm_rate_limit: dict = field(
+        default_factory=lambda: {"requests_per_minute": None, "tokens_per_minute": None}
+    )
+    embedding_rate_limit: dict = field(
+        default_factory=lambda: {"requests_per_minute": None, "tokens_per_minute": None}
+    )
 
 
     vector_db_storage_cls_kwargs: dict = field(default_factory=dict)
 
     enable_llm_cache: bool = True
+    # bounds and expiry of the per-entry LLM response cache, see ResponseCache
+    llm_response_cache_config: dict = field(
+        default_factory=lambda: {
+            "max_entries": 10000,
+            "max_bytes": None,
+            "ttl_seconds": None,
+            "eviction": "lru",
+            "invalidate_on_graph_change": True,
+        }
+    )
+    # LLM keyword extraction results keyed on the normalized query; they do
+    # not depend on the graph, so inserts leave them in place
+    keyword_cache_config: dict = field(
+        default_factory=lambda: {
+            "enabled": True,
+            "max_entries": 10000,
+            "ttl_seconds": None,
+        }
+    )
+    keyword_cache: Optional[ResponseCache] = None
+    # LLM summaries of entity and relationship descriptions keyed on their
+    # input, so a description list that was summarized before is not sent again
+    summary_cache_config: dict = field(
+        default_factory=lambda: {
+            "enabled": True,
+            "max_entries": 100000,
+            "ttl_seconds": None,
+        }
+    )
+    summary_cache: Optional[ResponseCache] = None
+    # entity names and relationship keywords for QueryParam(keyword_extractor="local")
+    keyword_index: Optional[KeywordIndex] = None
 
 
     addon_params: dict = field(default_factory=dict)
@@ -187,6 +285,45 @@ class PathRAG:
             logger.info(f"Creating working directory {self.working_dir}")
             os.makedirs(self.working_dir)
 
+        model_name = (
+            self.embedding_model_name
+            or getattr(self.embedding_func, "model_name", None)
+            or self.query_embedding_cache_config.get("model_name")
+        )
+        # a function name or dimension does not tell two models apart, so
+        # vectors are only kept on disk under a real model name
+        embedding_model_name = (
+            f"{model_name}:{self.embedding_func.embedding_dim}" if model_name else None
+        )
+        if (
+            self.query_embedding_cache is None
+            and self.query_embedding_cache_config.get("enabled", True)
+        ):
+            cache_config = self.query_embedding_cache_config
+            persist = cache_config.get("persist", False)
+            if persist and embedding_model_name is None:
+                logger.warning(
+                    "Query embedding cache kept in memory: set embedding_model_name to persist it"
+                )
+                persist = False
+            self.query_embedding_cache = EmbeddingCache(
+                max_entries=cache_config.get("max_entries", 10000),
+                model_name=embedding_model_name or "default",
+                file_name=os.path.join(self.working_dir, "query_embedding_cache.sqlite")
+                if persist
+                else None,
+            )
+        if self.content_embedding_store is None and self.enable_content_embedding_store:
+            if embedding_model_name is None:
+                logger.info(
+                    "Content embedding store disabled: set embedding_model_name to enable it"
+                )
+            else:
+                self.content_embedding_store = ContentEmbeddingStore(
+                    os.path.join(self.working_dir, "content_embeddings.sqlite"),
+                    model_name=embedding_model_name,
+                )
+
         self.llm_response_cache = (
             self.key_string_value_json_storage_cls(
                 namespace="llm_response_cache",
@@ -196,8 +333,74 @@ class PathRAG:
             if self.enable_llm_cache
             else None
         )
+        self.response_cache = (
+            get_response_cache(self.llm_response_cache)
+            if self.llm_response_cache is not None
+            else None
+        )
+        # JsonKVStorage rewrites its whole file on every flush, which a kill
+        # mid-insert can truncate; the append-only log survives that
+        checkpoint_storage_cls = (
+            LogKVStorage
+            if self.key_string_value_json_storage_cls is JsonKVStorage
+            else self.key_string_value_json_storage_cls
+        )
+        self.extraction_checkpoints = (
+            checkpoint_storage_cls(
+                namespace="extraction_checkpoints",
+                global_config=asdict(self),
+                embedding_func=None,
+            )
+            if self.enable_extraction_checkpoints
+            else None
+        )
+        keyword_cache_config = dict(self.keyword_cache_config)
+        if self.keyword_cache is None and keyword_cache_config.pop("enabled", True):
+            self.keyword_cache = ResponseCache(
+                self.key_string_value_json_storage_cls(
+                    namespace="keyword_cache",
+                    global_config=asdict(self),
+                    embedding_func=None,
+                ),
+                invalidate_on_graph_change=False,
+                **keyword_cache_config,
+            )
+        summary_cache_config = dict(self.summary_cache_config)
+        if self.summary_cache is None and summary_cache_config.pop("enabled", True):
+            self.summary_cache = ResponseCache(
+                self.key_string_value_json_storage_cls(
+                    namespace="summary_cache",
+                    global_config=asdict(self),
+                    embedding_func=None,
+                ),
+                invalidate_on_graph_change=False,
+                **summary_cache_config,
+            )
+        dedup_config = self.chunk_dedup_config
+        if self.chunk_dedup_index is None and dedup_config.get("enabled", False):
+            if dedup_config.get("action", "link") not in ("link", "skip"):
+                raise ValueError(f"Unknown near-duplicate action {dedup_config['action']}")
+            num_perm = dedup_config.get("num_perm", 128)
+            self.chunk_dedup_index = MinHashIndex(
+                os.path.join(self.working_dir, f"chunk_minhash_{num_perm}.bin"),
+                threshold=dedup_config.get("threshold", 0.9),
+                num_perm=num_perm,
+            )
+        if self.keyword_index is None:
+            self.keyword_index = KeywordIndex(
+                os.path.join(self.working_dir, "keyword_index.json")
+            )
+        def count_tokens(text):
+            return len(encode_string_by_tiktoken(text, self.tiktoken_model_name))
+
         self.embedding_func = limit_async_func_call(self.embedding_func_max_async)(
-            self.embedding_func
+            limit_rate(
+                get_rate_limiter(
+                    f"embedding:{embedding_model_name}", **self.embedding_rate_limit
+                ),
+                count_tokens,
+                kind="embedding",
+            )(self.embedding_func)
         )
 
 
@@ -236,16 +439,28 @@ class PathRAG:
             embedding_func=self.embedding_func,
         )
 
+        # the quota belongs to the model actually called: helpers such as
+        # gpt_4o_mini_complete ignore llm_model_name
+        llm_model_name = (
+            self.llm_model_kwargs.get("model")
+            or getattr(self.llm_model_func, "model_name", None)
+            or self.llm_model_name
+        )
         self.llm_model_func = limit_async_func_call(self.llm_model_max_async)(
-            partial(
-                self.llm_model_func,
-                hashing_kv=self.llm_response_cache
-                if self.llm_response_cache
-                and hasattr(self.llm_response_cache, "global_config")
-                else self.key_string_value_json_storage_cls(
-                    global_config=asdict(self),
-                ),
-                **self.llm_model_kwargs,
+            limit_rate(
+                get_rate_limiter(f"llm:{llm_model_name}", **self.llm_rate_limit),
+                count_tokens,
+            )(
+                partial(
+                    self.llm_model_func,
+                    hashing_kv=self.llm_response_cache
+                    if self.llm_response_cache
+                    and hasattr(self.llm_response_cache, "global_config")
+                    else self.key_string_value_json_storage_cls(
+                        global_config=asdict(self),
+                    ),
+                    **self.llm_model_kwargs,
+                )
             )
         )
 
@@ -253,11 +468,15 @@ class PathRAG:
         return {
 
             "JsonKVStorage": JsonKVStorage,
+            "LogKVStorage": LogKVStorage,
+            "SqliteKVStorage": SqliteKVStorage,
             "OracleKVStorage": OracleKVStorage,
             "MongoKVStorage": MongoKVStorage,
             "TiDBKVStorage": TiDBKVStorage,
 
             "NanoVectorDBStorage": NanoVectorDBStorage,
+            "MmapVectorDBStorage": MmapVectorDBStorage,
+            "IVFVectorDBStorage": IVFVectorDBStorage,
             "OracleVectorDBStorage": OracleVectorDBStorage,
             "MilvusVectorDBStorge": MilvusVectorDBStorge,
             "ChromaVectorDBStorage": ChromaVectorDBStorage,
@@ -277,6 +496,15 @@ class PathRAG:
 
     async def ainsert(self, string_or_strings):
         update_storage = False
+        completed = False
+        inserting_chunks = {}
+        # extraction calls queue behind concurrent queries
+        priority = CALL_PRIORITY.set(PRIORITY_BULK)
+        store_stats = (
+            self.content_embedding_store.stats()
+            if self.content_embedding_store is not None
+            else None
+        )
         try:
             if isinstance(string_or_strings, str):
                 string_or_strings = [string_or_strings]
@@ -293,61 +521,169 @@ class PathRAG:
             update_storage = True
             logger.info(f"[New Docs] inserting {len(new_docs)} docs")
 
-            inserting_chunks = {}
-            for doc_key, doc in tqdm_async(
-                new_docs.items(), desc="Chunking documents", unit="doc"
-            ):
-                chunks = {
-                    compute_mdhash_id(dp["content"], prefix="chunk-"): {
-                        **dp,
-                        "full_doc_id": doc_key,
-                    }
-                    for dp in chunking_by_token_size(
-                        doc["content"],
-                        overlap_token_size=self.chunk_overlap_token_size,
-                        max_token_size=self.chunk_token_size,
-                        tiktoken_model=self.tiktoken_model_name,
-                    )
-                }
-                inserting_chunks.update(chunks)
-            _add_chunk_keys = await self.text_chunks.filter_keys(
-                list(inserting_chunks.keys())
-            )
-            inserting_chunks = {
-                k: v for k, v in inserting_chunks.items() if k in _add_chunk_keys
-            }
-            if not len(inserting_chunks):
-                logger.warning("All chunks are already in the storage")
-                return
-            logger.info(f"[New Chunks] inserting {len(inserting_chunks)} chunks")
-
-            await self.chunks_vdb.upsert(inserting_chunks)
-
+            near_duplicates = {}
             logger.info("[Entity Extraction]...")
             maybe_new_kg = await extract_entities(
-                inserting_chunks,
+                self._stream_chunks(new_docs, inserting_chunks, near_duplicates),
                 knowledge_graph_inst=self.chunk_entity_relation_graph,
                 entity_vdb=self.entities_vdb,
                 relationships_vdb=self.relationships_vdb,
                 global_config=asdict(self),
+                text_chunks=self.text_chunks,
+                extraction_checkpoints=self.extraction_checkpoints,
             )
-            if maybe_new_kg is None:
+            completed = True
+            if near_duplicates:
+                self._log_near_duplicates(near_duplicates)
+            if not len(inserting_chunks) and not near_duplicates:
+                logger.warning("All chunks are already in the storage")
+                return
+            if maybe_new_kg is not None:
+                self.chunk_entity_relation_graph = maybe_new_kg
+            elif any(k not in near_duplicates for k in inserting_chunks):
                 logger.warning("No new entities and relationships found")
                 return
-            self.chunk_entity_relation_graph = maybe_new_kg
 
             await self.full_docs.upsert(new_docs)
-            await self.text_chunks.upsert(inserting_chunks)
         finally:
             if update_storage:
                 await self._insert_done()
+            if completed:
+                await self._prune_checkpoints(list(inserting_chunks))
+            if store_stats is not None:
+                current = self.content_embedding_store.stats()
+                logger.info(
+                    f"[Embeddings] {current['computed'] - store_stats['computed']} computed, "
+                    f"{current['skipped'] - store_stats['skipped']} reused from the content store"
+                )
+            CALL_PRIORITY.reset(priority)
+
+    async def _stream_chunks(
+        self, new_docs: dict, inserting_chunks: dict, near_duplicates: dict
+    ):
+        """Chunk documents and embed their new chunks, yielding them for extraction.
+
+        Chunks are embedded in groups of ``embedding_batch_num`` so extraction
+        of the first chunks starts before the last documents are chunked;
+        every yielded chunk is also recorded in ``inserting_chunks``.  Stored
+        chunks that still have an extraction checkpoint are yielded again.  With
+        near-duplicate detection on, a chunk similar to a stored chunk or an
+        earlier one of this insert is not extracted: it is recorded in
+        ``near_duplicates`` and, for the "link" action, stored with a
+        ``duplicate_of`` reference instead.
+        """
+        batch = {}
+        linked = {}
+        dedup_index = self.chunk_dedup_index
+        link = self.chunk_dedup_config.get("action", "link") == "link"
+
+        async def _embed_batch():
+            await self.chunks_vdb.upsert({**batch, **linked})
+            if linked:
+                await self.text_chunks.upsert(linked)
+            inserting_chunks.update(batch)
+            inserting_chunks.update(linked)
+            logger.info(f"[New Chunks] embedded {len(inserting_chunks)} chunks")
+
+        async def _original_of(chunk_key: str, signature) -> Optional[str]:
+            matches = [k for k, _ in dedup_index.query(signature) if k != chunk_key]
+            pending = [k for k in matches if k in batch or k in inserting_chunks]
+            if pending:
+                return pending[0]
+            # an index entry may outlive a chunk whose insert failed
+            missing = await self.text_chunks.filter_keys(matches) if matches else set()
+            stored = [k for k in matches if k not in missing]
+            return stored[0] if stored else None
+
+        for doc_key, doc in tqdm_async(
+            new_docs.items(), desc="Chunking documents", unit="doc"
+        ):
+            chunks = {
+                compute_mdhash_id(dp["content"], prefix="chunk-"): {
+                    **dp,
+                    "full_doc_id": doc_key,
+                }
+                for dp in chunking_by_token_size(
+                    doc["content"],
+                    overlap_token_size=self.chunk_overlap_token_size,
+                    max_token_size=self.chunk_token_size,
+                    tiktoken_model=self.tiktoken_model_name,
+                )
+            }
+            _add_chunk_keys = await self.text_chunks.filter_keys(list(chunks.keys()))
+            # a stored chunk whose checkpoint outlived an interrupted insert may
+            # be missing from the saved graph, so it is merged again
+            stored = [k for k in chunks if k not in _add_chunk_keys]
+            resumed = set()
+            if stored and self.extraction_checkpoints is not None:
+                resumed = set(stored) - await self.extraction_checkpoints.filter_keys(
+                    stored
+                )
+            for k in _add_chunk_keys | resumed:
+                if k in inserting_chunks or k in near_duplicates:
+                    continue
+                if dedup_index is not None:
+                    signature = dedup_index.signature(chunks[k]["content"])
+                    original = (
+                        None if k in resumed else await _original_of(k, signature)
+                    )
+                    if original is not None:
+                        near_duplicates[k] = original
+                        if link:
+                            linked[k] = {**chunks[k], "duplicate_of": original}
+                        continue
+                    dedup_index.add(k, signature)
+                batch[k] = chunks[k]
+            if len(batch) + len(linked) >= self.embedding_batch_num:
+                await _embed_batch()
+                for item in batch.items():
+                    yield item
+                batch, linked = {}, {}
+        if batch or linked:
+            await _embed_batch()
+            for item in batch.items():
+                yield item
+
+    def _log_near_duplicates(self, near_duplicates: dict):
+        action = (
+            "linked to"
+            if self.chunk_dedup_config.get("action", "link") == "link"
+            else "skipped as duplicates of"
+        )
+        message = f"[Near Duplicates] {len(near_duplicates)} chunks {action} similar chunks"
+        if not self.entity_extract_pack_tokens:
+            # the first pass, plus the gleaning pass and loop check when enabled
+            calls = 1 + min(self.entity_extract_max_gleaning, 1)
+            calls += 1 if self.entity_extract_max_gleaning > 1 else 0
+            message += f", at least {calls * len(near_duplicates)} extraction LLM calls avoided"
+        logger.info(message)
+
+    def scheduler_stats(self) -> dict:
+        """Queue depth and wait times of the LLM and embedding call limits."""
+        return {
+            name: func.scheduler.stats()
+            for name, func in [
+                ("llm", self.llm_model_func),
+                ("embedding", self.embedding_func),
+            ]
+            if hasattr(func, "scheduler")
+        }
 
     async def _insert_done(self):
+        if self.response_cache is not None:
+            await self.response_cache.bump_generation()
+        if self.summary_cache is not None:
+            await self.summary_cache.flush()
+        self.keyword_index.save()
+        if self.chunk_dedup_index is not None:
+            self.chunk_dedup_index.save()
         tasks = []
         for storage_inst in [
             self.full_docs,
             self.text_chunks,
             self.llm_response_cache,
+            self.extraction_checkpoints,
+            self.summary_cache.kv if self.summary_cache is not None else None,
             self.entities_vdb,
             self.relationships_vdb,
             self.chunks_vdb,
@@ -358,12 +694,23 @@ class PathRAG:
             tasks.append(cast(StorageNameSpace, storage_inst).index_done_callback())
         await asyncio.gather(*tasks)
 
+    async def _prune_checkpoints(self, chunk_keys: list[str]):
+        """Drop the extraction checkpoints of chunks persisted in `text_chunks`."""
+        if self.extraction_checkpoints is None or not chunk_keys:
+            return
+        missing = await self.text_chunks.filter_keys(chunk_keys)
+        landed = [k for k in chunk_keys if k not in missing]
+        if landed:
+            await self.extraction_checkpoints.delete(landed)
+            await self.extraction_checkpoints.index_done_callback()
+
     def insert_custom_kg(self, custom_kg: dict):
         loop = always_get_an_event_loop()
         return loop.run_until_complete(self.ainsert_custom_kg(custom_kg))
 
     async def ainsert_custom_kg(self, custom_kg: dict):
         update_storage = False
+        priority = CALL_PRIORITY.set(PRIORITY_BULK)
         try:
 
             all_chunks_data = {}
@@ -465,6 +812,13 @@ class PathRAG:
                 all_relationships_data.append(edge_data)
                 update_storage = True
 
+            for dp in all_entities_data:
+                self.keyword_index.add_entity(dp["entity_name"])
+            for dp in all_relationships_data:
+                self.keyword_index.add_entity(dp["src_id"])
+                self.keyword_index.add_entity(dp["tgt_id"])
+                self.keyword_index.add_keywords(dp["keywords"])
+
 
             if self.entities_vdb is not None:
                 data_for_vdb = {
@@ -493,6 +847,7 @@ class PathRAG:
         finally:
             if update_storage:
                 await self._insert_done()
+            CALL_PRIORITY.reset(priority)
     
     async def query(self, query: str, param: QueryParam = QueryParam()):
         loop = always_get_an_event_loop()
@@ -518,13 +873,30 @@ class PathRAG:
             print("response all ready")
         else:
             raise ValueError(f"Unknown mode {param.mode}")
+        if hasattr(response, "__aiter__"):
+            return self._stream_then_query_done(response)
         await self._query_done()
         return response
 
+    async def _stream_then_query_done(self, response):
+        try:
+            async for chunk in response:
+                yield chunk
+        finally:
+            await self._query_done()
+
         
     async def _query_done(self):
+        for cache in [self.response_cache, self.keyword_cache]:
+            if cache is not None:
+                await cache.flush()
+        # a local extraction may have filled the index from the graph
+        self.keyword_index.save()
         tasks = []
-        for storage_inst in [self.llm_response_cache]:
+        for storage_inst in [
+            self.llm_response_cache,
+            self.keyword_cache.kv if self.keyword_cache is not None else None,
+        ]:
             if storage_inst is None:
                 continue
             tasks.append(cast(StorageNameSpace, storage_inst).index_done_callback())
@@ -541,6 +913,7 @@ class PathRAG:
             await self.entities_vdb.delete_entity(entity_name)
             await self.relationships_vdb.delete_relation(entity_name)
             await self.chunk_entity_relation_graph.delete_node(entity_name)
+            self.keyword_index.remove_entity(entity_name)
 
             logger.info(
                 f"Entity '{entity_name}' and its relationships have been deleted."
@@ -550,11 +923,15 @@ class PathRAG:
             logger.error(f"Error while deleting entity '{entity_name}': {e}")
 
     async def _delete_by_entity_done(self):
+        if self.response_cache is not None:
+            await self.response_cache.bump_generation()
+        self.keyword_index.save()
         tasks = []
         for storage_inst in [
             self.entities_vdb,
             self.relationships_vdb,
             self.chunk_entity_relation_graph,
+            self.llm_response_cache,
         ]:
             if storage_inst is None:
                 continue
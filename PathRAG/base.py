@@ -1,5 +1,6 @@
+import asyncio
 from dataclasses import dataclass, field
-from typing import TypedDict, Union, Literal, Generic, TypeVar
+from typing import TypedDict, Union, Literal, Generic, TypeVar, Optional
 
 import numpy as np
 
@@ -24,6 +25,19 @@ class QueryParam:
     max_token_for_text_unit: int = 4000
     max_token_for_global_context: int = 3000
     max_token_for_local_context: int = 5000
+    path_max_hops: int = 3
+    path_max_paths: int = 10000
+    path_max_fanout: Optional[int] = 500
+    path_max_expansions: Optional[int] = 200000
+    path_search_timeout: Optional[float] = 1.0
+    path_flow_threshold: float = 0.3
+    path_flow_alpha: float = 0.8
+    # "flow" scores paths with the vectorised flow_weighted_paths, which is
+    # faster but scores a node reached at two depths differently from "bfs"
+    path_scorer: Literal["bfs", "flow"] = "bfs"
+    # "local" matches the query against entity names and relationship keywords
+    # first and only asks the LLM when no entity is named
+    keyword_extractor: Literal["llm", "local"] = "llm"
 
 
 @dataclass
@@ -48,6 +62,21 @@ class BaseVectorStorage(StorageNameSpace):
     async def query(self, query: str, top_k: int) -> list[dict]:
         raise NotImplementedError
 
+    async def query_batch(
+        self,
+        queries: list[str],
+        top_k: int,
+        embeddings: Optional[np.ndarray] = None,
+    ) -> list[list[dict]]:
+        """Results of `query` for each of `queries`, in order.
+
+        Backends that can score several query vectors at once override this,
+        embed `queries` in a single call and use `embeddings` as-is when the
+        caller already has them. This default falls back to one `query` per
+        string.
+        """
+        return list(await asyncio.gather(*[self.query(q, top_k) for q in queries]))
+
     async def upsert(self, data: dict[str, dict]):
 
         raise NotImplementedError
@@ -75,6 +104,9 @@ class BaseKVStorage(Generic[T], StorageNameSpace):
     async def upsert(self, data: dict[str, T]):
         raise NotImplementedError
 
+    async def delete(self, ids: list[str]):
+        raise NotImplementedError
+
     async def drop(self):
         raise NotImplementedError
 
@@ -120,6 +152,54 @@ class BaseGraphStorage(StorageNameSpace):
     ) -> Union[list[tuple[str,str]],None]:
         raise NotImplementedError
 
+    async def get_nodes_batch(self, node_ids: list[str]) -> list[Union[dict, None]]:
+        return await asyncio.gather(*[self.get_node(n) for n in node_ids])
+
+    async def get_edges_batch(
+        self, pairs: list[tuple[str, str]]
+    ) -> list[Union[dict, None]]:
+        """Edge data for each `(src, tgt)` pair, looked up in either direction."""
+
+        async def _get_either_direction(src_id, tgt_id):
+            edge = await self.get_edge(src_id, tgt_id)
+            if edge is None:
+                edge = await self.get_edge(tgt_id, src_id)
+            return edge
+
+        return await asyncio.gather(*[_get_either_direction(s, t) for s, t in pairs])
+
+    async def node_degrees_batch(self, node_ids: list[str]) -> list[int]:
+        return await asyncio.gather(*[self.node_degree(n) for n in node_ids])
+
+    async def edge_degrees_batch(self, pairs: list[tuple[str, str]]) -> list[int]:
+        return await asyncio.gather(*[self.edge_degree(s, t) for s, t in pairs])
+
+    async def get_node_neighbors(self, node_id: str) -> list[str]:
+        """Neighbours of `node_id` ignoring edge direction."""
+        raise NotImplementedError
+
+    async def get_neighborhood_adjacency(
+        self, node_ids: list[str], max_depth: int
+    ) -> dict[str, set[str]]:
+        """Undirected adjacency lists of every node within `max_depth` hops of `node_ids`.
+
+        Path search reads this instead of materialising the whole graph, so its
+        cost depends on the neighbourhood of the seeds and not on graph size.
+        """
+        adjacency = {}
+        frontier = list(dict.fromkeys(node_ids))
+        for depth in range(max_depth + 1):
+            next_frontier = []
+            for node_id in frontier:
+                if node_id in adjacency:
+                    continue
+                neighbors = set(await self.get_node_neighbors(node_id))
+                adjacency[node_id] = neighbors
+                if depth < max_depth:
+                    next_frontier.extend(n for n in neighbors if n not in adjacency)
+            frontier = next_frontier
+        return adjacency
+
     async def upsert_node(self, node_id: str, node_data: dict[str, str]):
         raise NotImplementedError
 
@@ -11,7 +11,6 @@ import aiohttp
 import numpy as np
 import ollama
 import torch
-import time
 import modelscope as ms
 from vllm import LLM
 from openai import (
@@ -32,6 +31,7 @@ from transformers import AutoTokenizer, AutoModelForCausalLM
 
 from .utils import (
     wrap_embedding_func_with_attrs,
+    wrap_llm_func_with_attrs,
     locate_json_string_body_from_string,
     safe_unicode_decode,
     logger,
@@ -64,7 +64,6 @@ async def openai_complete_if_cache(
 ) -> str:
     if api_key:
         os.environ["OPENAI_API_KEY"] = api_key
-    time.sleep(2)
     openai_async_client = (
         AsyncOpenAI() if base_url is None else AsyncOpenAI(base_url=base_url)
     )
@@ -503,6 +502,7 @@ async def openai_complete(
     )
 
 
+@wrap_llm_func_with_attrs(model_name="gpt-4o")
 async def gpt_4o_complete(
     prompt, system_prompt=None, history_messages=[], keyword_extraction=False, **kwargs
 ) -> str:
@@ -518,6 +518,7 @@ async def gpt_4o_complete(
     )
 
 
+@wrap_llm_func_with_attrs(model_name="gpt-4o-mini")
 async def gpt_4o_mini_complete(
     prompt, system_prompt=None, history_messages=[], keyword_extraction=False, **kwargs
 ) -> str:
@@ -533,6 +534,7 @@ async def gpt_4o_mini_complete(
     )
 
 
+@wrap_llm_func_with_attrs(model_name="nvidia/llama-3.1-nemotron-70b-instruct")
 async def nvidia_openai_complete(
     prompt, system_prompt=None, history_messages=[], keyword_extraction=False, **kwargs
 ) -> str:
@@ -550,6 +552,7 @@ async def nvidia_openai_complete(
     return result
 
 
+@wrap_llm_func_with_attrs(model_name="conversation-4o-mini")
 async def azure_openai_complete(
     prompt, system_prompt=None, history_messages=[], keyword_extraction=False, **kwargs
 ) -> str:
@@ -566,6 +569,7 @@ async def azure_openai_complete(
     return result
 
 
+@wrap_llm_func_with_attrs(model_name="anthropic.claude-3-haiku-20240307-v1:0")
 async def bedrock_complete(
     prompt, system_prompt=None, history_messages=[], keyword_extraction=False, **kwargs
 ) -> str:
@@ -665,6 +669,7 @@ async def zhipu_complete_if_cache(
     return response.choices[0].message.content
 
 
+@wrap_llm_func_with_attrs(model_name="glm-4-flashx")
 async def zhipu_complete(
     prompt, system_prompt=None, history_messages=[], keyword_extraction=False, **kwargs
 ):
@@ -740,7 +745,9 @@ async def zhipu_complete(
         )
 
 
-@wrap_embedding_func_with_attrs(embedding_dim=1024, max_token_size=8192)
+@wrap_embedding_func_with_attrs(
+    embedding_dim=1024, max_token_size=8192, model_name="embedding-3"
+)
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=4, max=60),
@@ -773,7 +780,9 @@ async def zhipu_embedding(
     return np.array(embeddings)
 
 
-@wrap_embedding_func_with_attrs(embedding_dim=1536, max_token_size=8192)
+@wrap_embedding_func_with_attrs(
+    embedding_dim=1536, max_token_size=8192, model_name="text-embedding-3-small"
+)
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=4, max=60),
@@ -831,7 +840,9 @@ async def jina_embedding(
     return np.array([dp["embedding"] for dp in data_list])
 
 
-@wrap_embedding_func_with_attrs(embedding_dim=2048, max_token_size=512)
+@wrap_embedding_func_with_attrs(
+    embedding_dim=2048, max_token_size=512, model_name="nvidia/llama-3.2-nv-embedqa-1b-v1"
+)
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=4, max=60),
@@ -861,7 +872,9 @@ async def nvidia_openai_embedding(
     return np.array([dp.embedding for dp in response.data])
 
 
-@wrap_embedding_func_with_attrs(embedding_dim=1536, max_token_size=8191)
+@wrap_embedding_func_with_attrs(
+    embedding_dim=1536, max_token_size=8191, model_name="text-embedding-3-small"
+)
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=4, max=10),
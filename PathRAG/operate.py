@@ -2,12 +2,15 @@ import asyncio
 import json
 import re
 from tqdm.asyncio import tqdm as tqdm_async
-from typing import Union
+from typing import AsyncIterator, Union
 from collections import Counter, defaultdict
+from itertools import chain
 import warnings
 import tiktoken
 import time
 import csv
+import numpy as np
+from scipy import sparse
 from .utils import (
     logger,
     clean_str,
@@ -24,6 +27,8 @@ from .utils import (
     handle_cache,
     save_to_cache,
     CacheData,
+    embed_queries,
+    normalize_query,
 )
 from .base import (
     BaseGraphStorage,
@@ -60,6 +65,7 @@ async def _handle_entity_relation_summary(
     entity_or_relation_name: str,
     description: str,
     global_config: dict,
+    summary_stats: dict = None,
 ) -> str:
     use_llm_func: callable = global_config["llm_model_func"]
     llm_max_tokens = global_config["llm_model_max_token_size"]
@@ -82,8 +88,24 @@ async def _handle_entity_relation_summary(
         language=language,
     )
     use_prompt = prompt_template.format(**context_base)
+    summary_cache = global_config.get("summary_cache")
+    cache_key = compute_args_hash(
+        "summary", use_prompt, summary_max_tokens, global_config.get("llm_model_name")
+    )
+    if summary_cache is not None:
+        cached = await summary_cache.get(cache_key)
+        if cached is not None:
+            if summary_stats is not None:
+                summary_stats["cached"] += 1
+            return cached["return"]
     logger.debug(f"Trigger summary: {entity_or_relation_name}")
     summary = await use_llm_func(use_prompt, max_tokens=summary_max_tokens)
+    if summary_stats is not None:
+        summary_stats["llm"] += 1
+    if summary_cache is not None:
+        await summary_cache.put(
+            cache_key, "summary", summary, entity_or_relation_name
+        )
     return summary
 
 
@@ -150,7 +172,13 @@ async def _merge_nodes_then_upsert(
         already_source_ids.extend(
             split_string_by_multi_markers(already_node["source_id"], [GRAPH_FIELD_SEP])
         )
-        already_description.append(already_node["description"])
+        already_description.extend(
+            split_string_by_multi_markers(already_node["description"], [GRAPH_FIELD_SEP])
+        )
+        # chunks already listed were merged by an interrupted insert
+        nodes_data = [dp for dp in nodes_data if dp["source_id"] not in already_source_ids]
+        if not nodes_data:
+            return dict(already_node, entity_name=entity_name)
 
     entity_type = sorted(
         Counter(
@@ -165,9 +193,6 @@ async def _merge_nodes_then_upsert(
     source_id = GRAPH_FIELD_SEP.join(
         set([dp["source_id"] for dp in nodes_data] + already_source_ids)
     )
-    description = await _handle_entity_relation_summary(
-        entity_name, description, global_config
-    )
     node_data = dict(
         entity_type=entity_type,
         description=description,
@@ -199,10 +224,20 @@ async def _merge_edges_then_upsert(
         already_source_ids.extend(
             split_string_by_multi_markers(already_edge["source_id"], [GRAPH_FIELD_SEP])
         )
-        already_description.append(already_edge["description"])
+        already_description.extend(
+            split_string_by_multi_markers(already_edge["description"], [GRAPH_FIELD_SEP])
+        )
         already_keywords.extend(
             split_string_by_multi_markers(already_edge["keywords"], [GRAPH_FIELD_SEP])
         )
+        edges_data = [dp for dp in edges_data if dp["source_id"] not in already_source_ids]
+        if not edges_data:
+            return dict(
+                src_id=src_id,
+                tgt_id=tgt_id,
+                description=already_edge["description"],
+                keywords=already_edge["keywords"],
+            )
 
     weight = sum([dp["weight"] for dp in edges_data] + already_weights)
     description = GRAPH_FIELD_SEP.join(
@@ -224,9 +259,6 @@ async def _merge_edges_then_upsert(
                     "entity_type": '"UNKNOWN"',
                 },
             )
-    description = await _handle_entity_relation_summary(
-        f"({src_id}, {tgt_id})", description, global_config
-    )
     await knowledge_graph_inst.upsert_edge(
         src_id,
         tgt_id,
@@ -249,18 +281,17 @@ async def _merge_edges_then_upsert(
 
 
 async def extract_entities(
-    chunks: dict[str, TextChunkSchema],
+    chunks: Union[dict[str, TextChunkSchema], AsyncIterator[tuple[str, TextChunkSchema]]],
     knowledge_graph_inst: BaseGraphStorage,
     entity_vdb: BaseVectorStorage,
     relationships_vdb: BaseVectorStorage,
     global_config: dict,
+    text_chunks: BaseKVStorage = None,
+    extraction_checkpoints: BaseKVStorage = None,
 ) -> Union[BaseGraphStorage, None]:
-    time.sleep(20)
     use_llm_func: callable = global_config["llm_model_func"]
     entity_extract_max_gleaning = global_config["entity_extract_max_gleaning"]
 
-    ordered_chunks = list(chunks.items())
-  
     language = global_config["addon_params"].get(
         "language", PROMPTS["DEFAULT_LANGUAGE"]
     )
@@ -298,26 +329,58 @@ async def extract_entities(
     continue_prompt = PROMPTS["entiti_continue_extraction"]
     if_loop_prompt = PROMPTS["entiti_if_loop_extraction"]
 
+    # raw extraction output is checkpointed per chunk; a change to the
+    # prompts, gleaning or model starts a new version instead of reusing it
+    prompt_version = compute_mdhash_id(
+        json.dumps(
+            [
+                entity_extract_prompt.format(**context_base, input_text=""),
+                continue_prompt,
+                if_loop_prompt,
+                PROMPTS["entity_extraction_packed"],
+                PROMPTS["entiti_continue_extraction_packed"],
+                entity_extract_max_gleaning,
+                global_config.get("llm_model_name"),
+            ]
+        )
+    )
+    checkpoint_interval = global_config.get("extraction_checkpoint_interval", 5.0)
+    last_checkpoint_flush = time.monotonic()
+    resumed_chunks = 0
+
     already_processed = 0
     already_entities = 0
     already_relations = 0
 
-    async def _process_single_content(chunk_key_dp: tuple[str, TextChunkSchema]):
-        nonlocal already_processed, already_entities, already_relations
-        chunk_key = chunk_key_dp[0]
-        chunk_dp = chunk_key_dp[1]
-        content = chunk_dp["content"]
+    async def _save_checkpoint(checkpoint_id: str, chunk_key: str, final_result: str):
+        nonlocal last_checkpoint_flush
+        await extraction_checkpoints.upsert(
+            {
+                checkpoint_id: {
+                    "chunk_id": chunk_key,
+                    "prompt_version": prompt_version,
+                    "extraction": final_result,
+                }
+            }
+        )
+        if time.monotonic() - last_checkpoint_flush >= checkpoint_interval:
+            last_checkpoint_flush = time.monotonic()
+            await extraction_checkpoints.index_done_callback()
+
+    async def _extract_passes(input_text: str, glean_prompt: str) -> list[str]:
+        """Output of the first extraction pass followed by each gleaning pass."""
         hint_prompt = entity_extract_prompt.format(
             **context_base, input_text="{input_text}"
-        ).format(**context_base, input_text=content)
+        ).format(**context_base, input_text=input_text)
 
         final_result = await use_llm_func(hint_prompt)
+        passes = [final_result]
         history = pack_user_ass_to_openai_messages(hint_prompt, final_result)
         for now_glean_index in range(entity_extract_max_gleaning):
-            glean_result = await use_llm_func(continue_prompt, history_messages=history)
+            glean_result = await use_llm_func(glean_prompt, history_messages=history)
 
-            history += pack_user_ass_to_openai_messages(continue_prompt, glean_result)
-            final_result += glean_result
+            history += pack_user_ass_to_openai_messages(glean_prompt, glean_result)
+            passes.append(glean_result)
             if now_glean_index == entity_extract_max_gleaning - 1:
                 break
 
@@ -327,7 +390,78 @@ async def extract_entities(
             if_loop_result = if_loop_result.strip().strip('"').strip("'").lower()
             if if_loop_result != "yes":
                 break
+        return passes
+
+    async def _extract_with_llm(input_text: str, glean_prompt: str) -> str:
+        return "".join(await _extract_passes(input_text, glean_prompt))
+
+    chunk_marker = PROMPTS["DEFAULT_CHUNK_DELIMITER"]
+    chunk_marker_pattern = re.compile(
+        re.escape(chunk_marker).replace(re.escape("{index}"), r"(\d+)")
+    )
+    unassigned_records = 0
+
+    async def _extract_packed(pack: list[tuple[str, TextChunkSchema]]) -> list[str]:
+        """Extract several chunks with one prompt and split the output per chunk.
+
+        Every pass is split on its own markers, so a gleaning pass that does
+        not repeat them is not credited to the last chunk of the first pass.
+        Records written before any marker, or after an unknown one, go to the
+        chunks of the pack that mention the record's entities.
+        """
+        nonlocal unassigned_records
+        packed_text = "\n\n".join(
+            f"{chunk_marker.format(index=i)}\n{dp['content']}"
+            for i, (_, dp) in enumerate(pack, start=1)
+        )
+        input_text = PROMPTS["entity_extraction_packed"].format(
+            **context_base,
+            chunk_count=len(pack),
+            first_marker=chunk_marker.format(index=1),
+            second_marker=chunk_marker.format(index=2),
+            packed_text=packed_text,
+        )
+        passes = await _extract_passes(
+            input_text, PROMPTS["entiti_continue_extraction_packed"]
+        )
+
+        segments = [[] for _ in pack]
+        stray = []
+        for pass_result in passes:
+            parts = chunk_marker_pattern.split(pass_result)
+            stray.append(parts[0])
+            for index, text in zip(parts[1::2], parts[2::2]):
+                if 1 <= int(index) <= len(pack):
+                    segments[int(index) - 1].append(text)
+                else:
+                    stray.append(text)
+        contents = [dp["content"].lower() for _, dp in pack]
+        for record in split_string_by_multi_markers(
+            "".join(stray),
+            [context_base["record_delimiter"], context_base["completion_delimiter"]],
+        ):
+            match = re.search(r"\((.*)\)", record)
+            if match is None:
+                continue
+            attributes = split_string_by_multi_markers(
+                match.group(1), [context_base["tuple_delimiter"]]
+            )
+            names = [clean_str(name).strip('"').lower() for name in attributes[1:3]]
+            if attributes[0] == '"entity"':
+                names = names[:1]
+            owners = [
+                i
+                for i, content in enumerate(contents)
+                if names and all(name and name in content for name in names)
+            ]
+            if not owners:
+                unassigned_records += 1
+            for i in owners:
+                segments[i].append(match.group(0) + context_base["record_delimiter"])
+        return ["".join(segment) for segment in segments]
 
+    async def _parse_extraction(chunk_key: str, final_result: str):
+        nonlocal already_processed, already_entities, already_relations
         records = split_string_by_multi_markers(
             final_result,
             [context_base["record_delimiter"], context_base["completion_delimiter"]],
@@ -370,92 +504,381 @@ async def extract_entities(
         )
         return dict(maybe_nodes), dict(maybe_edges)
 
-    results = []
-    for result in tqdm_async(
-        asyncio.as_completed([_process_single_content(c) for c in ordered_chunks]),
-        total=len(ordered_chunks),
-        desc="Extracting entities from chunks",
-        unit="chunk",
-    ):
-        results.append(await result)
-
-    maybe_nodes = defaultdict(list)
-    maybe_edges = defaultdict(list)
-    for m_nodes, m_edges in results:
-        for k, v in m_nodes.items():
-            maybe_nodes[k].extend(v)
-        for k, v in m_edges.items():
-            maybe_edges[k].extend(v)
-    logger.info("Inserting entities into storage...")
-    all_entities_data = []
-    for result in tqdm_async(
-        asyncio.as_completed(
-            [
+    async def _process_pack(pack: list[tuple[str, TextChunkSchema]]):
+        nonlocal resumed_chunks
+        checkpoint_ids = [chunk_key for chunk_key, _ in pack]
+        checkpoints = (
+            await extraction_checkpoints.get_by_ids(checkpoint_ids)
+            if extraction_checkpoints is not None
+            else [None] * len(pack)
+        )
+        extractions = [
+            cp["extraction"]
+            if cp is not None and cp.get("prompt_version") == prompt_version
+            else None
+            for cp in checkpoints
+        ]
+        resumed_chunks += sum(e is not None for e in extractions)
+        todo = [i for i, e in enumerate(extractions) if e is None]
+        if len(todo) == 1:
+            extractions[todo[0]] = await _extract_with_llm(
+                pack[todo[0]][1]["content"], continue_prompt
+            )
+        elif todo:
+            packed = await _extract_packed([pack[i] for i in todo])
+            for i, extraction in zip(todo, packed):
+                extractions[i] = extraction
+        if extraction_checkpoints is not None:
+            for i in todo:
+                await _save_checkpoint(checkpoint_ids[i], pack[i][0], extractions[i])
+        return [
+            (item, await _parse_extraction(item[0], extraction))
+            for item, extraction in zip(pack, extractions)
+        ]
+
+    # extraction workers feed a single merger through bounded queues, so the
+    # graph and vector stores grow while later chunks are still extracting
+    extract_workers = global_config.get("entity_extract_max_async", 16)
+    queue_size = global_config.get("insert_queue_size", 64)
+    chunk_queue = asyncio.Queue(maxsize=queue_size)
+    result_queue = asyncio.Queue(maxsize=queue_size)
+    keyword_index = global_config.get("keyword_index")
+
+    # small chunks are packed into one prompt up to this many chunk tokens
+    pack_tokens = global_config.get("entity_extract_pack_tokens", 0)
+    fed_chunks = 0
+    packed_calls = 0
+
+    async def _feed_chunks():
+        nonlocal fed_chunks, packed_calls
+        pack, pack_size = [], 0
+
+        async def _put(pack):
+            nonlocal packed_calls
+            packed_calls += len(pack) > 1
+            await chunk_queue.put(pack)
+
+        async def _items():
+            if isinstance(chunks, dict):
+                for item in chunks.items():
+                    yield item
+            else:
+                async for item in chunks:
+                    yield item
+
+        async for item in _items():
+            fed_chunks += 1
+            size = item[1].get("tokens") or len(
+                encode_string_by_tiktoken(
+                    item[1]["content"], model_name=global_config["tiktoken_model_name"]
+                )
+            )
+            if pack and pack_size + size > pack_tokens:
+                await _put(pack)
+                pack, pack_size = [], 0
+            pack.append(item)
+            pack_size += size
+        if pack:
+            await _put(pack)
+        for _ in range(extract_workers):
+            await chunk_queue.put(None)
+
+    async def _extract_worker():
+        while (pack := await chunk_queue.get()) is not None:
+            for result in await _process_pack(pack):
+                await result_queue.put(result)
+
+    async def _extract_all():
+        await _run_stages(
+            _feed_chunks(), *[_extract_worker() for _ in range(extract_workers)]
+        )
+        await result_queue.put(None)
+
+    merged_entities = 0
+    merged_relationships = 0
+    known_nodes = set()
+    # edges wait until both endpoints were extracted, so an endpoint that is
+    # still in flight is not created as an "UNKNOWN" placeholder
+    pending_edges = defaultdict(list)
+    waiting_on = defaultdict(set)
+
+    # the vector stage summarizes and embeds the latest version of everything
+    # merged since its previous round, so an entity updated by several
+    # chunks in between is summarized and embedded once; a round starts when
+    # there is enough to fill the concurrent embedding batches
+    vector_round_size = global_config.get("embedding_batch_num", 32) * global_config.get(
+        "embedding_func_max_async", 16
+    )
+    dirty_entities = set()
+    dirty_relationships = set()
+    dirty_chunks = {}
+    vectors_dirty = asyncio.Event()
+    merge_finished = False
+    # descriptions as last written by a summary, which need no new one
+    summarized = {}
+    # until the last round only descriptions past twice the summary size are
+    # summarized, so an entity merged across rounds is usually summarized once
+    deferred_summaries = set()
+    summary_max_tokens = global_config["entity_summary_to_max_tokens"]
+    summary_stats = {"llm": 0, "cached": 0, "deferred": 0}
+
+    async def _endpoints_known(edge_key):
+        for node in edge_key:
+            if node not in known_nodes:
+                if not await knowledge_graph_inst.has_node(node):
+                    waiting_on[node].add(edge_key)
+                    return False
+                known_nodes.add(node)
+        return True
+
+    async def _merge_batch(results, flush=False):
+        nonlocal merged_entities, merged_relationships
+        maybe_nodes = defaultdict(list)
+        for _, (m_nodes, m_edges) in results:
+            for k, v in m_nodes.items():
+                maybe_nodes[k].extend(v)
+            for k, v in m_edges.items():
+                pending_edges[k].extend(v)
+        entities_data = await asyncio.gather(
+            *[
                 _merge_nodes_then_upsert(k, v, knowledge_graph_inst, global_config)
                 for k, v in maybe_nodes.items()
             ]
-        ),
-        total=len(maybe_nodes),
-        desc="Inserting entities",
-        unit="entity",
-    ):
-        all_entities_data.append(await result)
-
-    logger.info("Inserting relationships into storage...")
-    all_relationships_data = []
-    for result in tqdm_async(
-        asyncio.as_completed(
-            [
+        )
+        known_nodes.update(maybe_nodes)
+
+        candidates = {k for _, (_, m_edges) in results for k in m_edges}
+        for node in maybe_nodes:
+            candidates |= waiting_on.pop(node, set())
+        ready = [
+            k
+            for k in (pending_edges if flush else candidates)
+            if k in pending_edges and (flush or await _endpoints_known(k))
+        ]
+        relationships_data = await asyncio.gather(
+            *[
                 _merge_edges_then_upsert(
-                    k[0], k[1], v, knowledge_graph_inst, global_config
+                    k[0], k[1], pending_edges.pop(k), knowledge_graph_inst, global_config
                 )
-                for k, v in maybe_edges.items()
+                for k in ready
             ]
-        ),
-        total=len(maybe_edges),
-        desc="Inserting relationships",
-        unit="relationship",
-    ):
-        all_relationships_data.append(await result)
+        )
+        merged_entities += len(entities_data)
+        merged_relationships += len(relationships_data)
+
+        if keyword_index is not None:
+            for dp in entities_data:
+                keyword_index.add_entity(dp["entity_name"])
+            for dp in relationships_data:
+                keyword_index.add_keywords(dp["keywords"])
+
+        dirty_entities.update(dp["entity_name"] for dp in entities_data)
+        dirty_relationships.update(
+            (dp["src_id"], dp["tgt_id"]) for dp in relationships_data
+        )
+        dirty_chunks.update(chunk for chunk, _ in results)
+        if len(dirty_entities) + len(dirty_relationships) >= vector_round_size:
+            vectors_dirty.set()
+
+    async def _summarize(key, description: str, final: bool) -> str:
+        if summarized.get(key) == description:
+            return description
+        if not final:
+            tokens = len(
+                encode_string_by_tiktoken(
+                    description, model_name=global_config["tiktoken_model_name"]
+                )
+            )
+            if summary_max_tokens <= tokens < 2 * summary_max_tokens:
+                if key not in deferred_summaries:
+                    deferred_summaries.add(key)
+                    summary_stats["deferred"] += 1
+                return description
+        name = key if isinstance(key, str) else f"({key[0]}, {key[1]})"
+        stats = {"llm": 0, "cached": 0}
+        summary = await _handle_entity_relation_summary(
+            name, description, global_config, stats
+        )
+        summary_stats["llm"] += stats["llm"]
+        summary_stats["cached"] += stats["cached"]
+        return summary
+
+    def _keep_concurrent_merges(summary: str, description: str, latest: str) -> str:
+        # descriptions merged while the summary was written stay next to it
+        covered = set(split_string_by_multi_markers(description, [GRAPH_FIELD_SEP]))
+        added = [
+            part
+            for part in split_string_by_multi_markers(latest, [GRAPH_FIELD_SEP])
+            if part not in covered
+        ]
+        return GRAPH_FIELD_SEP.join([summary] + added)
+
+    async def _summarize_node(entity_name: str, final: bool):
+        node = await knowledge_graph_inst.get_node(entity_name)
+        if node is None:
+            return None
+        description = node["description"]
+        summary = await _summarize(entity_name, description, final)
+        if summary != description:
+            node = await knowledge_graph_inst.get_node(entity_name)
+            node = dict(
+                node,
+                description=_keep_concurrent_merges(
+                    summary, description, node["description"]
+                ),
+            )
+            await knowledge_graph_inst.upsert_node(entity_name, node_data=node)
+            summarized[entity_name] = node["description"]
+        return dict(node, entity_name=entity_name)
+
+    async def _summarize_edge(edge_key: tuple[str, str], final: bool):
+        edge = await knowledge_graph_inst.get_edge(*edge_key)
+        if edge is None:
+            return None
+        description = edge["description"]
+        summary = await _summarize(edge_key, description, final)
+        if summary != description:
+            edge = await knowledge_graph_inst.get_edge(*edge_key)
+            edge = dict(
+                edge,
+                description=_keep_concurrent_merges(
+                    summary, description, edge["description"]
+                ),
+            )
+            await knowledge_graph_inst.upsert_edge(*edge_key, edge_data=edge)
+            summarized[edge_key] = edge["description"]
+        return dict(edge, src_id=edge_key[0], tgt_id=edge_key[1])
+
+    async def _upsert_vectors():
+        while True:
+            await vectors_dirty.wait()
+            vectors_dirty.clear()
+            final = merge_finished
+            if final:
+                for key in deferred_summaries:
+                    dirty = dirty_entities if isinstance(key, str) else dirty_relationships
+                    dirty.add(key)
+                deferred_summaries.clear()
+            entities, relationships, merged_chunks = (
+                dirty_entities.copy(),
+                dirty_relationships.copy(),
+                dirty_chunks.copy(),
+            )
+            for dirty in [dirty_entities, dirty_relationships, dirty_chunks]:
+                dirty.clear()
+            entities_data, relationships_data = await asyncio.gather(
+                asyncio.gather(*[_summarize_node(k, final) for k in entities]),
+                asyncio.gather(*[_summarize_edge(k, final) for k in relationships]),
+            )
+            upserts = []
+            if entity_vdb is not None and entities:
+                data_for_vdb = {
+                    compute_mdhash_id(dp["entity_name"], prefix="ent-"): {
+                        "content": dp["entity_name"] + dp["description"],
+                        "entity_name": dp["entity_name"],
+                    }
+                    for dp in entities_data
+                    if dp is not None
+                }
+                upserts.append(entity_vdb.upsert(data_for_vdb))
+            if relationships_vdb is not None and relationships:
+                data_for_vdb = {
+                    compute_mdhash_id(dp["src_id"] + dp["tgt_id"], prefix="rel-"): {
+                        "src_id": dp["src_id"],
+                        "tgt_id": dp["tgt_id"],
+                        "content": dp["keywords"]
+                        + dp["src_id"]
+                        + dp["tgt_id"]
+                        + dp["description"],
+                    }
+                    for dp in relationships_data
+                    if dp is not None
+                }
+                upserts.append(relationships_vdb.upsert(data_for_vdb))
+            await asyncio.gather(*upserts)
+            # a chunk counts as inserted once its entities are searchable; its
+            # checkpoint is made durable first, so a crash before the graph is
+            # saved leaves the extraction to merge again on the next insert
+            if text_chunks is not None and merged_chunks:
+                if extraction_checkpoints is not None:
+                    await extraction_checkpoints.index_done_callback()
+                await text_chunks.upsert(merged_chunks)
+            if merge_finished and not vectors_dirty.is_set():
+                return
+
+    async def _merge_all():
+        nonlocal merge_finished
+        done = False
+        while not done:
+            # merge whatever has arrived since the last batch
+            batch = [await result_queue.get()]
+            while not result_queue.empty():
+                batch.append(result_queue.get_nowait())
+            done = batch[-1] is None
+            results = [r for r in batch if r is not None]
+            if results:
+                await _merge_batch(results)
+        if pending_edges:
+            await _merge_batch([], flush=True)
+        merge_finished = True
+        vectors_dirty.set()
+
+    try:
+        await _run_stages(_extract_all(), _merge_all(), _upsert_vectors())
+    finally:
+        if extraction_checkpoints is not None:
+            await extraction_checkpoints.index_done_callback()
+    if not fed_chunks:
+        return None
+    if any(summary_stats.values()):
+        logger.info(
+            f"[Summaries] {summary_stats['llm']} LLM calls, {summary_stats['cached']} "
+            f"calls saved by the summary cache, {summary_stats['deferred']} "
+            f"summaries held for the end of the insert"
+        )
+    if packed_calls:
+        logger.info(
+            f"[Entity Extraction] packed small chunks into {packed_calls} prompts"
+            + (
+                f", {unassigned_records} unmarked records matched no chunk"
+                if unassigned_records
+                else ""
+            )
+        )
+    if resumed_chunks:
+        logger.info(
+            f"[Entity Extraction] reused checkpointed extraction for {resumed_chunks} of {fed_chunks} chunks"
+        )
 
-    if not len(all_entities_data) and not len(all_relationships_data):
+    if not merged_entities and not merged_relationships:
         logger.warning(
             "Didn't extract any entities and relationships, maybe your LLM is not working"
         )
         return None
 
-    if not len(all_entities_data):
+    if not merged_entities:
         logger.warning("Didn't extract any entities")
-    if not len(all_relationships_data):
+    if not merged_relationships:
         logger.warning("Didn't extract any relationships")
-
-    if entity_vdb is not None:
-        data_for_vdb = {
-            compute_mdhash_id(dp["entity_name"], prefix="ent-"): {
-                "content": dp["entity_name"] + dp["description"],
-                "entity_name": dp["entity_name"],
-            }
-            for dp in all_entities_data
-        }
-        await entity_vdb.upsert(data_for_vdb)
-
-    if relationships_vdb is not None:
-        data_for_vdb = {
-            compute_mdhash_id(dp["src_id"] + dp["tgt_id"], prefix="rel-"): {
-                "src_id": dp["src_id"],
-                "tgt_id": dp["tgt_id"],
-                "content": dp["keywords"]
-                + dp["src_id"]
-                + dp["tgt_id"]
-                + dp["description"],
-            }
-            for dp in all_relationships_data
-        }
-        await relationships_vdb.upsert(data_for_vdb)
+    logger.info(
+        f"Merged {merged_entities} entity and {merged_relationships} relationship updates"
+    )
 
     return knowledge_graph_inst
 
 
+async def _run_stages(*stages):
+    """Run pipeline stages together; the first failure cancels the others."""
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # let cancelled stages unwind before the caller sees the failure
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
 
 async def kg_query(
     query,
@@ -469,6 +892,7 @@ async def kg_query(
 ) -> str:
 
     use_model_func = global_config["llm_model_func"]
+    started = time.perf_counter()
     args_hash = compute_args_hash(query_param.mode, query)
     cached_response, quantized, min_val, max_val = await handle_cache(
         hashing_kv, args_hash, query, query_param.mode
@@ -476,45 +900,17 @@ async def kg_query(
     if cached_response is not None:
         return cached_response
 
-    example_number = global_config["addon_params"].get("example_number", None)
-    if example_number and example_number < len(PROMPTS["keywords_extraction_examples"]):
-        examples = "\n".join(
-            PROMPTS["keywords_extraction_examples"][: int(example_number)]
-        )
-    else:
-        examples = "\n".join(PROMPTS["keywords_extraction_examples"])
-    language = global_config["addon_params"].get(
-        "language", PROMPTS["DEFAULT_LANGUAGE"]
-    )
-
     if query_param.mode not in ["hybrid"]:
         logger.error(f"Unknown mode {query_param.mode} in kg_query")
         return PROMPTS["fail_response"]
 
-
-    kw_prompt_temp = PROMPTS["keywords_extraction"]
-    kw_prompt = kw_prompt_temp.format(query=query, examples=examples, language=language)
-    result = await use_model_func(kw_prompt, keyword_extraction=True)
-    logger.info("kw_prompt result:")
-    print(result)
-    try:
-
-        match = re.search(r"\{.*\}", result, re.DOTALL)
-        if match:
-            result = match.group(0)
-            keywords_data = json.loads(result)
-
-            hl_keywords = keywords_data.get("high_level_keywords", [])
-            ll_keywords = keywords_data.get("low_level_keywords", [])
-        else:
-            logger.error("No JSON-like structure found in the result.")
-            return PROMPTS["fail_response"]
-
-
-    except json.JSONDecodeError as e:
-        print(f"JSON parsing error: {e} {result}")
+    keywords_data = await _extract_keywords(
+        query, query_param, global_config, knowledge_graph_inst
+    )
+    if keywords_data is None:
         return PROMPTS["fail_response"]
-
+    hl_keywords = keywords_data.get("high_level_keywords", [])
+    ll_keywords = keywords_data.get("low_level_keywords", [])
 
     if hl_keywords == [] and ll_keywords == []:
         logger.warning("low_level_keywords and high_level_keywords is empty")
@@ -569,22 +965,119 @@ async def kg_query(
             .strip()
         )
 
-
-    await save_to_cache(
-        hashing_kv,
-        CacheData(
-            args_hash=args_hash,
-            content=response,
-            prompt=query,
-            quantized=quantized,
-            min_val=min_val,
-            max_val=max_val,
-            mode=query_param.mode,
-        ),
+    cache_data = CacheData(
+        args_hash=args_hash,
+        content=response,
+        prompt=query,
+        quantized=quantized,
+        min_val=min_val,
+        max_val=max_val,
+        mode=query_param.mode,
     )
+    if hasattr(response, "__aiter__"):
+        return _stream_and_cache(response, hashing_kv, cache_data, started)
+    await save_to_cache(hashing_kv, cache_data)
     return response
 
 
+async def _extract_keywords(
+    query: str,
+    query_param: QueryParam,
+    global_config: dict,
+    knowledge_graph_inst: BaseGraphStorage,
+) -> Union[dict, None]:
+    """Keyword JSON for `query` from the local index, the keyword cache or the LLM.
+
+    Returns None when the LLM answer holds no parsable JSON.
+    """
+    keyword_index = global_config.get("keyword_index")
+    if query_param.keyword_extractor == "local" and keyword_index is not None:
+        await _ensure_keyword_index(keyword_index, knowledge_graph_inst)
+        keywords_data = keyword_index.extract(query)
+        # kg_query needs both levels in hybrid mode, so a partial match goes to the LLM
+        if keywords_data["low_level_keywords"] and keywords_data["high_level_keywords"]:
+            logger.info(f"Local keywords: {keywords_data}")
+            return keywords_data
+        logger.info(
+            "Query names no indexed entity and relationship keyword, "
+            "extracting keywords with the LLM"
+        )
+
+    example_number = global_config["addon_params"].get("example_number", None)
+    if example_number and example_number < len(PROMPTS["keywords_extraction_examples"]):
+        examples = "\n".join(
+            PROMPTS["keywords_extraction_examples"][: int(example_number)]
+        )
+    else:
+        examples = "\n".join(PROMPTS["keywords_extraction_examples"])
+    language = global_config["addon_params"].get(
+        "language", PROMPTS["DEFAULT_LANGUAGE"]
+    )
+
+    keyword_cache = global_config.get("keyword_cache")
+    cache_key = compute_args_hash(
+        "keywords", normalize_query(query), language, example_number
+    )
+    if keyword_cache is not None:
+        cached = await keyword_cache.get(cache_key)
+        if cached is not None:
+            return json.loads(cached["return"])
+
+    use_model_func = global_config["llm_model_func"]
+    kw_prompt_temp = PROMPTS["keywords_extraction"]
+    kw_prompt = kw_prompt_temp.format(query=query, examples=examples, language=language)
+    result = await use_model_func(kw_prompt, keyword_extraction=True)
+    logger.debug(f"kw_prompt result: {result}")
+    try:
+
+        match = re.search(r"\{.*\}", result, re.DOTALL)
+        if match:
+            result = match.group(0)
+            keywords_data = json.loads(result)
+        else:
+            logger.error("No JSON-like structure found in the result.")
+            return None
+
+
+    except json.JSONDecodeError as e:
+        logger.error(f"JSON parsing error: {e} {result}")
+        return None
+
+    if keyword_cache is not None:
+        await keyword_cache.put(cache_key, "keywords", json.dumps(keywords_data), query)
+    return keywords_data
+
+
+async def _ensure_keyword_index(keyword_index, knowledge_graph_inst: BaseGraphStorage):
+    """Fill an empty index from graph storages that can list their nodes and edges."""
+    if len(keyword_index) or not hasattr(knowledge_graph_inst, "nodes"):
+        return
+    for node_id in list(await knowledge_graph_inst.nodes()):
+        keyword_index.add_entity(node_id)
+    edges = list(await knowledge_graph_inst.edges())
+    for edge in await knowledge_graph_inst.get_edges_batch(edges):
+        if edge is not None:
+            keyword_index.add_keywords(edge.get("keywords", ""))
+
+
+async def _stream_and_cache(response, hashing_kv, cache_data: CacheData, started: float):
+    """Forward streamed chunks as they arrive and cache the full answer at the end.
+
+    A stream the caller abandons is not cached, since its answer is incomplete.
+    """
+    chunks = []
+    async for chunk in response:
+        if not chunks:
+            logger.info(f"First token after {(time.perf_counter() - started) * 1000:.0f}ms")
+        chunks.append(chunk)
+        yield chunk
+    logger.info(
+        f"Streamed {len(chunks)} chunks in {(time.perf_counter() - started) * 1000:.0f}ms"
+    )
+    cache_data.content = "".join(chunks)
+    await save_to_cache(hashing_kv, cache_data)
+
+
 async def _build_query_context(
     query: list,
     knowledge_graph_inst: BaseGraphStorage,
@@ -597,65 +1090,95 @@ async def _build_query_context(
     hl_entities_context, hl_relations_context, hl_text_units_context = "", "", ""
 
     ll_kewwords, hl_keywrds = query[0], query[1]
-    if query_param.mode in ["local", "hybrid"]:
-        if ll_kewwords == "":
-            ll_entities_context, ll_relations_context, ll_text_units_context = (
-                "",
-                "",
-                "",
-            )
-            warnings.warn(
-                "Low Level context is None. Return empty Low entity/relationship/source"
-            )
-            query_param.mode = "global"
-        else:
-            (
-                ll_entities_context,
-                ll_relations_context,
-                ll_text_units_context,
-            ) = await _get_node_data(
-                ll_kewwords,
-                knowledge_graph_inst,
-                entities_vdb,
-                text_chunks_db,
-                query_param,
-            )
-    if query_param.mode in ["hybrid"]:
-        if hl_keywrds == "":
-            hl_entities_context, hl_relations_context, hl_text_units_context = (
-                "",
-                "",
-                "",
-            )
-            warnings.warn(
-                "High Level context is None. Return empty High entity/relationship/source"
+    timings = {}
+    start = time.perf_counter()
+    if query_param.mode in ["local", "hybrid"] and ll_kewwords == "":
+        warnings.warn(
+            "Low Level context is None. Return empty Low entity/relationship/source"
+        )
+        query_param.mode = "global"
+    run_low_level = query_param.mode in ["local", "hybrid"]
+    run_high_level = query_param.mode in ["hybrid"] and hl_keywrds != ""
+    if query_param.mode in ["hybrid"] and hl_keywrds == "":
+        warnings.warn(
+            "High Level context is None. Return empty High entity/relationship/source"
+        )
+        query_param.mode = "local"
+
+    # only the keywords of the branches that run are embedded, in one call
+    keyword_embeddings = await _timed(
+        timings,
+        "embed",
+        _embed_keywords(
+            [ll_kewwords if run_low_level else "", hl_keywrds if run_high_level else ""],
+            *([entities_vdb] if run_low_level else []),
+            *([relationships_vdb] if run_high_level else []),
+        ),
+    )
+
+    # the two branches only read the storages, so they run side by side
+    empty = ("", "", "")
+    branches = []
+    if run_low_level:
+        branches.append(
+            _timed(
+                timings,
+                "low_level",
+                _get_node_data(
+                    ll_kewwords,
+                    knowledge_graph_inst,
+                    entities_vdb,
+                    text_chunks_db,
+                    query_param,
+                    query_embedding=keyword_embeddings.get(ll_kewwords),
+                    timings=timings,
+                ),
             )
-            query_param.mode = "local"
-        else:
-            (
-                hl_entities_context,
-                hl_relations_context,
-                hl_text_units_context,
-            ) = await _get_edge_data(
-                hl_keywrds,
-                knowledge_graph_inst,
-                relationships_vdb,
-                text_chunks_db,
-                query_param,
+        )
+    if run_high_level:
+        branches.append(
+            _timed(
+                timings,
+                "high_level",
+                _get_edge_data(
+                    hl_keywrds,
+                    knowledge_graph_inst,
+                    relationships_vdb,
+                    text_chunks_db,
+                    query_param,
+                    query_embedding=keyword_embeddings.get(hl_keywrds),
+                ),
             )
-            if (
-                hl_entities_context == ""
-                and hl_relations_context == ""
-                and hl_text_units_context == ""
-            ):
-                logger.warn("No high level context found. Switching to local mode.")
-                query_param.mode = "local"
+        )
+    results = await asyncio.gather(*branches)
+    ll_entities_context, ll_relations_context, ll_text_units_context = (
+        results.pop(0) if run_low_level else empty
+    )
+    hl_entities_context, hl_relations_context, hl_text_units_context = (
+        results.pop(0) if run_high_level else empty
+    )
+    if run_high_level and (
+        hl_entities_context == ""
+        and hl_relations_context == ""
+        and hl_text_units_context == ""
+    ):
+        logger.warn("No high level context found. Switching to local mode.")
+        query_param.mode = "local"
+    timings["total"] = time.perf_counter() - start
+    logger.info(
+        "Retrieval timings: "
+        + ", ".join(f"{name} {seconds * 1000:.1f}ms" for name, seconds in timings.items())
+    )
     if query_param.mode == "hybrid":
         entities_context, relations_context, text_units_context = combine_contexts(
             [hl_entities_context, hl_relations_context],
             [ll_entities_context, ll_relations_context],
             [hl_text_units_context, ll_text_units_context],
         )
+    elif query_param.mode == "local":
+        text_units_context = ll_text_units_context
+    else:
+        text_units_context = hl_text_units_context
 
 
     return f"""
@@ -683,28 +1206,66 @@ async def _build_query_context(
 ```
 """
 
+async def _timed(timings: dict, name: str, awaitable):
+    """Await `awaitable` and record its wall time in seconds under `timings[name]`."""
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timings[name] = time.perf_counter() - start
+
+
+async def _embed_keywords(
+    keywords: list[str], *vdbs: BaseVectorStorage
+) -> dict[str, np.ndarray]:
+    """Embed the keyword strings in one call when every vdb can query by vector.
+
+    Backends that keep the default `query_batch` embed their own queries, so
+    nothing is embedded up front for them.
+    """
+    wanted = [k for k in dict.fromkeys(keywords) if k]
+    if not wanted or not vdbs or any(
+        type(vdb).query_batch is BaseVectorStorage.query_batch for vdb in vdbs
+    ):
+        return {}
+    embeddings = await embed_queries(
+        vdbs[0].global_config, vdbs[0].embedding_func, wanted
+    )
+    return dict(zip(wanted, embeddings))
+
+
+async def _query_vdb(
+    vdb: BaseVectorStorage, query: str, top_k: int, query_embedding=None
+) -> list[dict]:
+    if query_embedding is None:
+        return await vdb.query(query, top_k=top_k)
+    results = await vdb.query_batch([query], top_k=top_k, embeddings=[query_embedding])
+    return results[0]
+
+
 async def _get_node_data(
     query,
     knowledge_graph_inst: BaseGraphStorage,
     entities_vdb: BaseVectorStorage,
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     query_param: QueryParam,
+    query_embedding=None,
+    timings: dict = None,
 ):
 
-    results = await entities_vdb.query(query, top_k=query_param.top_k)
+    results = await _query_vdb(
+        entities_vdb, query, query_param.top_k, query_embedding
+    )
     if not len(results):
         return "", "", ""
 
-    node_datas = await asyncio.gather(
-        *[knowledge_graph_inst.get_node(r["entity_name"]) for r in results]
-    )
+    entity_names = [r["entity_name"] for r in results]
+    node_datas = await knowledge_graph_inst.get_nodes_batch(entity_names)
     if not all([n is not None for n in node_datas]):
         logger.warning("Some nodes are missing, maybe the storage is damaged")
 
 
-    node_degrees = await asyncio.gather(
-        *[knowledge_graph_inst.node_degree(r["entity_name"]) for r in results]
-    )
+    node_degrees = await knowledge_graph_inst.node_degrees_batch(entity_names)
     node_datas = [
         {**n, "entity_name": k["entity_name"], "rank": d}
         for k, n, d in zip(results, node_datas, node_degrees)
@@ -716,7 +1277,7 @@ async def _get_node_data(
 
 
     use_relations= await _find_most_related_edges_from_entities3(
-        node_datas, query_param, knowledge_graph_inst
+        node_datas, query_param, knowledge_graph_inst, timings=timings
     )
 
     logger.info(
@@ -770,8 +1331,8 @@ async def _find_most_related_text_unit_from_entities(
         all_one_hop_nodes.update([e[1] for e in this_edges])
 
     all_one_hop_nodes = list(all_one_hop_nodes)
-    all_one_hop_nodes_data = await asyncio.gather(
-        *[knowledge_graph_inst.get_node(e) for e in all_one_hop_nodes]
+    all_one_hop_nodes_data = await knowledge_graph_inst.get_nodes_batch(
+        all_one_hop_nodes
     )
 
 
@@ -829,21 +1390,21 @@ async def _get_edge_data(
     relationships_vdb: BaseVectorStorage,
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     query_param: QueryParam,
+    query_embedding=None,
 ):
-    results = await relationships_vdb.query(keywords, top_k=query_param.top_k)
+    results = await _query_vdb(
+        relationships_vdb, keywords, query_param.top_k, query_embedding
+    )
 
     if not len(results):
         return "", "", ""
 
-    edge_datas = await asyncio.gather(
-        *[knowledge_graph_inst.get_edge(r["src_id"], r["tgt_id"]) for r in results]
-    )
+    edge_pairs = [(r["src_id"], r["tgt_id"]) for r in results]
+    edge_datas = await knowledge_graph_inst.get_edges_batch(edge_pairs)
 
     if not all([n is not None for n in edge_datas]):
         logger.warning("Some edges are missing, maybe the storage is damaged")
-    edge_degree = await asyncio.gather(
-        *[knowledge_graph_inst.edge_degree(r["src_id"], r["tgt_id"]) for r in results]
-    )
+    edge_degree = await knowledge_graph_inst.edge_degrees_batch(edge_pairs)
     edge_datas = [
         {"src_id": k["src_id"], "tgt_id": k["tgt_id"], "rank": d, **v}
         for k, v, d in zip(results, edge_datas, edge_degree)
@@ -921,13 +1482,9 @@ async def _find_most_related_entities_from_relationships(
             entity_names.append(e["tgt_id"])
             seen.add(e["tgt_id"])
 
-    node_datas = await asyncio.gather(
-        *[knowledge_graph_inst.get_node(entity_name) for entity_name in entity_names]
-    )
+    node_datas = await knowledge_graph_inst.get_nodes_batch(entity_names)
 
-    node_degrees = await asyncio.gather(
-        *[knowledge_graph_inst.node_degree(entity_name) for entity_name in entity_names]
-    )
+    node_degrees = await knowledge_graph_inst.node_degrees_batch(entity_names)
     node_datas = [
         {**n, "entity_name": k, "rank": d}
         for k, n, d in zip(entity_names, node_datas, node_degrees)
@@ -1009,49 +1566,138 @@ def combine_contexts(entities, relationships, sources):
     return combined_entities, combined_relationships, combined_sources
 
 
-import networkx as nx
-from collections import defaultdict
-async def find_paths_and_edges_with_stats(graph, target_nodes):
+def find_paths_and_edges_with_stats(
+    graph,
+    target_nodes,
+    max_hops=3,
+    max_paths=None,
+    max_fanout=None,
+    max_expansions=None,
+    deadline=None,
+):
+    """Enumerate simple paths of up to `max_hops` edges between every pair of `target_nodes`.
+
+    `graph` maps a node to its undirected neighbours and only needs entries for
+    nodes within `min(max_hops - 1, 1)` hops of the targets: paths are grown
+    forward from each source for `max_hops - 1` hops and closed through a one-hop
+    index of the targets' neighbours, so the last hop is a lookup rather than
+    another expansion, and every intermediate node whose fan-out is checked is
+    a source's or a target's neighbour. Each unordered pair is enumerated once
+    and mirrored.
+
+    Nodes with more than `max_fanout` neighbours are never used as intermediate
+    hops. The search stops early once `max_paths` (directed) paths have been
+    produced, `max_expansions` prefixes have been grown or the
+    `time.perf_counter()` value `deadline` has passed; `path_stats["stopped_by"]`
+    names the limit that was hit, or is None when the search completed.
+    """
+    if not 1 <= max_hops <= 3:
+        raise ValueError(f"max_hops must be between 1 and 3, got {max_hops}")
 
     result = defaultdict(lambda: {"paths": [], "edges": set()})
-    path_stats = {"1-hop": 0, "2-hop": 0, "3-hop": 0}   
-    one_hop_paths = []
-    two_hop_paths = []
-    three_hop_paths = []
-
-    async def dfs(current, target, path, depth):
-
-        if depth > 3: 
-            return
-        if current == target: 
-            result[(path[0], target)]["paths"].append(list(path))
-            for u, v in zip(path[:-1], path[1:]):
-                result[(path[0], target)]["edges"].add(tuple(sorted((u, v))))
-            if depth == 1:
-                path_stats["1-hop"] += 1
-                one_hop_paths.append(list(path))
-            elif depth == 2:
-                path_stats["2-hop"] += 1
-                two_hop_paths.append(list(path))
-            elif depth == 3:
-                path_stats["3-hop"] += 1
-                three_hop_paths.append(list(path))
-            return
-        neighbors = graph.neighbors(current) 
-        for neighbor in neighbors:
-            if neighbor not in path:  
-                await dfs(neighbor, target, path + [neighbor], depth + 1)
-
-    for node1 in target_nodes:
-        for node2 in target_nodes:
-            if node1 != node2:
-                await dfs(node1, node2, [node1], 0)
+    path_stats = {"1-hop": 0, "2-hop": 0, "3-hop": 0}
+    hop_paths = {1: [], 2: [], 3: []}
+    budget = float("inf") if max_paths is None else max_paths
+    expansions_left = float("inf") if max_expansions is None else max_expansions
+    expansions = 0
+    skipped_hubs = set()
+    stopped_by = None
+
+    seeds = [n for n in dict.fromkeys(target_nodes) if n in graph]
+    seed_rank = {n: i for i, n in enumerate(seeds)}
+    closing = defaultdict(list)
+    for target in seeds:
+        for neighbor in graph[target]:
+            closing[neighbor].append(target)
+
+    def is_hub(node):
+        if max_fanout is not None and len(graph.get(node, ())) > max_fanout:
+            skipped_hubs.add(node)
+            return True
+        return False
+
+    buffer = [None] * max_hops
+    on_path = set()
+
+    def emit(length, target):
+        nonlocal budget, stopped_by
+        path = buffer[:length]
+        path.append(target)
+        reverse = path[::-1]
+        hops = len(path) - 1
+        edges = [tuple(sorted(e)) for e in zip(path[:-1], path[1:])]
+        for p in (path, reverse):
+            entry = result[(p[0], p[-1])]
+            entry["paths"].append(p)
+            entry["edges"].update(edges)
+            hop_paths[hops].append(p)
+        path_stats[f"{hops}-hop"] += 2
+        budget -= 2
+        if budget <= 0:
+            stopped_by = "max_paths"
+        return stopped_by is None
+
+    def close(length, tail, source_rank):
+        for target in closing.get(tail, ()):
+            if seed_rank[target] > source_rank and target not in on_path:
+                if not emit(length, target):
+                    return False
+        return True
+
+    def expand(length, source_rank):
+        # buffer[:length] holds the current prefix, buffer[length - 1] its tail
+        nonlocal expansions, expansions_left, stopped_by
+        if not close(length, buffer[length - 1], source_rank):
+            return False
+        if length == max_hops:
+            return True
+        for neighbor in graph.get(buffer[length - 1], ()):
+            if neighbor in on_path:
+                continue
+            if length + 1 == max_hops and neighbor not in closing:
+                continue
+            if is_hub(neighbor):
+                continue
+            expansions += 1
+            expansions_left -= 1
+            if expansions_left < 0:
+                stopped_by = "max_expansions"
+                return False
+            if deadline is not None and not expansions % 256:
+                if time.perf_counter() > deadline:
+                    stopped_by = "deadline"
+                    return False
+            buffer[length] = neighbor
+            on_path.add(neighbor)
+            keep_going = expand(length + 1, source_rank)
+            on_path.discard(neighbor)
+            if not keep_going:
+                return False
+        return True
+
+    for source in seeds:
+        buffer[0] = source
+        on_path.add(source)
+        keep_going = expand(1, seed_rank[source])
+        on_path.discard(source)
+        if not keep_going:
+            break
 
     for key in result:
         result[key]["edges"] = list(result[key]["edges"])
 
-    return dict(result), path_stats , one_hop_paths, two_hop_paths, three_hop_paths
+    path_stats["expansions"] = expansions
+    path_stats["skipped_hubs"] = len(skipped_hubs)
+    path_stats["stopped_by"] = stopped_by
+    return dict(result), path_stats, hop_paths[1], hop_paths[2], hop_paths[3]
+
+
 def bfs_weighted_paths(G, path, source, target, threshold, alpha):
+    """Score one pair's paths by resource flow, the default path scorer.
+
+    `flow_weighted_paths` is the vectorised alternative selected by
+    `QueryParam.path_scorer="flow"`; path_flow_benchmark.py compares the two.
+    """
     results = [] 
     edge_weights = defaultdict(float)  
     node = source
@@ -1104,37 +1750,141 @@ def bfs_weighted_paths(G, path, source, target, threshold, alpha):
     combined = [(p, w) for p, w in zip(path, path_weights)]
 
     return combined
+
+
+def pairwise_weighted_paths(G, result, source_nodes, threshold, alpha):
+    """`bfs_weighted_paths` over every (source, target) pair in `result`."""
+    all_results = []
+    for node1 in source_nodes:
+        for node2 in source_nodes:
+            if node1 != node2 and (node1, node2) in result:
+                all_results += bfs_weighted_paths(
+                    G, result[(node1, node2)]["paths"], node1, node2, threshold, alpha
+                )
+    return all_results
+
+
+def flow_weighted_paths(result, source_nodes, threshold, alpha):
+    """Vectorised `bfs_weighted_paths` over every (source, target) pair in `result`.
+
+    Each pair's follow graph becomes a block of one sparse transition matrix
+    over (pair, node) states, resource is pushed from all sources at once with
+    three matrix-vector products, and every path is scored in a single pass.
+    Flow is propagated level by level, so an edge reached at two depths is
+    thresholded on its shallower contribution, where the pairwise loop
+    thresholds whatever it has accumulated so far in set iteration order.
+    Returns the same `(path, weight)` list as `pairwise_weighted_paths`, in the
+    same order; scores differ only for pairs with a node at two depths, which
+    can change the ranking, so it is used only with
+    `QueryParam.path_scorer="flow"` (path_flow_benchmark.py checks the rest agree).
+    """
+    pairs = [
+        (node1, node2)
+        for node1 in source_nodes
+        for node2 in source_nodes
+        if node1 != node2 and (node1, node2) in result
+    ]
+    paths = [p for pair in pairs for p in result[pair]["paths"]]
+    if not paths:
+        return []
+
+    flat = list(chain.from_iterable(paths))
+    node_index = {n: i for i, n in enumerate(dict.fromkeys(flat))}
+    flat_nodes = np.fromiter(
+        map(node_index.__getitem__, flat), dtype=np.int64, count=len(flat)
+    )
+    lengths = np.fromiter(map(len, paths), dtype=np.int64, count=len(paths))
+    path_pair = np.repeat(
+        np.arange(len(pairs)), [len(result[pair]["paths"]) for pair in pairs]
+    )
+    _, states = np.unique(
+        np.repeat(path_pair, lengths) * len(node_index) + flat_nodes,
+        return_inverse=True,
+    )
+    n_states = int(states.max()) + 1
+
+    starts = np.cumsum(lengths) - lengths
+    ends = starts + lengths - 1
+    edge_positions = np.ones(len(states), dtype=bool)
+    edge_positions[ends] = False
+    edge_positions = np.flatnonzero(edge_positions)
+    tails, heads = states[edge_positions], states[edge_positions + 1]
+
+    edge_keys = np.unique(tails * n_states + heads)
+    rows, cols = edge_keys // n_states, edge_keys % n_states
+    out_degree = np.bincount(rows, minlength=n_states)
+    inv_degree = np.zeros(n_states)
+    inv_degree[out_degree > 0] = 1.0 / out_degree[out_degree > 0]
+    transition_t = sparse.csr_matrix(
+        (inv_degree[rows], (cols, rows)), shape=(n_states, n_states)
+    )
+
+    not_target = np.ones(n_states)
+    not_target[states[ends]] = 0.0
+    level0 = np.zeros(n_states)
+    level0[states[starts]] = 1.0
+    passed = level0 * (level0 * inv_degree > threshold)
+    level1 = (transition_t @ passed) * not_target
+    passed = level1 * (alpha * level1 * inv_degree > threshold)
+    level2 = alpha * (transition_t @ passed) * not_target
+    potential = (level0 + alpha * level1 + alpha * level2) * inv_degree
+
+    hops = lengths - 1
+    weights = np.add.reduceat(potential[tails], np.cumsum(hops) - hops) / hops
+    return list(zip(paths, weights.tolist()))
+
+
+def _search_weighted_paths(G, source_nodes, query_param: QueryParam, deadline):
+    """Path enumeration and flow scoring; pure CPU work run off the event loop."""
+    result, path_stats, one_hop_paths, two_hop_paths, three_hop_paths = find_paths_and_edges_with_stats(
+        G,
+        source_nodes,
+        max_hops=query_param.path_max_hops,
+        max_paths=query_param.path_max_paths,
+        max_fanout=query_param.path_max_fanout,
+        max_expansions=query_param.path_max_expansions,
+        deadline=deadline,
+    )
+    threshold = query_param.path_flow_threshold
+    alpha = query_param.path_flow_alpha
+    if query_param.path_scorer == "flow":
+        all_results = flow_weighted_paths(result, source_nodes, threshold, alpha)
+    else:
+        all_results = pairwise_weighted_paths(G, result, source_nodes, threshold, alpha)
+    return all_results, path_stats, one_hop_paths, two_hop_paths, three_hop_paths
+
+
 async def _find_most_related_edges_from_entities3(
     node_datas: list[dict],
     query_param: QueryParam,
     knowledge_graph_inst: BaseGraphStorage,
+    timings: dict = None,
 ):  
 
-    G = nx.Graph()
-    edges = await knowledge_graph_inst.edges()
-    nodes = await knowledge_graph_inst.nodes()
-
-    for u, v in edges:
-        G.add_edge(u, v) 
-    G.add_nodes_from(nodes)
     source_nodes = [dp["entity_name"] for dp in node_datas]
-    result, path_stats, one_hop_paths, two_hop_paths, three_hop_paths = await find_paths_and_edges_with_stats(G, source_nodes)
+    max_hops = query_param.path_max_hops
+    deadline = (
+        time.perf_counter() + query_param.path_search_timeout
+        if query_param.path_search_timeout is not None
+        else None
+    )
+    G = await knowledge_graph_inst.get_neighborhood_adjacency(
+        source_nodes, max_depth=min(max_hops - 1, 1)
+    )
+    start = time.perf_counter()
+    # G is a private adjacency snapshot, so the worker thread shares nothing mutable
+    all_results, path_stats, one_hop_paths, two_hop_paths, three_hop_paths = await asyncio.to_thread(
+        _search_weighted_paths, G, source_nodes, query_param, deadline
+    )
+    if timings is not None:
+        timings["path_search"] = time.perf_counter() - start
+    if path_stats["stopped_by"] is not None:
+        logger.warning(
+            f"Path search stopped early by {path_stats['stopped_by']} after "
+            f"{path_stats['expansions']} expansions"
+        )
 
 
-    threshold = 0.3
-    alpha = 0.8 
-    all_results = []
-    
-    for node1 in source_nodes: 
-        for node2 in source_nodes: 
-            if node1 != node2: 
-                if (node1, node2) in result:
-                    sub_G = nx.Graph()
-                    paths = result[(node1,node2)]['paths']
-                    edges = result[(node1,node2)]['edges']
-                    sub_G.add_edges_from(edges)
-                    results = bfs_weighted_paths(G, paths, node1, node2, threshold, alpha)
-                    all_results+= results
     all_results = sorted(all_results, key=lambda x: x[1], reverse=True)
     seen = set()
     result_edge = []
@@ -1170,14 +1920,25 @@ async def _find_most_related_edges_from_entities3(
     for edge, weight in sort_result:
         final_result.append(edge)
 
+    path_nodes = list(dict.fromkeys(n for path in final_result for n in path))
+    path_edges = list(
+        dict.fromkeys(e for path in final_result for e in zip(path[:-1], path[1:]))
+    )
+    node_lookup = dict(
+        zip(path_nodes, await knowledge_graph_inst.get_nodes_batch(path_nodes))
+    )
+    edge_lookup = dict(
+        zip(path_edges, await knowledge_graph_inst.get_edges_batch(path_edges))
+    )
+
     relationship = []
 
     for path in final_result:
         if len(path) == 4:
             s_name,b1_name,b2_name,t_name = path[0],path[1],path[2],path[3]
-            edge0 = await knowledge_graph_inst.get_edge(path[0], path[1]) or await knowledge_graph_inst.get_edge(path[1], path[0])
-            edge1 = await knowledge_graph_inst.get_edge(path[1],path[2]) or await knowledge_graph_inst.get_edge(path[2], path[1])
-            edge2 = await knowledge_graph_inst.get_edge(path[2],path[3]) or await knowledge_graph_inst.get_edge(path[3], path[2])
+            edge0 = edge_lookup[(path[0], path[1])]
+            edge1 = edge_lookup[(path[1], path[2])]
+            edge2 = edge_lookup[(path[2], path[3])]
             if edge0==None or edge1==None or edge2==None:
                 print(path,"边丢失")
                 if edge0==None:
@@ -1190,41 +1951,41 @@ async def _find_most_related_edges_from_entities3(
             e1 = "through edge ("+edge0["keywords"]+") to connect to "+s_name+" and "+b1_name+"."
             e2 = "through edge ("+edge1["keywords"]+") to connect to "+b1_name+" and "+b2_name+"."
             e3 = "through edge ("+edge2["keywords"]+") to connect to "+b2_name+" and "+t_name+"."
-            s = await knowledge_graph_inst.get_node(s_name)
+            s = node_lookup[s_name]
             s = "The entity "+s_name+" is a "+s["entity_type"]+" with the description("+s["description"]+")"
-            b1 = await knowledge_graph_inst.get_node(b1_name)
+            b1 = node_lookup[b1_name]
             b1 = "The entity "+b1_name+" is a "+b1["entity_type"]+" with the description("+b1["description"]+")"
-            b2 = await knowledge_graph_inst.get_node(b2_name)
+            b2 = node_lookup[b2_name]
             b2 = "The entity "+b2_name+" is a "+b2["entity_type"]+" with the description("+b2["description"]+")"
-            t = await knowledge_graph_inst.get_node(t_name)
+            t = node_lookup[t_name]
             t = "The entity "+t_name+" is a "+t["entity_type"]+" with the description("+t["description"]+")"
             relationship.append([s+e1+b1+"and"+b1+e2+b2+"and"+b2+e3+t])
         elif len(path) == 3:
             s_name,b_name,t_name = path[0],path[1],path[2]
-            edge0 = await knowledge_graph_inst.get_edge(path[0], path[1]) or await knowledge_graph_inst.get_edge(path[1], path[0])
-            edge1 = await knowledge_graph_inst.get_edge(path[1],path[2]) or await knowledge_graph_inst.get_edge(path[2], path[1])
+            edge0 = edge_lookup[(path[0], path[1])]
+            edge1 = edge_lookup[(path[1], path[2])]
             if edge0==None or edge1==None:
                 print(path,"边丢失")
                 continue
             e1 = "through edge("+edge0["keywords"]+") to connect to "+s_name+" and "+b_name+"."
             e2 = "through edge("+edge1["keywords"]+") to connect to "+b_name+" and "+t_name+"."
-            s = await knowledge_graph_inst.get_node(s_name)
+            s = node_lookup[s_name]
             s = "The entity "+s_name+" is a "+s["entity_type"]+" with the description("+s["description"]+")"
-            b = await knowledge_graph_inst.get_node(b_name)
+            b = node_lookup[b_name]
             b = "The entity "+b_name+" is a "+b["entity_type"]+" with the description("+b["description"]+")"
-            t = await knowledge_graph_inst.get_node(t_name)
+            t = node_lookup[t_name]
             t = "The entity "+t_name+" is a "+t["entity_type"]+" with the description("+t["description"]+")"
             relationship.append([s+e1+b+"and"+b+e2+t])
         elif len(path) == 2:
             s_name,t_name = path[0],path[1]
-            edge0 = await knowledge_graph_inst.get_edge(path[0], path[1]) or await knowledge_graph_inst.get_edge(path[1], path[0])
+            edge0 = edge_lookup[(path[0], path[1])]
             if edge0==None:
                 print(path,"边丢失")
                 continue
             e = "through edge("+edge0["keywords"]+") to connect to "+s_name+" and "+t_name+"."
-            s = await knowledge_graph_inst.get_node(s_name)
+            s = node_lookup[s_name]
             s = "The entity "+s_name+" is a "+s["entity_type"]+" with the description("+s["description"]+")"
-            t = await knowledge_graph_inst.get_node(t_name)
+            t = node_lookup[t_name]
             t = "The entity "+t_name+" is a "+t["entity_type"]+" with the description("+t["description"]+")"
             relationship.append([s+e+t])
 
@@ -151,6 +151,25 @@ PROMPTS[
 ] = """It appears some entities may have still been missed.  Answer YES | NO if there are still entities that need to be added.
 """
 
+PROMPTS["DEFAULT_CHUNK_DELIMITER"] = "<|CHUNK_{index}|>"
+
+PROMPTS[
+    "entity_extraction_packed"
+] = """The text below contains {chunk_count} separate documents. Each document starts with a marker line such as {first_marker}.
+Extract entities and relationships from each document on its own, and only relate entities that appear in the same document.
+Before the records of each document, output that document's marker line on its own line, for example:
+{first_marker}
+("entity"{tuple_delimiter}...){record_delimiter}
+{second_marker}
+("entity"{tuple_delimiter}...){record_delimiter}
+
+{packed_text}"""
+
+PROMPTS[
+    "entiti_continue_extraction_packed"
+] = """MANY entities were missed in the last extraction.  Add them below using the same format, writing each document's marker line before its records:
+"""
+
 PROMPTS["fail_response"] = "Sorry, I'm not able to provide an answer to that question."
 
 PROMPTS["rag_response"] = """---Role---
@@ -1,9 +1,13 @@
 import asyncio
 import html
+import json
 import os
+import sqlite3
+import struct
+import zlib
 from tqdm.asyncio import tqdm as tqdm_async
 from dataclasses import dataclass
-from typing import Any, Union, cast
+from typing import Any, Optional, Union, cast
 import networkx as nx
 import numpy as np
 from nano_vectordb import NanoVectorDB
@@ -13,6 +17,7 @@ from .utils import (
     load_json,
     write_json,
     compute_mdhash_id,
+    embed_queries,
 )
 
 from .base import (
@@ -59,10 +64,438 @@ class JsonKVStorage(BaseKVStorage):
         self._data.update(left_data)
         return left_data
 
+    async def delete(self, ids: list[str]):
+        for id in ids:
+            self._data.pop(id, None)
+
     async def drop(self):
         self._data = {}
 
 
+# record = crc32 | op | key length | value length, followed by key and value bytes
+_LOG_RECORD_HEADER = struct.Struct("<IBII")
+_LOG_OP_PUT = 1
+_LOG_OP_DELETE = 2
+
+
+@dataclass
+class LogKVStorage(BaseKVStorage):
+    """Append-only, log-structured KV store.
+
+    Writes append records to ``kv_store_<namespace>.log``; an in-memory
+    index maps each key to the offset of its latest value, which is read
+    from disk on demand.  Unlike ``JsonKVStorage`` an upsert of an existing
+    key replaces its value.  Compaction rewrites the live records once the
+    log is mostly garbage; the copy runs in a worker thread while writers keep
+    appending, and only the records appended meanwhile are moved over under
+    the write lock.  A torn or corrupt tail left by a crash is
+    truncated on load.  An existing ``kv_store_<namespace>.json`` is
+    migrated into the log the first time the namespace is opened.
+    """
+
+    compaction_min_bytes: int = 1 << 20
+    compaction_garbage_ratio: float = 0.5
+
+    def __post_init__(self):
+        working_dir = self.global_config["working_dir"]
+        self._file_name = os.path.join(working_dir, f"kv_store_{self.namespace}.log")
+        self.compaction_min_bytes = self.global_config.get(
+            "kv_log_compaction_min_bytes", self.compaction_min_bytes
+        )
+        self.compaction_garbage_ratio = self.global_config.get(
+            "kv_log_compaction_garbage_ratio", self.compaction_garbage_ratio
+        )
+        self._lock = asyncio.Lock()
+        self._compacting = False
+        self._drops = 0
+
+        if not os.path.exists(self._file_name):
+            json_file = os.path.join(working_dir, f"kv_store_{self.namespace}.json")
+            legacy = load_json(json_file) or {}
+            self._write_log(self._file_name + ".tmp", legacy.items())
+            os.replace(self._file_name + ".tmp", self._file_name)
+            if legacy:
+                logger.info(
+                    f"Migrated {len(legacy)} records of KV {self.namespace} from {json_file}"
+                )
+
+        self._index, self._live_bytes, valid_end = self._scan_log(self._file_name)
+        if valid_end < os.path.getsize(self._file_name):
+            logger.warning(
+                f"Truncating corrupt tail of {self._file_name} at byte {valid_end}"
+            )
+            with open(self._file_name, "r+b") as f:
+                f.truncate(valid_end)
+        self._writer = open(self._file_name, "ab")
+        self._reader = open(self._file_name, "rb")
+        logger.info(f"Load KV {self.namespace} with {len(self._index)} data")
+
+    @staticmethod
+    def _encode_record(op: int, key: str, value: Any = None) -> bytes:
+        key_bytes = key.encode("utf-8")
+        value_bytes = (
+            b"" if op == _LOG_OP_DELETE
+            else json.dumps(value, ensure_ascii=False).encode("utf-8")
+        )
+        body = bytes([op]) + key_bytes + value_bytes
+        header = _LOG_RECORD_HEADER.pack(
+            zlib.crc32(body), op, len(key_bytes), len(value_bytes)
+        )
+        return header + key_bytes + value_bytes
+
+    @staticmethod
+    def _write_log(file_name: str, items) -> tuple[dict[str, tuple[int, int]], int]:
+        """Write ``file_name`` from scratch with one record per item.
+
+        Callers write to a temporary file and rename it into place.
+        """
+        index: dict[str, tuple[int, int]] = {}
+        offset = 0
+        header_size = _LOG_RECORD_HEADER.size
+        with open(file_name, "wb") as f:
+            for key, value in items:
+                record = LogKVStorage._encode_record(_LOG_OP_PUT, key, value)
+                key_len = len(key.encode("utf-8"))
+                index[key] = (
+                    offset + header_size + key_len,
+                    len(record) - header_size - key_len,
+                )
+                f.write(record)
+                offset += len(record)
+            f.flush()
+            os.fsync(f.fileno())
+        return index, offset
+
+    @staticmethod
+    def _scan_log(
+        file_name: str, index: dict = None, live_bytes: int = 0, offset: int = 0
+    ) -> tuple[dict[str, tuple[int, int]], int, int]:
+        """Rebuild the key -> (value offset, value length) index.
+
+        Scanning starts at ``offset`` on top of an existing ``index`` holding
+        ``live_bytes``.  Returns the index, the number of bytes held by live
+        records and the offset just past the last intact record.
+        """
+        index = {} if index is None else index
+        header_size = _LOG_RECORD_HEADER.size
+        with open(file_name, "rb") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(header_size)
+                if len(header) < header_size:
+                    break
+                crc, op, key_len, value_len = _LOG_RECORD_HEADER.unpack(header)
+                payload = f.read(key_len + value_len)
+                if (
+                    len(payload) < key_len + value_len
+                    or op not in (_LOG_OP_PUT, _LOG_OP_DELETE)
+                    or zlib.crc32(bytes([op]) + payload) != crc
+                ):
+                    break
+                key = payload[:key_len].decode("utf-8")
+                record_size = header_size + key_len + value_len
+                previous = index.pop(key, None)
+                if previous is not None:
+                    live_bytes -= header_size + len(key.encode("utf-8")) + previous[1]
+                if op == _LOG_OP_PUT:
+                    index[key] = (offset + header_size + key_len, value_len)
+                    live_bytes += record_size
+                offset += record_size
+        return index, live_bytes, offset
+
+    def _read_value(self, key: str):
+        location = self._index.get(key)
+        if location is None:
+            return None
+        value_offset, value_len = location
+        self._reader.seek(value_offset)
+        return json.loads(self._reader.read(value_len).decode("utf-8"))
+
+    async def all_keys(self) -> list[str]:
+        return list(self._index.keys())
+
+    async def get_by_id(self, id):
+        return self._read_value(id)
+
+    async def get_by_ids(self, ids, fields=None):
+        values = [self._read_value(id) for id in ids]
+        if fields is None:
+            return values
+        return [
+            {k: v for k, v in value.items() if k in fields} if value else None
+            for value in values
+        ]
+
+    async def filter_keys(self, data: list[str]) -> set[str]:
+        return set([s for s in data if s not in self._index])
+
+    async def _append(self, records: list[tuple[int, str, Any]]):
+        async with self._lock:
+            offset = self._writer.tell()
+            header_size = _LOG_RECORD_HEADER.size
+            chunks = []
+            for op, key, value in records:
+                record = self._encode_record(op, key, value)
+                chunks.append(record)
+                previous = self._index.pop(key, None)
+                if previous is not None:
+                    self._live_bytes -= (
+                        header_size + len(key.encode("utf-8")) + previous[1]
+                    )
+                if op == _LOG_OP_PUT:
+                    key_len = len(key.encode("utf-8"))
+                    self._index[key] = (
+                        offset + header_size + key_len,
+                        len(record) - header_size - key_len,
+                    )
+                    self._live_bytes += len(record)
+                offset += len(record)
+            self._writer.write(b"".join(chunks))
+            self._writer.flush()
+
+    async def upsert(self, data: dict[str, dict]):
+        await self._append([(_LOG_OP_PUT, k, v) for k, v in data.items()])
+        return data
+
+    async def delete(self, ids: list[str]):
+        await self._append([(_LOG_OP_DELETE, k, None) for k in ids if k in self._index])
+
+    async def index_done_callback(self):
+        async with self._lock:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            log_bytes = self._writer.tell()
+            if self._compacting or not (
+                log_bytes >= self.compaction_min_bytes
+                and log_bytes - self._live_bytes
+                > log_bytes * self.compaction_garbage_ratio
+            ):
+                return
+            self._compacting = True
+            live = list(self._index.items())
+            drops = self._drops
+        compact_file = self._file_name + ".compact"
+        try:
+            # copy the live records without the lock; writers keep appending
+            # to the old log and readers keep using its handle meanwhile
+            index, live_bytes = await asyncio.to_thread(
+                self._compact_sync, live, compact_file
+            )
+            async with self._lock:
+                if drops != self._drops:
+                    return
+                self._writer.flush()
+                index, live_bytes, _ = self._append_tail(
+                    compact_file, log_bytes, index, live_bytes
+                )
+                self._swap_in(compact_file, index, live_bytes)
+            logger.info(
+                f"Compacted KV {self.namespace} log from {log_bytes} to {live_bytes} bytes"
+            )
+        finally:
+            self._compacting = False
+            if os.path.exists(compact_file):
+                os.remove(compact_file)
+
+    def _compact_sync(self, live: list[tuple[str, tuple[int, int]]], compact_file: str):
+        with open(self._file_name, "rb") as source:
+
+            def live_items():
+                for key, (value_offset, value_len) in live:
+                    source.seek(value_offset)
+                    yield key, json.loads(source.read(value_len).decode("utf-8"))
+
+            return self._write_log(compact_file, live_items())
+
+    def _append_tail(self, compact_file: str, start: int, index: dict, live_bytes: int):
+        """Move the records appended to the log since ``start`` to ``compact_file``."""
+        self._reader.seek(start)
+        tail = self._reader.read(self._writer.tell() - start)
+        with open(compact_file, "ab") as f:
+            offset = f.tell()
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+        return self._scan_log(compact_file, index, live_bytes, offset)
+
+    def _swap_in(self, file_name: str, index: dict[str, tuple[int, int]], live_bytes: int):
+        # open handles would make os.replace fail on Windows
+        self._writer.close()
+        self._reader.close()
+        os.replace(file_name, self._file_name)
+        self._index, self._live_bytes = index, live_bytes
+        self._writer = open(self._file_name, "ab")
+        self._reader = open(self._file_name, "rb")
+
+    async def drop(self):
+        async with self._lock:
+            self._drops += 1
+            tmp_file = self._file_name + ".tmp"
+            self._swap_in(tmp_file, *self._write_log(tmp_file, []))
+
+
+# stays below SQLITE_MAX_VARIABLE_NUMBER on old SQLite builds (999)
+_SQLITE_BATCH_SIZE = 500
+
+
+def _open_sqlite(file_name: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(file_name)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _batched(items: list, size: int = _SQLITE_BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+@dataclass
+class SqliteKVStorage(BaseKVStorage):
+    """KV storage in ``kv_store_<namespace>.sqlite`` (WAL mode).
+
+    Values are stored as JSON text and fetched per request, so memory does
+    not grow with the namespace.  Upserts replace existing keys.  An
+    existing ``kv_store_<namespace>.json`` is imported on first open; a
+    ``meta`` row committed with the import marks it done.
+    """
+
+    def __post_init__(self):
+        working_dir = self.global_config["working_dir"]
+        self._file_name = os.path.join(
+            working_dir, f"kv_store_{self.namespace}.sqlite"
+        )
+        self._conn = _open_sqlite(self._file_name)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv (id TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        migrated = self._conn.execute(
+            "SELECT 1 FROM meta WHERE key = 'json_migrated'"
+        ).fetchone()
+        # databases written before the marker existed already hold their records
+        if not migrated and not self._conn.execute("SELECT 1 FROM kv LIMIT 1").fetchone():
+            json_file = os.path.join(working_dir, f"kv_store_{self.namespace}.json")
+            legacy = load_json(json_file) or {}
+            if legacy:
+                self._put_many(legacy)
+                logger.info(
+                    f"Migrated {len(legacy)} records of KV {self.namespace} from {json_file}"
+                )
+        if not migrated:
+            # committed with the imported records, so a crash mid-import retries it
+            self._conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', '1')")
+        self._conn.commit()
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM kv").fetchone()
+        logger.info(f"Load KV {self.namespace} with {count} data")
+
+    def _put_many(self, data: dict[str, dict]):
+        self._conn.executemany(
+            "INSERT INTO kv (id, value) VALUES (?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET value = excluded.value",
+            (
+                (k, json.dumps(v, ensure_ascii=False))
+                for k, v in data.items()
+            ),
+        )
+
+    def _fetch(self, ids: list[str]) -> dict[str, str]:
+        found = {}
+        for batch in _batched(ids):
+            placeholders = ",".join("?" * len(batch))
+            found.update(
+                self._conn.execute(
+                    f"SELECT id, value FROM kv WHERE id IN ({placeholders})", batch
+                )
+            )
+        return found
+
+    async def all_keys(self) -> list[str]:
+        return [row[0] for row in self._conn.execute("SELECT id FROM kv")]
+
+    async def index_done_callback(self):
+        self._conn.commit()
+
+    async def get_by_id(self, id):
+        row = self._conn.execute("SELECT value FROM kv WHERE id = ?", (id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def get_by_ids(self, ids, fields=None):
+        found = self._fetch(list(dict.fromkeys(ids)))
+        values = [json.loads(found[id]) if id in found else None for id in ids]
+        if fields is None:
+            return values
+        return [
+            {k: v for k, v in value.items() if k in fields} if value else None
+            for value in values
+        ]
+
+    async def filter_keys(self, data: list[str]) -> set[str]:
+        keys = list(dict.fromkeys(data))
+        existing = set()
+        for batch in _batched(keys):
+            placeholders = ",".join("?" * len(batch))
+            existing.update(
+                row[0]
+                for row in self._conn.execute(
+                    f"SELECT id FROM kv WHERE id IN ({placeholders})", batch
+                )
+            )
+        return set(keys) - existing
+
+    async def upsert(self, data: dict[str, dict]):
+        self._put_many(data)
+        self._conn.commit()
+        return data
+
+    async def delete(self, ids: list[str]):
+        self._conn.executemany("DELETE FROM kv WHERE id = ?", ((id,) for id in ids))
+        self._conn.commit()
+
+    async def drop(self):
+        self._conn.execute("DELETE FROM kv")
+        self._conn.commit()
+
+
+async def _embed_in_batches(
+    embedding_func, contents: list[str], max_batch_size: int, global_config: dict = None
+):
+    """Embed `contents` in batches, reusing vectors from the content embedding store."""
+    store = (global_config or {}).get("content_embedding_store")
+    stored = store.get_many(contents) if store is not None else [None] * len(contents)
+    missing = [i for i, vector in enumerate(stored) if vector is None]
+    to_embed = list(dict.fromkeys(contents[i] for i in missing))
+    batches = [
+        to_embed[i : i + max_batch_size]
+        for i in range(0, len(to_embed), max_batch_size)
+    ]
+
+    async def wrapped_task(batch):
+        result = await embedding_func(batch)
+        pbar.update(1)
+        return result
+
+    embedding_tasks = [wrapped_task(batch) for batch in batches]
+    pbar = tqdm_async(
+        total=len(embedding_tasks), desc="Generating embeddings", unit="batch"
+    )
+    embeddings_list = await asyncio.gather(*embedding_tasks)
+    if not missing:
+        return np.stack(stored)
+    embedded = np.concatenate(embeddings_list)
+    if len(embedded) != len(to_embed):
+        # let the caller report the mismatch
+        return embedded
+    if store is not None:
+        store.put_many(to_embed, embedded)
+    by_content = dict(zip(to_embed, embedded))
+    for i in missing:
+        stored[i] = by_content[contents[i]]
+    return np.stack(stored)
+
+
 @dataclass
 class NanoVectorDBStorage(BaseVectorStorage):
     cosine_better_than_threshold: float = 0.2
@@ -92,23 +525,9 @@ class NanoVectorDBStorage(BaseVectorStorage):
             for k, v in data.items()
         ]
         contents = [v["content"] for v in data.values()]
-        batches = [
-            contents[i : i + self._max_batch_size]
-            for i in range(0, len(contents), self._max_batch_size)
-        ]
-
-        async def wrapped_task(batch):
-            result = await self.embedding_func(batch)
-            pbar.update(1)
-            return result
-
-        embedding_tasks = [wrapped_task(batch) for batch in batches]
-        pbar = tqdm_async(
-            total=len(embedding_tasks), desc="Generating embeddings", unit="batch"
+        embeddings = await _embed_in_batches(
+            self.embedding_func, contents, self._max_batch_size, self.global_config
         )
-        embeddings_list = await asyncio.gather(*embedding_tasks)
-
-        embeddings = np.concatenate(embeddings_list)
         if len(embeddings) == len(list_data):
             for i, d in enumerate(list_data):
                 d["__vector__"] = embeddings[i]
@@ -121,7 +540,9 @@ class NanoVectorDBStorage(BaseVectorStorage):
             )
 
     async def query(self, query: str, top_k=5):
-        embedding = await self.embedding_func([query])
+        embedding = await embed_queries(
+            self.global_config, self.embedding_func, [query]
+        )
         embedding = embedding[0]
         results = self._client.query(
             query=embedding,
@@ -133,6 +554,38 @@ class NanoVectorDBStorage(BaseVectorStorage):
         ]
         return results
 
+    async def query_batch(self, queries: list[str], top_k=5, embeddings=None):
+        if embeddings is None:
+            embeddings = await embed_queries(
+                self.global_config, self.embedding_func, queries
+            )
+        storage = self.client_storage
+        if not storage["data"] or top_k <= 0:
+            return [[] for _ in queries]
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings / np.where(norms == 0, 1.0, norms)
+        # one (n, d) x (d, m) product scores every query against the matrix
+        scores = storage["matrix"] @ embeddings.T
+        k = min(top_k, len(storage["data"]))
+        results = []
+        for column in scores.T:
+            top = np.argpartition(-column, k - 1)[:k]
+            top = top[np.argsort(-column[top], kind="stable")]
+            results.append(
+                [
+                    {
+                        **storage["data"][i],
+                        "__metrics__": float(column[i]),
+                        "id": storage["data"][i]["__id__"],
+                        "distance": float(column[i]),
+                    }
+                    for i in top
+                    if column[i] >= self.cosine_better_than_threshold
+                ]
+            )
+        return results
+
     @property
     def client_storage(self):
         return getattr(self._client, "_NanoVectorDB__storage")
@@ -174,6 +627,644 @@ class NanoVectorDBStorage(BaseVectorStorage):
         self._client.save()
 
 
+_MMAP_VECTOR_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+# rows scored per matmul; bounds the float32 copy made of float16/int8 blocks
+_MMAP_QUERY_BLOCK_ROWS = 1 << 12
+_MMAP_MIN_CAPACITY = 1024
+
+
+@dataclass
+class MmapVectorDBStorage(BaseVectorStorage):
+    """Vector storage backed by a memory-mapped matrix file.
+
+    Unit-normalised vectors live in ``vdb_<namespace>.vectors`` as a raw
+    row-major matrix of ``dtype`` (``float32``, ``float16`` or ``int8``;
+    int8 rows keep a float32 scale in ``vdb_<namespace>.scales``).  Ids and
+    meta fields live in ``vdb_<namespace>.sqlite``.  The matrix file grows
+    by doubling and rows are written in place, so inserts never rewrite
+    existing data, and processes serving the same working directory share
+    its pages through the OS page cache.  ``dtype`` is read from
+    ``vector_db_storage_cls_kwargs`` when the namespace is created.
+    """
+
+    cosine_better_than_threshold: float = 0.2
+
+    def __post_init__(self):
+        working_dir = self.global_config["working_dir"]
+        self._max_batch_size = self.global_config["embedding_batch_num"]
+        self.cosine_better_than_threshold = self.global_config.get(
+            "cosine_better_than_threshold", self.cosine_better_than_threshold
+        )
+        storage_kwargs = self.global_config.get("vector_db_storage_cls_kwargs", {})
+        self._vector_file = os.path.join(working_dir, f"vdb_{self.namespace}.vectors")
+        self._scale_file = os.path.join(working_dir, f"vdb_{self.namespace}.scales")
+
+        self._meta = _open_sqlite(
+            os.path.join(working_dir, f"vdb_{self.namespace}.sqlite")
+        )
+        self._meta.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS vectors (
+                row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, data TEXT NOT NULL
+            );
+            """
+        )
+        settings = dict(self._meta.execute("SELECT key, value FROM settings"))
+        is_new = not settings
+        if is_new:
+            settings = {
+                "dim": str(self.embedding_func.embedding_dim),
+                "dtype": storage_kwargs.get("dtype", "float32"),
+            }
+            if settings["dtype"] not in _MMAP_VECTOR_DTYPES:
+                raise ValueError(
+                    f"Unsupported vector dtype {settings['dtype']}, "
+                    f"expected one of {list(_MMAP_VECTOR_DTYPES)}"
+                )
+            self._meta.executemany(
+                "INSERT INTO settings (key, value) VALUES (?, ?)", settings.items()
+            )
+            self._meta.commit()
+        elif storage_kwargs.get("dtype", settings["dtype"]) != settings["dtype"]:
+            logger.warning(
+                f"vdb_{self.namespace} was created as {settings['dtype']}, "
+                f"ignoring dtype={storage_kwargs['dtype']}"
+            )
+        self._dim = int(settings["dim"])
+        if self._dim != self.embedding_func.embedding_dim:
+            raise ValueError(
+                f"vdb_{self.namespace} holds {self._dim}-d vectors but the embedding "
+                f"function produces {self.embedding_func.embedding_dim}-d vectors"
+            )
+        self._dtype = np.dtype(_MMAP_VECTOR_DTYPES[settings["dtype"]])
+        self._quantized = self._dtype == np.int8
+
+        open(self._vector_file, "ab").close()
+        if self._quantized:
+            open(self._scale_file, "ab").close()
+        self._matrix = None
+        self._scales = None
+        self._capacity = 0
+        self._data_version = None
+        self._refresh()
+
+        legacy_file = os.path.join(working_dir, f"vdb_{self.namespace}.json")
+        if is_new and os.path.exists(legacy_file):
+            self._migrate_nano_vectordb(legacy_file)
+        logger.info(f"Load vdb {self.namespace} with {int(self._live.sum())} data")
+
+    def _migrate_nano_vectordb(self, legacy_file: str):
+        legacy = NanoVectorDB(self._dim, storage_file=legacy_file)
+        storage = getattr(legacy, "_NanoVectorDB__storage")
+        if not storage["data"]:
+            return
+        self._write_rows(
+            [dp["__id__"] for dp in storage["data"]],
+            [{k: v for k, v in dp.items() if k != "__id__"} for dp in storage["data"]],
+            np.asarray(storage["matrix"], dtype=np.float32),
+        )
+        logger.info(
+            f"Migrated {len(storage['data'])} vectors of {self.namespace} from {legacy_file}"
+        )
+
+    def _refresh(self):
+        """Pick up rows committed by other processes since the last call."""
+        (data_version,) = self._meta.execute("PRAGMA data_version").fetchone()
+        if data_version == self._data_version:
+            return
+        self._data_version = data_version
+        rows = np.fromiter(
+            (row for (row,) in self._meta.execute("SELECT row FROM vectors")),
+            dtype=np.int64,
+        )
+        self._rows = int(rows.max()) + 1 if len(rows) else 0
+        self._live = np.zeros(self._rows, dtype=bool)
+        self._live[rows] = True
+        self._map(os.path.getsize(self._vector_file) // self._row_bytes)
+
+    @property
+    def _row_bytes(self) -> int:
+        return self._dim * self._dtype.itemsize
+
+    def _map(self, capacity: int):
+        self._capacity = capacity
+        if capacity == 0:
+            self._matrix = self._scales = None
+            return
+        self._matrix = np.memmap(
+            self._vector_file, dtype=self._dtype, mode="r+", shape=(capacity, self._dim)
+        )
+        if self._quantized:
+            self._scales = np.memmap(
+                self._scale_file, dtype=np.float32, mode="r+", shape=(capacity,)
+            )
+
+    def _ensure_capacity(self, rows: int):
+        if rows <= self._capacity:
+            return
+        # another process may have grown the file; never truncate it back
+        on_disk = os.path.getsize(self._vector_file) // self._row_bytes
+        if on_disk > self._capacity:
+            self._map(on_disk)
+            if rows <= self._capacity:
+                return
+        capacity = max(rows, 2 * self._capacity, _MMAP_MIN_CAPACITY)
+        with open(self._vector_file, "r+b") as f:
+            f.truncate(capacity * self._row_bytes)
+        if self._quantized:
+            with open(self._scale_file, "r+b") as f:
+                f.truncate(capacity * np.dtype(np.float32).itemsize)
+        self._map(capacity)
+
+    def _encode(self, vectors: np.ndarray) -> tuple[np.ndarray, Union[np.ndarray, None]]:
+        if not self._quantized:
+            return vectors.astype(self._dtype), None
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+
+    def _write_rows(self, ids: list[str], metas: list[dict], vectors: np.ndarray):
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1.0, norms)
+
+        # the write lock is held from picking rows until they are committed, so
+        # processes upserting into the same namespace never pick the same rows
+        self._meta.execute("BEGIN IMMEDIATE")
+        try:
+            self._refresh()
+            existing = {}
+            for batch in _batched(ids):
+                placeholders = ",".join("?" * len(batch))
+                existing.update(
+                    self._meta.execute(
+                        f"SELECT id, row FROM vectors WHERE id IN ({placeholders})", batch
+                    )
+                )
+            report = {"update": [id for id in ids if id in existing], "insert": []}
+            rows = np.empty(len(ids), dtype=np.int64)
+            next_row = self._rows
+            for i, id in enumerate(ids):
+                if id in existing:
+                    rows[i] = existing[id]
+                else:
+                    rows[i] = next_row
+                    report["insert"].append(id)
+                    next_row += 1
+
+            self._ensure_capacity(next_row)
+            encoded, scales = self._encode(vectors)
+            self._matrix[rows] = encoded
+            self._matrix.flush()
+            if scales is not None:
+                self._scales[rows] = scales
+                self._scales.flush()
+            # vectors are on disk before the rows that point at them are committed
+            self._meta.executemany(
+                "INSERT INTO vectors (row, id, data) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+                (
+                    (int(row), id, json.dumps(meta, ensure_ascii=False))
+                    for row, id, meta in zip(rows, ids, metas)
+                ),
+            )
+            self._meta.commit()
+        except BaseException:
+            self._meta.rollback()
+            raise
+
+        if next_row > self._rows:
+            self._live = np.concatenate(
+                [self._live, np.zeros(next_row - self._rows, dtype=bool)]
+            )
+            self._rows = next_row
+        self._live[rows] = True
+        self._on_rows_written(rows, vectors)
+        return report
+
+    def _on_rows_written(self, rows: np.ndarray, vectors: np.ndarray):
+        """Hook for index structures kept alongside the matrix."""
+
+    async def upsert(self, data: dict[str, dict]):
+        logger.info(f"Inserting {len(data)} vectors to {self.namespace}")
+        if not len(data):
+            logger.warning("You insert an empty data to vector DB")
+            return []
+        ids = list(data.keys())
+        metas = [
+            {k1: v1 for k1, v1 in v.items() if k1 in self.meta_fields}
+            for v in data.values()
+        ]
+        contents = [v["content"] for v in data.values()]
+        embeddings = await _embed_in_batches(
+            self.embedding_func, contents, self._max_batch_size, self.global_config
+        )
+        if len(embeddings) != len(ids):
+            # sometimes the embedding is not returned correctly. just log it.
+            logger.error(
+                f"embedding is not 1-1 with data, {len(embeddings)} != {len(ids)}"
+            )
+            return
+        self._refresh()
+        return self._write_rows(ids, metas, np.asarray(embeddings, dtype=np.float32))
+
+    def _score_rows(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        block = self._matrix[rows]
+        if block.dtype != np.float32:
+            block = block.astype(np.float32)
+        scores = block @ query
+        if self._quantized:
+            scores *= self._scales[rows]
+        return scores
+
+    def _candidate_scores(
+        self, queries: np.ndarray
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """Return, per query row, the live rows considered and their scores."""
+        scores = np.empty((self._rows, len(queries)), dtype=np.float32)
+        for start in range(0, self._rows, _MMAP_QUERY_BLOCK_ROWS):
+            stop = min(start + _MMAP_QUERY_BLOCK_ROWS, self._rows)
+            block = self._matrix[start:stop]
+            if block.dtype != np.float32:
+                block = block.astype(np.float32)
+            scores[start:stop] = block @ queries.T
+            if self._quantized:
+                scores[start:stop] *= self._scales[start:stop, None]
+        rows = np.flatnonzero(self._live)
+        scores = scores[rows]
+        return [(rows, scores[:, j]) for j in range(len(queries))]
+
+    def _search(self, embeddings: np.ndarray, top_k: int) -> list[list[dict]]:
+        self._refresh()
+        if self._rows == 0 or top_k <= 0:
+            return [[] for _ in embeddings]
+        queries = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms == 0, 1.0, norms)
+
+        hits_per_query = []
+        for rows, scores in self._candidate_scores(queries):
+            if not len(rows):
+                hits_per_query.append([])
+                continue
+            k = min(top_k, len(rows))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            top = top[scores[top] >= self.cosine_better_than_threshold]
+            hits_per_query.append(list(zip(rows[top].tolist(), scores[top].tolist())))
+
+        wanted = list({row for hits in hits_per_query for row, _ in hits})
+        found = {}
+        for batch in _batched(wanted):
+            placeholders = ",".join("?" * len(batch))
+            found.update(
+                (row, (id, data))
+                for row, id, data in self._meta.execute(
+                    f"SELECT row, id, data FROM vectors WHERE row IN ({placeholders})",
+                    batch,
+                )
+            )
+        return [
+            [
+                {**json.loads(found[row][1]), "id": found[row][0], "distance": score}
+                for row, score in hits
+                if row in found
+            ]
+            for hits in hits_per_query
+        ]
+
+    async def query(self, query: str, top_k=5):
+        embedding = await embed_queries(
+            self.global_config, self.embedding_func, [query]
+        )
+        return self._search(embedding, top_k)[0]
+
+    async def query_batch(self, queries: list[str], top_k=5, embeddings=None):
+        if embeddings is None:
+            embeddings = await embed_queries(
+                self.global_config, self.embedding_func, queries
+            )
+        return self._search(embeddings, top_k)
+
+    def _delete_where(self, condition: str, params: tuple) -> int:
+        rows = [
+            row
+            for (row,) in self._meta.execute(
+                f"SELECT row FROM vectors WHERE {condition}", params
+            )
+        ]
+        if rows:
+            self._meta.execute(f"DELETE FROM vectors WHERE {condition}", params)
+            self._meta.commit()
+            self._live[rows] = False
+        return len(rows)
+
+    async def delete_entity(self, entity_name: str):
+        try:
+            entity_id = compute_mdhash_id(entity_name, prefix="ent-")
+            if self._delete_where("id = ?", (entity_id,)):
+                logger.info(f"Entity {entity_name} have been deleted.")
+            else:
+                logger.info(f"No entity found with name {entity_name}.")
+        except Exception as e:
+            logger.error(f"Error while deleting entity {entity_name}: {e}")
+
+    async def delete_relation(self, entity_name: str):
+        try:
+            deleted = self._delete_where(
+                "json_extract(data, '$.src_id') = ? OR json_extract(data, '$.tgt_id') = ?",
+                (entity_name, entity_name),
+            )
+            if deleted:
+                logger.info(
+                    f"All relations related to entity {entity_name} have been deleted."
+                )
+            else:
+                logger.info(f"No relations found for entity {entity_name}.")
+        except Exception as e:
+            logger.error(
+                f"Error while deleting relations for entity {entity_name}: {e}"
+            )
+
+    async def index_done_callback(self):
+        if self._matrix is not None:
+            self._matrix.flush()
+        if self._scales is not None:
+            self._scales.flush()
+        self._meta.commit()
+
+
+_IVF_KMEANS_ITERATIONS = 10
+# training sample per list; k-means quality flattens out well below this
+_IVF_SAMPLES_PER_LIST = 64
+
+
+@dataclass
+class IVFVectorDBStorage(MmapVectorDBStorage):
+    """Inverted-file (IVF) approximate search over the memory-mapped vectors.
+
+    Spherical k-means splits the vectors into ``nlist`` lists (default
+    ``sqrt(n)``).  A query ranks the centroids and scores only the rows of
+    the ``nprobe`` closest lists, trading recall for speed.  New and updated
+    rows are assigned to their nearest centroid as ``upsert`` runs; the
+    centroids are retrained in a worker thread once the namespace grows
+    ``retrain_growth`` times past the size they were trained on.  Below
+    ``min_train_rows`` vectors queries use the exact scan.  Centroids and
+    assignments are saved to ``vdb_<namespace>.ivf.npz``.  All knobs are
+    read from ``vector_db_storage_cls_kwargs``.
+    """
+
+    nlist: Optional[int] = None
+    nprobe: int = 8
+    min_train_rows: int = 10000
+    retrain_growth: float = 4.0
+
+    def __post_init__(self):
+        storage_kwargs = self.global_config.get("vector_db_storage_cls_kwargs", {})
+        for knob in ("nlist", "nprobe", "min_train_rows", "retrain_growth"):
+            setattr(self, knob, storage_kwargs.get(knob, getattr(self, knob)))
+        self._ivf_file = os.path.join(
+            self.global_config["working_dir"], f"vdb_{self.namespace}.ivf.npz"
+        )
+        self._ivf_mtime = None
+        self._ivf_changed = False
+        self._set_index(None, np.empty(0, dtype=np.int32), 0)
+        super().__post_init__()
+        if self._needs_training():
+            self._set_index(*self._train())
+
+    def _set_index(self, centroids, assignments: np.ndarray, trained_rows: int):
+        self._centroids = centroids
+        self._assignments = assignments
+        self._trained_rows = trained_rows
+        self._ivf_changed = centroids is not None
+        self._build_lists()
+
+    def _build_lists(self):
+        """Group assigned rows by list (CSR layout) and clear the dirty set."""
+        nlist = 0 if self._centroids is None else len(self._centroids)
+        order = np.argsort(self._assignments, kind="stable")
+        self._list_order = order
+        self._list_offsets = np.searchsorted(
+            self._assignments[order], np.arange(nlist + 1)
+        )
+        # rows (re)assigned since the lists were built
+        self._dirty_rows = set()
+
+    def _refresh(self):
+        super()._refresh()
+        try:
+            mtime = os.stat(self._ivf_file).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._ivf_mtime:
+            return
+        with np.load(self._ivf_file) as saved:
+            centroids = saved["centroids"]
+            assignments = saved["assignments"][: self._rows]
+            trained_rows = int(saved["trained_rows"])
+        self._set_index(centroids, assignments, trained_rows)
+        self._ivf_changed = False
+        self._ivf_mtime = mtime
+
+    def _dense_rows(self, rows: np.ndarray) -> np.ndarray:
+        vectors = self._matrix[rows].astype(np.float32)
+        if self._quantized:
+            vectors *= self._scales[rows][:, None]
+        return vectors
+
+    def _nearest_lists(self, vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        nearest = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), _MMAP_QUERY_BLOCK_ROWS):
+            block = vectors[start : start + _MMAP_QUERY_BLOCK_ROWS]
+            nearest[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        return nearest
+
+    def _needs_training(self) -> bool:
+        live = int(self._live.sum())
+        if live < self.min_train_rows:
+            return False
+        return (
+            self._centroids is None
+            or live > self.retrain_growth * self._trained_rows
+        )
+
+    def _train(self) -> tuple[np.ndarray, np.ndarray, int]:
+        rows_total = self._rows
+        live_rows = np.flatnonzero(self._live[:rows_total])
+        nlist = min(self.nlist or max(1, int(np.sqrt(len(live_rows)))), len(live_rows))
+        rng = np.random.default_rng(0)
+        sample_size = min(len(live_rows), _IVF_SAMPLES_PER_LIST * nlist)
+        sample = np.sort(rng.choice(live_rows, sample_size, replace=False))
+        data = self._dense_rows(sample)
+        centroids = data[rng.choice(len(data), nlist, replace=False)]
+
+        for _ in range(_IVF_KMEANS_ITERATIONS):
+            labels = self._nearest_lists(data, centroids)
+            order = np.argsort(labels, kind="stable")
+            counts = np.bincount(labels, minlength=nlist)
+            filled = np.flatnonzero(counts)
+            starts = np.concatenate([[0], np.cumsum(counts[filled])[:-1]])
+            sums = np.add.reduceat(data[order], starts, axis=0)
+            # empty lists keep their previous centroid
+            centroids[filled] = sums
+            norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+            centroids /= np.where(norms == 0, 1.0, norms)
+
+        assignments = np.empty(rows_total, dtype=np.int32)
+        for start in range(0, rows_total, _MMAP_QUERY_BLOCK_ROWS):
+            block = np.arange(start, min(start + _MMAP_QUERY_BLOCK_ROWS, rows_total))
+            assignments[block] = self._nearest_lists(self._dense_rows(block), centroids)
+        logger.info(
+            f"Trained IVF index of {self.namespace} with {nlist} lists on "
+            f"{sample_size} of {len(live_rows)} vectors"
+        )
+        return centroids, assignments, len(live_rows)
+
+    def _on_rows_written(self, rows: np.ndarray, vectors: np.ndarray):
+        if self._centroids is None:
+            return
+        assigned = len(self._assignments)
+        assignments = np.concatenate(
+            [self._assignments, np.full(self._rows - assigned, -1, dtype=np.int32)]
+        )
+        assignments[rows] = self._nearest_lists(vectors, self._centroids)
+        # rows written by others (or during a retrain) that are still unassigned
+        missing = np.flatnonzero(assignments < 0)
+        if len(missing):
+            assignments[missing] = self._nearest_lists(
+                self._dense_rows(missing), self._centroids
+            )
+        self._assignments = assignments
+        self._dirty_rows.update(rows.tolist())
+        self._dirty_rows.update(range(assigned, self._rows))
+        self._ivf_changed = True
+        if len(self._dirty_rows) > max(1024, len(assignments) // 20):
+            self._build_lists()
+
+    async def upsert(self, data: dict[str, dict]):
+        report = await super().upsert(data)
+        if self._needs_training():
+            # rows inserted while training runs are assigned on the next write
+            self._set_index(*await asyncio.to_thread(self._train))
+        return report
+
+    def _candidate_scores(
+        self, queries: np.ndarray
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        if self._centroids is None:
+            return super()._candidate_scores(queries)
+        return [self._probe(query) for query in queries]
+
+    def _probe(self, query: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        nprobe = max(1, min(self.nprobe, len(self._centroids)))
+        probed = np.argpartition(-(self._centroids @ query), nprobe - 1)[:nprobe]
+        parts = [
+            self._list_order[self._list_offsets[l] : self._list_offsets[l + 1]]
+            for l in probed
+        ]
+        if self._dirty_rows:
+            parts.append(np.fromiter(self._dirty_rows, dtype=np.int64))
+        # rows committed by other processes that this one has not assigned yet
+        parts.append(np.arange(len(self._assignments), self._rows))
+        rows = np.unique(np.concatenate(parts).astype(np.int64))
+
+        probe_mask = np.zeros(len(self._centroids), dtype=bool)
+        probe_mask[probed] = True
+        keep = self._live[rows]
+        assigned = rows < len(self._assignments)
+        keep[assigned] &= probe_mask[self._assignments[rows[assigned]]]
+        rows = rows[keep]
+        return rows, self._score_rows(query, rows)
+
+    async def index_done_callback(self):
+        await super().index_done_callback()
+        if not self._ivf_changed:
+            return
+        tmp_file = self._ivf_file + ".tmp"
+        with open(tmp_file, "wb") as f:
+            np.savez(
+                f,
+                centroids=self._centroids,
+                assignments=self._assignments,
+                trained_rows=self._trained_rows,
+            )
+        os.replace(tmp_file, self._ivf_file)
+        self._ivf_mtime = os.stat(self._ivf_file).st_mtime_ns
+        self._ivf_changed = False
+
+
+GRAPH_SNAPSHOT_MAGIC = b"PRGSNAP1"
+_SNAPSHOT_ALIGNMENT = 64
+
+
+def _snapshot_column_kind(values: list) -> str:
+    present = [v for v in values if v is not None]
+    if all(isinstance(v, (bool, np.bool_)) for v in present):
+        return "bool"
+    if all(
+        isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_))
+        for v in present
+    ):
+        return "int"
+    if all(
+        isinstance(v, (int, float, np.integer, np.floating))
+        and not isinstance(v, (bool, np.bool_))
+        for v in present
+    ):
+        return "float"
+    if all(isinstance(v, str) for v in present):
+        return "str"
+    return "json"
+
+
+def _encode_snapshot_strings(values: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """Concatenate `values` into one UTF-8 blob plus character offsets into its decoded form."""
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum([len(v) for v in values], out=offsets[1:])
+    blob = np.frombuffer("".join(values).encode("utf-8"), dtype=np.uint8)
+    return offsets, blob
+
+
+def _decode_snapshot_strings(offsets: np.ndarray, blob: np.ndarray) -> list[str]:
+    text = blob.tobytes().decode("utf-8")
+    offsets = offsets.tolist()
+    return [text[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+def _encode_snapshot_column(values: list) -> tuple[str, dict[str, np.ndarray]]:
+    kind = _snapshot_column_kind(values)
+    arrays = {"mask": np.array([v is not None for v in values], dtype=np.uint8)}
+    if kind == "bool":
+        arrays["values"] = np.array([bool(v) for v in values], dtype=np.uint8)
+    elif kind == "int":
+        arrays["values"] = np.array([v or 0 for v in values], dtype=np.int64)
+    elif kind == "float":
+        arrays["values"] = np.array(
+            [v if v is not None else 0.0 for v in values], dtype=np.float64
+        )
+    else:
+        if kind == "json":
+            values = [json.dumps(v) if v is not None else None for v in values]
+        arrays["offsets"], arrays["data"] = _encode_snapshot_strings(
+            [v if v is not None else "" for v in values]
+        )
+    return kind, arrays
+
+
+def _decode_snapshot_column(kind: str, arrays: dict[str, np.ndarray]) -> list:
+    if kind == "bool":
+        values = arrays["values"].astype(bool).tolist()
+    elif kind in ("int", "float"):
+        values = arrays["values"].tolist()
+    else:
+        values = _decode_snapshot_strings(arrays["offsets"], arrays["data"])
+        if kind == "json":
+            values = [json.loads(v) if v else None for v in values]
+    return values
+
+
 @dataclass
 class NetworkXStorage(BaseGraphStorage):
     @staticmethod
@@ -193,6 +1284,124 @@ class NetworkXStorage(BaseGraphStorage):
         )
         nx.write_graphml(graph, file_name)
 
+    @staticmethod
+    def write_graph_snapshot(graph: nx.Graph, file_name):
+        """Write `graph` as a binary snapshot: interned node ids, CSR edges and columnar attributes.
+
+        Arrays are 64-byte aligned so `load_graph_snapshot` can view them straight
+        out of the file buffer; the JSON header describing them sits at the end.
+        The file is written next to `file_name` and renamed into place.
+        """
+        logger.info(
+            f"Writing graph snapshot with {graph.number_of_nodes()} nodes, {graph.number_of_edges()} edges"
+        )
+        node_ids = list(graph.nodes())
+        node_index = {node_id: i for i, node_id in enumerate(node_ids)}
+        edges = list(graph.edges(data=True))
+
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(
+                [node_index[u] for u, _, _ in edges], minlength=len(node_ids)
+            ),
+            out=indptr[1:],
+        )
+        arrays = {"indptr": indptr}
+        arrays["indices"] = np.array([node_index[v] for _, v, _ in edges], dtype=np.int64)
+        arrays["node_ids.offsets"], arrays["node_ids.data"] = _encode_snapshot_strings(
+            node_ids
+        )
+
+        header = {
+            "directed": graph.is_directed(),
+            "graph": graph.graph,
+            "num_nodes": len(node_ids),
+            "num_edges": len(edges),
+            "node_attrs": {},
+            "edge_attrs": {},
+            "arrays": {},
+        }
+        for scope, records in (
+            ("node_attrs", [data for _, data in graph.nodes(data=True)]),
+            ("edge_attrs", [data for _, _, data in edges]),
+        ):
+            for name in dict.fromkeys(k for data in records for k in data):
+                kind, column = _encode_snapshot_column([data.get(name) for data in records])
+                header[scope][name] = kind
+                for part, array in column.items():
+                    arrays[f"{scope}.{name}.{part}"] = array
+
+        tmp_file_name = f"{file_name}.tmp"
+        with open(tmp_file_name, "wb") as f:
+            f.write(GRAPH_SNAPSHOT_MAGIC)
+            f.write(struct.pack("<Q", 0))
+            for name, array in arrays.items():
+                f.write(b"\0" * (-f.tell() % _SNAPSHOT_ALIGNMENT))
+                header["arrays"][name] = {
+                    "offset": f.tell(),
+                    "dtype": array.dtype.str,
+                    "count": int(array.size),
+                }
+                f.write(np.ascontiguousarray(array).tobytes())
+            header_offset = f.tell()
+            f.write(json.dumps(header, ensure_ascii=False).encode("utf-8"))
+            f.seek(len(GRAPH_SNAPSHOT_MAGIC))
+            f.write(struct.pack("<Q", header_offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file_name, file_name)
+
+    @staticmethod
+    def load_graph_snapshot(file_name) -> Union[nx.Graph, None]:
+        if not os.path.exists(file_name):
+            return None
+        # the graph is rebuilt in memory anyway, so one sequential read is enough
+        with open(file_name, "rb") as f:
+            buffer = f.read()
+        if buffer[: len(GRAPH_SNAPSHOT_MAGIC)] != GRAPH_SNAPSHOT_MAGIC:
+            raise ValueError(f"{file_name} is not a graph snapshot")
+        (header_offset,) = struct.unpack_from("<Q", buffer, len(GRAPH_SNAPSHOT_MAGIC))
+        header = json.loads(buffer[header_offset:].decode("utf-8"))
+
+        def array(name):
+            spec = header["arrays"][name]
+            return np.frombuffer(
+                buffer, dtype=spec["dtype"], count=spec["count"], offset=spec["offset"]
+            )
+
+        def columns(scope, size):
+            records = [{} for _ in range(size)]
+            for name, kind in header[scope].items():
+                parts = {
+                    key.rsplit(".", 1)[1]: array(key)
+                    for key in header["arrays"]
+                    if key.startswith(f"{scope}.{name}.")
+                    and key.count(".") == name.count(".") + 2
+                }
+                values = _decode_snapshot_column(kind, parts)
+                for i in np.flatnonzero(parts["mask"]).tolist():
+                    records[i][name] = values[i]
+            return records
+
+        node_ids = _decode_snapshot_strings(
+            array("node_ids.offsets"), array("node_ids.data")
+        )
+        sources = np.repeat(
+            np.arange(len(node_ids)), np.diff(array("indptr"))
+        ).tolist()
+        targets = array("indices").tolist()
+
+        graph = nx.DiGraph() if header["directed"] else nx.Graph()
+        graph.graph.update(header["graph"])
+        graph.add_nodes_from(zip(node_ids, columns("node_attrs", len(node_ids))))
+        graph.add_edges_from(
+            (node_ids[u], node_ids[v], data)
+            for u, v, data in zip(
+                sources, targets, columns("edge_attrs", header["num_edges"])
+            )
+        )
+        return graph
+
     @staticmethod
     def stable_largest_connected_component(graph: nx.Graph) -> nx.Graph:
         """Refer to https://github.com/microsoft/graphrag/index/graph/utils/stable_lcc.py
@@ -245,18 +1454,51 @@ class NetworkXStorage(BaseGraphStorage):
         self._graphml_xml_file = os.path.join(
             self.global_config["working_dir"], f"graph_{self.namespace}.graphml"
         )
-        preloaded_graph = NetworkXStorage.load_nx_graph(self._graphml_xml_file)
+        self._snapshot_file = os.path.join(
+            self.global_config["working_dir"], f"graph_{self.namespace}.snapshot"
+        )
+        loaded_from = self._snapshot_file
+        preloaded_graph = NetworkXStorage.load_graph_snapshot(self._snapshot_file)
+        if preloaded_graph is None:
+            # working dirs created before snapshots existed only have GraphML
+            loaded_from = self._graphml_xml_file
+            preloaded_graph = NetworkXStorage.load_nx_graph(self._graphml_xml_file)
         if preloaded_graph is not None:
             logger.info(
-                f"Loaded graph from {self._graphml_xml_file} with {preloaded_graph.number_of_nodes()} nodes, {preloaded_graph.number_of_edges()} edges"
+                f"Loaded graph from {loaded_from} with {preloaded_graph.number_of_nodes()} nodes, {preloaded_graph.number_of_edges()} edges"
             )
         self._graph = preloaded_graph or nx.DiGraph()
+        # only mutations through this storage mark the snapshot stale
+        self._dirty = False
+        self._adjacency = self._build_adjacency(self._graph)
         self._node_embed_algorithms = {
             "node2vec": self._node2vec_embed,
         }
 
+    @staticmethod
+    def _build_adjacency(graph: nx.Graph) -> dict[str, set[str]]:
+        """Undirected dict-of-sets view of `graph`, kept in sync by the mutators."""
+        adjacency = {node: set() for node in graph.nodes()}
+        for u, v in graph.edges():
+            adjacency[u].add(v)
+            adjacency[v].add(u)
+        return adjacency
+
     async def index_done_callback(self):
-        NetworkXStorage.write_nx_graph(self._graph, self._graphml_xml_file)
+        # an unchanged graph (e.g. an insert of already known docs) is not rewritten
+        if self._dirty or not os.path.exists(self._snapshot_file):
+            NetworkXStorage.write_graph_snapshot(self._graph, self._snapshot_file)
+        if self.global_config.get("graph_export_graphml", False) and (
+            self._dirty or not os.path.exists(self._graphml_xml_file)
+        ):
+            NetworkXStorage.write_nx_graph(self._graph, self._graphml_xml_file)
+        self._dirty = False
+
+    async def export_graphml(self, file_name: str = None) -> str:
+        """Write the graph as GraphML, by default to the path older versions persisted to."""
+        file_name = file_name or self._graphml_xml_file
+        NetworkXStorage.write_nx_graph(self._graph, file_name)
+        return file_name
 
     async def has_node(self, node_id: str) -> bool:
         return self._graph.has_node(node_id)
@@ -278,6 +1520,34 @@ class NetworkXStorage(BaseGraphStorage):
     ) -> Union[dict, None]:
         return self._graph.edges.get((source_node_id, target_node_id))
 
+    async def get_nodes_batch(self, node_ids: list[str]) -> list[Union[dict, None]]:
+        nodes = self._graph.nodes
+        return [nodes.get(node_id) for node_id in node_ids]
+
+    async def get_edges_batch(
+        self, pairs: list[tuple[str, str]]
+    ) -> list[Union[dict, None]]:
+        edges = self._graph.edges
+        results = []
+        for src_id, tgt_id in pairs:
+            edge = edges.get((src_id, tgt_id))
+            if edge is None:
+                edge = edges.get((tgt_id, src_id))
+            results.append(edge)
+        return results
+
+    async def node_degrees_batch(self, node_ids: list[str]) -> list[int]:
+        graph = self._graph
+        return [graph.degree(n) if n in graph else 0 for n in node_ids]
+
+    async def edge_degrees_batch(self, pairs: list[tuple[str, str]]) -> list[int]:
+        graph = self._graph
+        return [
+            (graph.degree(s) if s in graph else 0)
+            + (graph.degree(t) if t in graph else 0)
+            for s, t in pairs
+        ]
+
     async def get_node_edges(self, source_node_id: str):
         if self._graph.has_node(source_node_id):
             return list(self._graph.edges(source_node_id))
@@ -290,6 +1560,26 @@ class NetworkXStorage(BaseGraphStorage):
         if self._graph.has_node(source_node_id):
             return list(self._graph.out_edges(source_node_id))
         return None
+
+    async def get_node_neighbors(self, node_id: str) -> list[str]:
+        return list(self._adjacency.get(node_id, ()))
+
+    async def get_neighborhood_adjacency(
+        self, node_ids: list[str], max_depth: int
+    ) -> dict[str, set[str]]:
+        adjacency = {}
+        frontier = [n for n in dict.fromkeys(node_ids) if n in self._adjacency]
+        for depth in range(max_depth + 1):
+            next_frontier = []
+            for node_id in frontier:
+                if node_id in adjacency:
+                    continue
+                neighbors = set(self._adjacency[node_id])
+                adjacency[node_id] = neighbors
+                if depth < max_depth:
+                    next_frontier.extend(n for n in neighbors if n not in adjacency)
+            frontier = next_frontier
+        return adjacency
     
     async def get_pagerank(self,source_node_id:str):
         pagerank_list=nx.pagerank(self._graph)
@@ -300,11 +1590,16 @@ class NetworkXStorage(BaseGraphStorage):
 
     async def upsert_node(self, node_id: str, node_data: dict[str, str]):
         self._graph.add_node(node_id, **node_data)
+        self._dirty = True
+        self._adjacency.setdefault(node_id, set())
 
     async def upsert_edge(
         self, source_node_id: str, target_node_id: str, edge_data: dict[str, str]
     ):
         self._graph.add_edge(source_node_id, target_node_id, **edge_data)
+        self._dirty = True
+        self._adjacency.setdefault(source_node_id, set()).add(target_node_id)
+        self._adjacency.setdefault(target_node_id, set()).add(source_node_id)
 
     async def delete_node(self, node_id: str):
         """
@@ -314,6 +1609,10 @@ class NetworkXStorage(BaseGraphStorage):
         """
         if self._graph.has_node(node_id):
             self._graph.remove_node(node_id)
+            self._dirty = True
+            for neighbor in self._adjacency.pop(node_id, ()):
+                if neighbor in self._adjacency:
+                    self._adjacency[neighbor].discard(node_id)
             logger.info(f"Node {node_id} deleted from the graph.")
         else:
             logger.warning(f"Node {node_id} not found in the graph for deletion.")
@@ -2,10 +2,19 @@ import asyncio
 import html
 import io
 import csv
+import heapq
+import itertools
 import json
 import logging
 import os
 import re
+import sqlite3
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+from contextvars import ContextVar
 from dataclasses import dataclass
 from functools import wraps
 from hashlib import md5
@@ -15,7 +24,7 @@ import xml.etree.ElementTree as ET
 import numpy as np
 import tiktoken
 
-from PathRAG.prompt import PROMPTS
+from PathRAG.prompt import GRAPH_FIELD_SEP, PROMPTS
 
 
 class UnlimitedSemaphore:
@@ -54,6 +63,8 @@ class EmbeddingFunc:
     max_token_size: int
     func: callable
     concurrent_limit: int = 16
+    # identifies the vectors in persistent embedding caches; None disables them
+    model_name: Optional[str] = None
 
     def __post_init__(self):
         if self.concurrent_limit != 0:
@@ -103,21 +114,239 @@ def compute_mdhash_id(content, prefix: str = ""):
     return prefix + md5(content.encode()).hexdigest()
 
 
-def limit_async_func_call(max_size: int, waitting_time: float = 0.0001):
+# calls from interactive queries are admitted before bulk ingestion calls
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+_PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BULK: "bulk"}
+CALL_PRIORITY: ContextVar[int] = ContextVar("CALL_PRIORITY", default=PRIORITY_INTERACTIVE)
+
+
+class PriorityScheduler:
+    """Concurrency limit for LLM and embedding calls with priority classes.
+
+    At most ``max_concurrency`` calls run at once.  Waiting calls are
+    admitted lowest priority value first and in arrival order within a
+    class; a released slot is handed straight to the next waiter.  A waiter
+    that is cancelled leaves the queue, and a caller that is cancelled
+    right after being handed a slot gives it back.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        # heap of (priority, arrival, future); cancelled futures are skipped on release
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._arrivals = itertools.count()
+        self._waits: dict[int, list[float]] = {}
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE):
+        start = time.monotonic()
+        if self.active < self.max_concurrency and not self.queue_depth:
+            self.active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._arrivals), future))
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.cancelled():
+                    self.queue_depth -= 1
+                else:
+                    self.release()
+                raise
+        waited = time.monotonic() - start
+        calls, total, longest = self._waits.get(priority, (0, 0.0, 0.0))
+        self._waits[priority] = [calls + 1, total + waited, max(longest, waited)]
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self.queue_depth -= 1
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "active": self.active,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "waits": {
+                _PRIORITY_NAMES.get(priority, str(priority)): {
+                    "calls": calls,
+                    "mean_wait": total / calls,
+                    "max_wait": longest,
+                }
+                for priority, (calls, total, longest) in sorted(self._waits.items())
+            },
+        }
+
+
+def limit_async_func_call(max_size: int):
+    """Run at most `max_size` calls of the wrapped function at once.
+
+    Calls are queued by the `CALL_PRIORITY` of their context; the scheduler
+    is exposed as ``.scheduler`` on the wrapper for its metrics.
+    """
+
+    def final_decro(func):
+        scheduler = PriorityScheduler(max_size)
+
+        @wraps(func)
+        async def wait_func(*args, **kwargs):
+            await scheduler.acquire(CALL_PRIORITY.get())
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                scheduler.release()
+
+        wait_func.scheduler = scheduler
+        return wait_func
+
+    return final_decro
+
+
+class AsyncRateLimiter:
+    """Token buckets for requests and tokens per minute.
+
+    Each bucket holds up to one minute of quota and refills continuously.
+    `acquire` waits with ``asyncio.sleep`` until both buckets can cover the
+    call, serving waiters in arrival order; `charge` books tokens that are
+    only known afterwards (e.g. the completion) and may leave the token
+    bucket in debt, which delays the next callers.  ``None`` disables a
+    bucket.  The buckets are shared by every event loop calling the model;
+    each loop queues its waiters behind its own lock.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = requests_per_minute or 0.0
+        self._tokens = tokens_per_minute or 0.0
+        self._updated = time.monotonic()
+        # asyncio locks belong to one loop, so each loop gets its own on first use
+        self._locks = weakref.WeakKeyDictionary()
+        self._buckets_lock = threading.Lock()
+        self.waited_seconds = 0.0
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute:
+            self._requests = min(
+                self.requests_per_minute,
+                self._requests + elapsed * self.requests_per_minute / 60,
+            )
+        if self.tokens_per_minute:
+            self._tokens = min(
+                self.tokens_per_minute,
+                self._tokens + elapsed * self.tokens_per_minute / 60,
+            )
+
+    def _loop_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        lock = self._locks.get(loop)
+        if lock is None:
+            lock = self._locks[loop] = asyncio.Lock()
+        return lock
+
+    def _take(self, tokens: int) -> float:
+        """Book one call of `tokens` and return 0, or the seconds to wait first."""
+        with self._buckets_lock:
+            self._refill()
+            wait = 0.0
+            if self.requests_per_minute and self._requests < 1:
+                wait = (1 - self._requests) * 60 / self.requests_per_minute
+            if self.tokens_per_minute and self._tokens < tokens:
+                wait = max(wait, (tokens - self._tokens) * 60 / self.tokens_per_minute)
+            if wait > 0:
+                return wait
+            if self.requests_per_minute:
+                self._requests -= 1
+            if self.tokens_per_minute:
+                self._tokens -= tokens
+            return 0.0
+
+    async def acquire(self, tokens: int = 0):
+        async with self._loop_lock():
+            if self.tokens_per_minute:
+                # a call larger than the whole bucket would never fit
+                tokens = min(tokens, self.tokens_per_minute)
+            while (wait := self._take(tokens)) > 0:
+                self.waited_seconds += wait
+                await asyncio.sleep(wait)
+
+    def charge(self, tokens: int):
+        if self.tokens_per_minute:
+            with self._buckets_lock:
+                self._refill()
+                self._tokens -= tokens
+
+
+_RATE_LIMITERS: dict[str, AsyncRateLimiter] = {}
+
+
+def get_rate_limiter(
+    key: str,
+    requests_per_minute: Optional[float] = None,
+    tokens_per_minute: Optional[float] = None,
+) -> Optional[AsyncRateLimiter]:
+    """Process-wide limiter for `key` (a provider/model name), or None when unlimited.
+
+    Every caller using the same key shares one quota, whichever event loop it
+    runs on; the first caller's limits win.
+    """
+    if requests_per_minute is None and tokens_per_minute is None:
+        return None
+    if key not in _RATE_LIMITERS:
+        _RATE_LIMITERS[key] = AsyncRateLimiter(requests_per_minute, tokens_per_minute)
+    return _RATE_LIMITERS[key]
 
 
+def limit_rate(limiter: Optional[AsyncRateLimiter], count_tokens=None, kind: str = "llm"):
+    """Wrap an LLM (`kind="llm"`) or embedding (`kind="embedding"`) function with `limiter`.
+
+    `count_tokens(text)` sizes the request: the prompt, system prompt and
+    history for an LLM, every input text for an embedding call.  The
+    tokens of a returned completion are charged after the call.
+    """
+
     def final_decro(func):
+        if limiter is None:
+            return func
 
-        __current_size = 0
+        def size(texts):
+            if count_tokens is None:
+                return 0
+            return sum(count_tokens(t) for t in texts if t)
 
         @wraps(func)
         async def wait_func(*args, **kwargs):
-            nonlocal __current_size
-            while __current_size >= max_size:
-                await asyncio.sleep(waitting_time)
-            __current_size += 1
+            if kind == "embedding":
+                texts = args[0] if args else kwargs.get("texts", [])
+            else:
+                prompt = args[0] if args else kwargs.get("prompt", "")
+                texts = [prompt, kwargs.get("system_prompt")] + [
+                    m.get("content") for m in kwargs.get("history_messages") or []
+                ]
+            await limiter.acquire(size(texts))
             result = await func(*args, **kwargs)
-            __current_size -= 1
+            if kind == "llm" and isinstance(result, str):
+                limiter.charge(size([result]))
             return result
 
         return wait_func
@@ -125,6 +354,311 @@ def limit_async_func_call(max_size: int, waitting_time: float = 0.0001):
     return final_decro
 
 
+class EmbeddingCache:
+    """Size-bounded LRU of embedding vectors keyed by model name and text hash.
+
+    A PathRAG instance hands the same cache to every vector storage and to
+    the LLM response cache (deep copies return the instance itself), so a
+    string embedded once is reused by all of them.  Concurrent requests for
+    the same text share one embedding call.  With ``file_name`` set, new
+    vectors are also written to a SQLite file and the most recent
+    ``max_entries`` are loaded back on start.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10000,
+        model_name: str = "default",
+        file_name: Optional[str] = None,
+    ):
+        self.max_entries = max_entries
+        self.model_name = model_name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._pending: dict[str, asyncio.Future] = {}
+        self._db = None
+        if file_name is not None:
+            self._db = sqlite3.connect(file_name)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT UNIQUE NOT NULL, vector BLOB NOT NULL)"
+            )
+            rows = self._db.execute(
+                "SELECT key, vector FROM embeddings ORDER BY seq DESC LIMIT ?",
+                (max_entries,),
+            ).fetchall()
+            for key, vector in reversed(rows):
+                self._entries[key] = np.frombuffer(vector, dtype=np.float32)
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def _key(self, text: str) -> str:
+        return md5(f"{self.model_name}\x00{text}".encode()).hexdigest()
+
+    def _put(self, items: list[tuple[str, np.ndarray]]):
+        for key, vector in items:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            evicted.append(self._entries.popitem(last=False)[0])
+        self.evictions += len(evicted)
+        if self._db is not None:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                ((key, vector.tobytes()) for key, vector in items),
+            )
+            self._db.executemany(
+                "DELETE FROM embeddings WHERE key = ?", ((key,) for key in evicted)
+            )
+            self._db.commit()
+
+    async def embed(self, embedding_func, texts: list[str]) -> np.ndarray:
+        """Embed `texts` with `embedding_func`, calling it only for uncached texts."""
+        keys = [self._key(text) for text in texts]
+        found: dict[str, np.ndarray] = {}
+        waiting: dict[str, asyncio.Future] = {}
+        missing: dict[str, str] = {}
+        for text, key in zip(texts, keys):
+            if key in found or key in waiting or key in missing:
+                continue
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                found[key] = vector
+                self.hits += 1
+            elif key in self._pending:
+                waiting[key] = self._pending[key]
+                self.hits += 1
+            else:
+                missing[key] = text
+                self.misses += 1
+
+        if missing:
+            future = asyncio.get_running_loop().create_future()
+            for key in missing:
+                self._pending[key] = future
+            try:
+                vectors = await embedding_func(list(missing.values()))
+                computed = {
+                    key: np.asarray(vector, dtype=np.float32)
+                    for key, vector in zip(missing, vectors)
+                }
+                self._put(list(computed.items()))
+                future.set_result(computed)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                future.set_exception(e)
+                # waiters see the error; mark it retrieved for the event loop
+                future.exception()
+                raise
+            finally:
+                for key in missing:
+                    self._pending.pop(key, None)
+            found.update(computed)
+        for key, future in waiting.items():
+            found[key] = (await asyncio.shield(future))[key]
+        return np.stack([found[key] for key in keys])
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class ContentEmbeddingStore:
+    """Persistent embeddings keyed by md5(model name, content).
+
+    Vector storages look contents up here before calling the embedding
+    model, so unchanged entity/relationship descriptions and re-ingested
+    chunks are not embedded again.  ``skipped`` and ``computed`` count the
+    vectors served from the store and the ones that had to be embedded.
+    Like `EmbeddingCache`, deep copies return the instance itself.
+    """
+
+    def __init__(self, file_name: str, model_name: str = "default"):
+        self.model_name = model_name
+        self.skipped = 0
+        self.computed = 0
+        self._db = sqlite3.connect(file_name)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def _key(self, content: str) -> str:
+        return md5(f"{self.model_name}\x00{content}".encode()).hexdigest()
+
+    def get_many(self, contents: list[str]) -> list[Optional[np.ndarray]]:
+        keys = [self._key(content) for content in contents]
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        # stays below SQLITE_MAX_VARIABLE_NUMBER on old SQLite builds
+        for i in range(0, len(unique_keys), 500):
+            batch = unique_keys[i : i + 500]
+            placeholders = ",".join("?" * len(batch))
+            found.update(
+                self._db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    batch,
+                )
+            )
+        vectors = [
+            np.frombuffer(found[key], dtype=np.float32) if key in found else None
+            for key in keys
+        ]
+        self.skipped += sum(v is not None for v in vectors)
+        return vectors
+
+    def put_many(self, contents: list[str], vectors: np.ndarray):
+        self._db.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+            (
+                (self._key(content), np.asarray(vector, dtype=np.float32).tobytes())
+                for content, vector in zip(contents, vectors)
+            ),
+        )
+        self._db.commit()
+        self.computed += len(contents)
+
+    def stats(self) -> dict:
+        return {"skipped": self.skipped, "computed": self.computed}
+
+
+async def embed_queries(global_config: dict, embedding_func, texts: list[str]) -> np.ndarray:
+    """Embed query strings through the instance's shared `EmbeddingCache`, if any."""
+    cache = global_config.get("query_embedding_cache")
+    if cache is None:
+        return await embedding_func(texts)
+    return await cache.embed(embedding_func, texts)
+
+
+_KEYWORD_TOKEN = re.compile(r"\w+")
+_KEYWORD_STOPWORDS = frozenset(
+    """a about after all also an and any are as at be been before between both but by
+    can could did do does doing during each for from had has have how i if in into is
+    it its me more most my no not of on or other our over same should so some such
+    than that the their them then there these they this those through to too under
+    until up very was we were what when where which while who whom whose why will
+    with would you your""".split()
+)
+
+
+def normalize_query(query: str) -> str:
+    """Lowercased word tokens of `query` joined by single spaces."""
+    return " ".join(_KEYWORD_TOKEN.findall(query.lower()))
+
+
+class KeywordIndex:
+    """Inverted index of entity names and relationship keywords.
+
+    `extract` answers the keyword-extraction prompt locally: n-grams of the
+    query (longest first, non-overlapping) that name an entity become
+    low-level keywords and ones that match a relationship keyword become
+    high-level keywords.  Unmatched words are never guessed as keywords, so
+    callers fall back to the LLM when either side comes back empty.  The
+    index is saved to
+    ``file_name`` as JSON.  Like `EmbeddingCache`, deep copies return the
+    instance itself.
+    """
+
+    def __init__(self, file_name: Optional[str] = None, max_ngram: int = 6):
+        self.file_name = file_name
+        self.max_ngram = max_ngram
+        # normalized phrase -> entity name as stored in the graph
+        self._entities: dict[str, str] = {}
+        self._keywords: set[str] = set()
+        self._dirty = False
+        data = load_json(file_name) if file_name is not None else None
+        if data:
+            self._entities = data["entities"]
+            self._keywords = set(data["keywords"])
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __len__(self):
+        return len(self._entities) + len(self._keywords)
+
+    def add_entity(self, entity_name: str):
+        phrase = normalize_query(entity_name)
+        if phrase and self._entities.get(phrase) != entity_name:
+            self._entities[phrase] = entity_name
+            self._dirty = True
+
+    def remove_entity(self, entity_name: str):
+        if self._entities.pop(normalize_query(entity_name), None) is not None:
+            self._dirty = True
+
+    def add_keywords(self, keywords: str):
+        for keyword in split_string_by_multi_markers(keywords, [GRAPH_FIELD_SEP, ","]):
+            phrase = normalize_query(keyword)
+            if phrase and phrase not in self._keywords:
+                self._keywords.add(phrase)
+                self._dirty = True
+
+    def save(self):
+        if self._dirty and self.file_name is not None:
+            write_json(
+                {"entities": self._entities, "keywords": sorted(self._keywords)},
+                self.file_name,
+            )
+            self._dirty = False
+
+    def extract(self, query: str) -> dict[str, list[str]]:
+        """Keywords of `query` in the shape of the keyword-extraction prompt's JSON."""
+        tokens = list(_KEYWORD_TOKEN.finditer(query))
+        words = [t.group().lower() for t in tokens]
+        covered = [False] * len(words)
+        matches = []
+        for n in range(min(self.max_ngram, len(words)), 0, -1):
+            for i in range(len(words) - n + 1):
+                if any(covered[i : i + n]) or all(
+                    w in _KEYWORD_STOPWORDS for w in words[i : i + n]
+                ):
+                    continue
+                phrase = " ".join(words[i : i + n])
+                if phrase in self._entities:
+                    level = "low_level_keywords"
+                elif phrase in self._keywords:
+                    level = "high_level_keywords"
+                else:
+                    continue
+                covered[i : i + n] = [True] * n
+                span = query[tokens[i].start() : tokens[i + n - 1].end()]
+                matches.append((i, level, span))
+        result = {"high_level_keywords": [], "low_level_keywords": []}
+        for _, level, span in sorted(matches):
+            result[level].append(span)
+        return {level: list(dict.fromkeys(spans)) for level, spans in result.items()}
+
+
+def wrap_llm_func_with_attrs(**kwargs):
+    """Set attributes such as the `model_name` a completion helper always calls."""
+
+    def final_decro(func):
+        for name, value in kwargs.items():
+            setattr(func, name, value)
+        return func
+
+    return final_decro
+
+
 def wrap_embedding_func_with_attrs(**kwargs):
 
 
@@ -143,8 +677,11 @@ def load_json(file_name):
 
 
 def write_json(json_obj, file_name):
-    with open(file_name, "w", encoding="utf-8") as f:
+    # written aside and renamed so a crash mid-write never truncates the file
+    tmp_file_name = f"{file_name}.tmp"
+    with open(tmp_file_name, "w", encoding="utf-8") as f:
         json.dump(json_obj, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_file_name, file_name)
 
 
 def encode_string_by_tiktoken(content: str, model_name: str = "gpt-4o-mini"):
@@ -317,6 +854,296 @@ def process_combine_contexts(hl, ll):
     return combined_sources_result
 
 
+def _lsh_bands(threshold: float, num_perm: int) -> tuple[int, int]:
+    """Bands and rows per band whose LSH curve best matches `threshold`.
+
+    Minimizes the sum of the false positive and false negative areas under
+    the candidate probability ``1 - (1 - s**rows) ** bands``.
+    """
+    s = np.linspace(0.0, 1.0, 201)
+    best, best_error = (1, num_perm), float("inf")
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        candidate = 1 - (1 - s**rows) ** bands
+        error = np.where(s < threshold, candidate, 1 - candidate).mean()
+        if error < best_error:
+            best, best_error = (bands, rows), error
+    return best
+
+
+class MinHashIndex:
+    """MinHash signatures of chunk texts with an LSH band index.
+
+    A signature is the minimum of ``num_perm`` hash permutations over the
+    word shingles of a normalized text, and the share of equal positions
+    in two signatures estimates the Jaccard similarity of their texts.
+    `query` looks a signature up in the LSH buckets and returns the stored
+    keys whose estimated similarity reaches ``threshold``.  Signatures are
+    appended to ``file_name`` as fixed-size binary records on `save`.  Like
+    `KeywordIndex`, deep copies return the instance itself.
+    """
+
+    _MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+    def __init__(
+        self,
+        file_name: Optional[str] = None,
+        threshold: float = 0.9,
+        num_perm: int = 128,
+        shingle_size: int = 3,
+    ):
+        self.file_name = file_name
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands, self.rows = _lsh_bands(threshold, num_perm)
+        # fixed seed, so signatures stay comparable across processes
+        rng = np.random.RandomState(1)
+        self._a = rng.randint(1, (1 << 61) - 1, num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, (1 << 61) - 1, num_perm, dtype=np.uint64)
+        self._record = np.dtype([("key", "S64"), ("signature", "<u4", (num_perm,))])
+        self._keys: list[str] = []
+        self._key_set: set[str] = set()
+        self._signatures = np.empty((0, num_perm), dtype=np.uint32)
+        self._buckets: list[dict[bytes, list[int]]] = [{} for _ in range(self.bands)]
+        self._saved = 0
+        if file_name is not None and os.path.exists(file_name):
+            count = os.path.getsize(file_name) // self._record.itemsize
+            records = np.fromfile(file_name, dtype=self._record, count=count)
+            for key, signature in zip(records["key"], records["signature"]):
+                self.add(key.decode(), signature)
+            # rows the file repeats are not rewritten by save()
+            self._saved = len(self._keys)
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __len__(self):
+        return len(self._keys)
+
+    def signature(self, text: str) -> np.ndarray:
+        words = re.findall(r"\w+", text.lower())
+        size = self.shingle_size
+        shingles = [
+            " ".join(words[i : i + size]) for i in range(max(len(words) - size + 1, 1))
+        ]
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode()) for shingle in set(shingles)),
+            dtype=np.uint64,
+        )
+        # (a * x + b) mod p over every shingle and permutation, overflow included
+        permuted = (np.outer(hashes, self._a) + self._b) % self._MERSENNE_PRIME
+        return (permuted & np.uint64(0xFFFFFFFF)).min(axis=0).astype(np.uint32)
+
+    def _bands_of(self, signature: np.ndarray):
+        rows = self.rows
+        for band in range(self.bands):
+            yield band, signature[band * rows : (band + 1) * rows].tobytes()
+
+    def add(self, key: str, signature: np.ndarray):
+        """Index `key`; a key already indexed, e.g. by a failed insert, is kept as is."""
+        if key in self._key_set:
+            return
+        row = len(self._keys)
+        if row == len(self._signatures):
+            grown = np.empty((max(64, 2 * row), self.num_perm), dtype=np.uint32)
+            grown[:row] = self._signatures[:row]
+            self._signatures = grown
+        self._signatures[row] = signature
+        self._keys.append(key)
+        self._key_set.add(key)
+        for band, bucket in self._bands_of(signature):
+            self._buckets[band].setdefault(bucket, []).append(row)
+
+    def query(self, signature: np.ndarray) -> list[tuple[str, float]]:
+        """Stored keys similar to `signature`, most similar first."""
+        candidates = set()
+        for band, bucket in self._bands_of(signature):
+            candidates.update(self._buckets[band].get(bucket, ()))
+        if not candidates:
+            return []
+        rows = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        similarity = (self._signatures[rows] == signature).mean(axis=1)
+        order = np.argsort(-similarity, kind="stable")
+        return [
+            (self._keys[rows[i]], float(similarity[i]))
+            for i in order
+            if similarity[i] >= self.threshold
+        ]
+
+    def save(self):
+        if self.file_name is None or self._saved == len(self._keys):
+            return
+        records = np.empty(len(self._keys) - self._saved, dtype=self._record)
+        records["key"] = [key.encode() for key in self._keys[self._saved :]]
+        records["signature"] = self._signatures[self._saved : len(self._keys)]
+        with open(self.file_name, "ab") as f:
+            records.tofile(f)
+        self._saved = len(self._keys)
+
+
+class SemanticCacheIndex:
+    """Quantized prompt embeddings of one LLM-cache mode in a contiguous matrix.
+
+    Each entry is a fixed-size binary record (args hash, min, max, uint8
+    vector) appended to ``file_name`` and loaded back with one
+    ``np.fromfile``.  A lookup scores every entry with a single
+    matrix-vector product instead of decoding entries one by one.
+    Removals append a tombstone record (NaN min); the file is rewritten
+    when tombstoned rows outnumber live ones.
+    """
+
+    def __init__(self, file_name: str, dim: int):
+        self.file_name = file_name
+        self.dim = dim
+        self._record = np.dtype(
+            [("hash", "S32"), ("min", "<f4"), ("max", "<f4"), ("q", "u1", (dim,))]
+        )
+        self._hashes: list[Optional[str]] = []
+        self._rows: dict[str, int] = {}
+        # the uint8 codes are held as float32 so a lookup is one BLAS call;
+        # buffers grow by doubling and only the first len(self._hashes) rows are used
+        self._codes = np.empty((0, dim), dtype=np.float32)
+        self._min = np.empty(0, dtype=np.float32)
+        self._scale = np.empty(0, dtype=np.float32)
+        self._norm = np.empty(0, dtype=np.float32)
+        self._live = np.empty(0, dtype=bool)
+        if os.path.exists(file_name):
+            count = os.path.getsize(file_name) // self._record.itemsize
+            self._append(np.fromfile(file_name, dtype=self._record, count=count))
+            if len(self._hashes) > max(2 * len(self._rows), 1024):
+                self._compact()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, args_hash: str):
+        return args_hash in self._rows
+
+    def hashes(self) -> list[str]:
+        return list(self._rows)
+
+    def _reserve(self, rows: int):
+        capacity = len(self._min)
+        if rows <= capacity:
+            return
+        capacity = max(rows, 2 * capacity, 64)
+        grown = [np.empty((capacity, self.dim), dtype=np.float32)] + [
+            np.empty(capacity, dtype=a.dtype)
+            for a in (self._min, self._scale, self._norm, self._live)
+        ]
+        used = len(self._hashes)
+        for new, old in zip(grown, (self._codes, self._min, self._scale, self._norm, self._live)):
+            new[:used] = old[:used]
+        self._codes, self._min, self._scale, self._norm, self._live = grown
+
+    def _kill(self, args_hash: str):
+        row = self._rows.pop(args_hash, None)
+        if row is not None:
+            self._hashes[row] = None
+            self._live[row] = False
+
+    def _append(self, records: np.ndarray):
+        kept = records[~np.isnan(records["min"])]
+        start = len(self._hashes)
+        end = start + len(kept)
+        self._reserve(end)
+        codes = kept["q"].reshape(-1, self.dim).astype(np.float32)
+        mins = kept["min"].astype(np.float32)
+        scales = ((kept["max"] - kept["min"]) / 255).astype(np.float32)
+        self._codes[start:end] = codes
+        self._min[start:end] = mins
+        self._scale[start:end] = scales
+        self._norm[start:end] = np.linalg.norm(
+            codes * scales[:, None] + mins[:, None], axis=1
+        )
+        self._live[start:end] = True
+        for raw_hash, min_val in zip(records["hash"], records["min"]):
+            args_hash = raw_hash.decode()
+            # a later record for the same prompt replaces or removes the earlier one
+            self._kill(args_hash)
+            if not np.isnan(min_val):
+                self._rows[args_hash] = len(self._hashes)
+                self._hashes.append(args_hash)
+
+    def _compact(self):
+        rows = np.fromiter(self._rows.values(), dtype=np.int64, count=len(self._rows))
+        records = np.zeros(len(rows), dtype=self._record)
+        records["hash"] = [h.encode() for h in self._rows]
+        records["min"] = self._min[rows]
+        records["max"] = self._min[rows] + 255 * self._scale[rows]
+        records["q"] = self._codes[rows].astype(np.uint8)
+        tmp_file = self.file_name + ".tmp"
+        records.tofile(tmp_file)
+        os.replace(tmp_file, self.file_name)
+        self._hashes, self._rows = [], {}
+        self._codes = self._codes[:0]
+        self._min, self._scale = self._min[:0], self._scale[:0]
+        self._norm, self._live = self._norm[:0], self._live[:0]
+        self._append(records)
+
+    def _write(self, records: np.ndarray):
+        with open(self.file_name, "ab") as f:
+            f.write(records.tobytes())
+        self._append(records)
+
+    def add_many(self, entries: list[tuple[str, np.ndarray, float, float]]):
+        """Append `(args_hash, quantized, min, max)` entries to the file and the matrix."""
+        if not entries:
+            return
+        records = np.zeros(len(entries), dtype=self._record)
+        for i, (args_hash, quantized, min_val, max_val) in enumerate(entries):
+            records[i]["hash"] = args_hash.encode()
+            records[i]["min"] = min_val
+            records[i]["max"] = max_val
+            records[i]["q"] = np.asarray(quantized, dtype=np.uint8).reshape(self.dim)
+        self._write(records)
+
+    def add(self, args_hash: str, quantized: np.ndarray, min_val: float, max_val: float):
+        self.add_many([(args_hash, quantized, min_val, max_val)])
+
+    def remove(self, args_hashes: list[str]):
+        args_hashes = [h for h in args_hashes if h in self._rows]
+        if not args_hashes:
+            return
+        records = np.zeros(len(args_hashes), dtype=self._record)
+        records["hash"] = [h.encode() for h in args_hashes]
+        records["min"] = np.nan
+        self._write(records)
+
+    def candidates(
+        self, embedding: np.ndarray, threshold: float
+    ) -> list[tuple[str, float]]:
+        """Return `(args_hash, cosine)` of live entries above `threshold`, best first."""
+        if not self._rows:
+            return []
+        used = len(self._hashes)
+        query = np.asarray(embedding, dtype=np.float32).reshape(self.dim)
+        # dequantized row = q * scale + min, so row . x = scale * (q . x) + min * sum(x)
+        dots = self._scale[:used] * (self._codes[:used] @ query)
+        dots += self._min[:used] * query.sum()
+        norms = self._norm[:used] * np.linalg.norm(query)
+        similarities = np.divide(
+            dots, norms, out=np.full_like(dots, -1.0), where=norms > 0
+        )
+        similarities[~self._live[:used]] = -np.inf
+        rows = np.flatnonzero(similarities > threshold)
+        rows = rows[np.argsort(-similarities[rows], kind="stable")]
+        return [(self._hashes[row], float(similarities[row])) for row in rows]
+
+
+def _semantic_cache_file(hashing_kv, mode: str) -> str:
+    return os.path.join(
+        hashing_kv.global_config["working_dir"],
+        f"kv_store_{hashing_kv.namespace}_{mode}.embeddings",
+    )
+
+
+async def get_semantic_cache_index(hashing_kv, mode: str, dim: int) -> SemanticCacheIndex:
+    """Return the index for `mode` of the response cache over `hashing_kv`."""
+    return await get_response_cache(hashing_kv).semantic_index(mode, dim)
+
+
 async def get_best_cached_response(
     hashing_kv,
     current_embedding,
@@ -327,36 +1154,27 @@ async def get_best_cached_response(
     original_prompt=None,
 ) -> Union[str, None]:
 
-    mode_cache = await hashing_kv.get_by_id(mode)
-    if not mode_cache:
-        return None
-
-    best_similarity = -1
-    best_response = None
-    best_prompt = None
-    best_cache_id = None
-
-
-    for cache_id, cache_data in mode_cache.items():
-        if cache_data["embedding"] is None:
+    index = await get_semantic_cache_index(hashing_kv, mode, len(current_embedding))
+    cache = get_response_cache(hashing_kv)
+    best_cache_id, best_similarity, cache_data = None, -1.0, None
+    looked_up = False
+    # the index file is appended at once but responses only persist on the
+    # next flush, so after a crash a candidate may have no response
+    for cache_id, similarity in index.candidates(current_embedding, similarity_threshold):
+        if cache_id not in cache:
+            index.remove([cache_id])
             continue
-
-
-        cached_quantized = np.frombuffer(
-            bytes.fromhex(cache_data["embedding"]), dtype=np.uint8
-        ).reshape(cache_data["embedding_shape"])
-        cached_embedding = dequantize_embedding(
-            cached_quantized,
-            cache_data["embedding_min"],
-            cache_data["embedding_max"],
-        )
-
-        similarity = cosine_similarity(current_embedding, cached_embedding)
-        if similarity > best_similarity:
-            best_similarity = similarity
-            best_response = cache_data["return"]
-            best_prompt = cache_data["original_prompt"]
-            best_cache_id = cache_id
+        looked_up = True
+        cache_data = await cache.get(cache_id)
+        if cache_data is not None:
+            best_cache_id, best_similarity = cache_id, similarity
+            break
+    if cache_data is None:
+        if not looked_up:
+            cache.misses += 1
+        return None
+    best_response = cache_data["return"]
+    best_prompt = cache_data["original_prompt"]
 
     if best_similarity > similarity_threshold:
 
@@ -434,6 +1252,332 @@ def dequantize_embedding(
     return (quantized * scale + min_val).astype(np.float32)
 
 
+_RESPONSE_CACHE_META_KEY = "__response_cache__"
+# entry metadata lives under its own key so loading never reads responses
+_RESPONSE_CACHE_ENTRY_META_PREFIX = "__meta__:"
+_RESPONSE_CACHE_LAYOUT = 2
+_RESPONSE_CACHE_META_FIELDS = (
+    "mode", "size", "created_at", "accessed_at", "hits", "graph_generation"
+)
+
+
+class ResponseCache:
+    """Per-entry LLM response cache on top of a KV storage.
+
+    Every response is its own record keyed by its args hash.  Its mode,
+    size, creation/access times, hit count and the graph generation it was
+    answered against sit in a separate metadata record, which is all that
+    is loaded at startup and mirrored in memory, so eviction never reads
+    the responses themselves.  Entries
+    expire after ``ttl_seconds``, the least recently (``"lru"``) or least
+    frequently (``"lfu"``) used ones are evicted past ``max_entries`` or
+    ``max_bytes``, and `bump_generation` drops everything answered
+    against an older graph.  Caches written in the old one-dict-per-mode
+    layout, or with metadata inside the responses, are converted on first
+    load.  The semantic (embedding) indexes of each mode are held here too.
+    """
+
+    def __init__(
+        self,
+        kv,
+        max_entries: Optional[int] = 10000,
+        max_bytes: Optional[int] = None,
+        ttl_seconds: Optional[float] = None,
+        eviction: str = "lru",
+        invalidate_on_graph_change: bool = True,
+    ):
+        if eviction not in ("lru", "lfu"):
+            raise ValueError(f"Unknown eviction policy {eviction}")
+        self.kv = kv
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.eviction = eviction
+        self.invalidate_on_graph_change = invalidate_on_graph_change
+        self.graph_generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        # args hash -> metadata, least recently used first
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._bytes = 0
+        self._dirty: set[str] = set()
+        self._semantic_indexes: dict[str, SemanticCacheIndex] = {}
+        self._loaded = False
+        self._lock = asyncio.Lock()
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __contains__(self, args_hash: str):
+        return args_hash in self._entries
+
+    @staticmethod
+    def _meta_key(args_hash: str) -> str:
+        return _RESPONSE_CACHE_ENTRY_META_PREFIX + args_hash
+
+    def _track(self, args_hash: str, meta: dict):
+        self._entries[args_hash] = {k: meta[k] for k in _RESPONSE_CACHE_META_FIELDS}
+        self._entries.move_to_end(args_hash)
+        self._bytes += meta["size"]
+
+    async def _replace(self, records: dict[str, dict]):
+        # JsonKVStorage.upsert keeps existing keys, so replace them explicitly
+        await self.kv.delete(list(records))
+        await self.kv.upsert(records)
+
+    async def _write_header(self):
+        await self._replace(
+            {
+                _RESPONSE_CACHE_META_KEY: {
+                    "graph_generation": self.graph_generation,
+                    "layout": _RESPONSE_CACHE_LAYOUT,
+                }
+            }
+        )
+
+    async def load(self):
+        if self._loaded:
+            return
+        async with self._lock:
+            if self._loaded:
+                return
+            keys = await self.kv.all_keys()
+            header = await self.kv.get_by_id(_RESPONSE_CACHE_META_KEY) or {}
+            self.graph_generation = header.get("graph_generation", 0)
+            if header.get("layout") == _RESPONSE_CACHE_LAYOUT:
+                meta_keys = [
+                    k for k in keys if k.startswith(_RESPONSE_CACHE_ENTRY_META_PREFIX)
+                ]
+                metas = await self.kv.get_by_ids(meta_keys)
+                tracked = [
+                    (key[len(_RESPONSE_CACHE_ENTRY_META_PREFIX):], meta)
+                    for key, meta in zip(meta_keys, metas)
+                    if meta is not None
+                ]
+            else:
+                tracked = await self._upgrade(keys)
+            for key, meta in sorted(tracked, key=lambda item: item[1]["accessed_at"]):
+                self._track(key, meta)
+            self._loaded = True
+            await self._drop_stale()
+            await self._evict()
+
+    async def _upgrade(self, keys: list[str]) -> list[tuple[str, dict]]:
+        """Split the metadata out of caches written by older layouts (read once)."""
+        records = await self.kv.get_by_ids(keys)
+        legacy = {}
+        tracked = []
+        for key, record in zip(keys, records):
+            if record is None or key == _RESPONSE_CACHE_META_KEY:
+                continue
+            if "return" in record:
+                tracked.append((key, {k: record[k] for k in _RESPONSE_CACHE_META_FIELDS}))
+            elif all(isinstance(v, dict) and "return" in v for v in record.values()):
+                legacy[key] = record
+        if tracked:
+            await self.kv.upsert({self._meta_key(key): meta for key, meta in tracked})
+        if legacy:
+            tracked += await self._migrate(legacy)
+        await self._write_header()
+        return tracked
+
+    async def _migrate(self, legacy: dict[str, dict]) -> list[tuple[str, dict]]:
+        now = time.time()
+        records = {}
+        metas = {}
+        for mode, mode_cache in legacy.items():
+            embeddings = []
+            for args_hash, entry in mode_cache.items():
+                records[args_hash], metas[args_hash] = self._record(
+                    mode, entry["return"], entry.get("original_prompt", ""), now
+                )
+                if entry.get("embedding"):
+                    embeddings.append(
+                        (
+                            args_hash,
+                            np.frombuffer(bytes.fromhex(entry["embedding"]), dtype=np.uint8),
+                            entry["embedding_min"],
+                            entry["embedding_max"],
+                        )
+                    )
+            if embeddings:
+                SemanticCacheIndex(
+                    _semantic_cache_file(self.kv, mode), len(embeddings[0][1])
+                ).add_many(embeddings)
+        await self.kv.upsert(records)
+        await self.kv.upsert({self._meta_key(h): meta for h, meta in metas.items()})
+        await self.kv.delete(list(legacy))
+        logger.info(f"Converted {len(records)} cached LLM responses to per-entry records")
+        return list(metas.items())
+
+    def _record(self, mode: str, content: str, prompt: str, now: float) -> tuple[dict, dict]:
+        """Return the response record and its metadata record."""
+        record = {"mode": mode, "return": content, "original_prompt": prompt}
+        meta = {
+            "mode": mode,
+            "size": len(content.encode()) + len(prompt.encode()),
+            "created_at": now,
+            "accessed_at": now,
+            "hits": 0,
+            "graph_generation": self.graph_generation,
+        }
+        return record, meta
+
+    async def semantic_index(self, mode: str, dim: int) -> SemanticCacheIndex:
+        """Return the index for `mode`, dropping rows whose response is no longer cached."""
+        if mode not in self._semantic_indexes:
+            await self.load()
+            index = SemanticCacheIndex(_semantic_cache_file(self.kv, mode), dim)
+            index.remove([h for h in index.hashes() if h not in self])
+            self._semantic_indexes[mode] = index
+        return self._semantic_indexes[mode]
+
+    def _stale(self, meta: dict, now: float) -> Optional[str]:
+        if self.ttl_seconds is not None and now - meta["created_at"] > self.ttl_seconds:
+            return "expired"
+        if (
+            self.invalidate_on_graph_change
+            and meta["graph_generation"] != self.graph_generation
+        ):
+            return "invalidated"
+        return None
+
+    async def _remove(self, args_hashes: list[str]):
+        if not args_hashes:
+            return
+        by_mode: dict[str, list[str]] = {}
+        for args_hash in args_hashes:
+            meta = self._entries.pop(args_hash)
+            self._bytes -= meta["size"]
+            self._dirty.discard(args_hash)
+            by_mode.setdefault(meta["mode"], []).append(args_hash)
+        for mode, hashes in by_mode.items():
+            if mode in self._semantic_indexes:
+                self._semantic_indexes[mode].remove(hashes)
+        await self.kv.delete(args_hashes + [self._meta_key(h) for h in args_hashes])
+
+    async def _drop_stale(self):
+        now = time.time()
+        stale = [(h, self._stale(meta, now)) for h, meta in self._entries.items()]
+        stale = [(h, reason) for h, reason in stale if reason is not None]
+        self.expirations += sum(reason == "expired" for _, reason in stale)
+        self.invalidations += sum(reason == "invalidated" for _, reason in stale)
+        await self._remove([h for h, _ in stale])
+
+    def _over_limit(self, entries: int, size: int) -> bool:
+        return (self.max_entries is not None and entries > self.max_entries) or (
+            self.max_bytes is not None and size > self.max_bytes
+        )
+
+    async def _evict(self):
+        if not self._over_limit(len(self._entries), self._bytes):
+            return
+        # expired entries go before live ones are evicted
+        if self.ttl_seconds is not None:
+            await self._drop_stale()
+        entries, size = len(self._entries), self._bytes
+        if not self._over_limit(entries, size):
+            return
+        if self.eviction == "lru":
+            candidates = iter(self._entries)
+        else:
+            candidates = iter(
+                sorted(
+                    self._entries,
+                    key=lambda h: (self._entries[h]["hits"], self._entries[h]["accessed_at"]),
+                )
+            )
+        victims = []
+        while self._over_limit(entries, size):
+            victim = next(candidates)
+            victims.append(victim)
+            entries -= 1
+            size -= self._entries[victim]["size"]
+        self.evictions += len(victims)
+        await self._remove(victims)
+
+    async def get(self, args_hash: Optional[str]) -> Optional[dict]:
+        """Return the cached record for `args_hash`, counting a hit or a miss."""
+        await self.load()
+        meta = self._entries.get(args_hash) if args_hash is not None else None
+        if meta is not None:
+            now = time.time()
+            reason = self._stale(meta, now)
+            if reason is not None:
+                if reason == "expired":
+                    self.expirations += 1
+                else:
+                    self.invalidations += 1
+                await self._remove([args_hash])
+                meta = None
+        record = await self.kv.get_by_id(args_hash) if meta is not None else None
+        if record is None:
+            if meta is not None:
+                # tracked but never persisted, e.g. lost in a crash before a flush
+                await self._remove([args_hash])
+            self.misses += 1
+            return None
+        meta["accessed_at"] = now
+        meta["hits"] += 1
+        self._entries.move_to_end(args_hash)
+        self._dirty.add(args_hash)
+        self.hits += 1
+        return record
+
+    async def put(self, args_hash: str, mode: str, content: str, prompt: str):
+        await self.load()
+        if args_hash in self._entries:
+            await self._remove([args_hash])
+        record, meta = self._record(mode, content, prompt, time.time())
+        await self.kv.upsert({args_hash: record, self._meta_key(args_hash): meta})
+        self._track(args_hash, meta)
+        await self._evict()
+
+    async def bump_generation(self):
+        """Record a graph change; entries answered against older graphs go stale."""
+        await self.load()
+        self.graph_generation += 1
+        await self._write_header()
+        if self.invalidate_on_graph_change:
+            await self._drop_stale()
+
+    async def flush(self):
+        """Write access times and hit counts of entries read since the last flush."""
+        dirty = [h for h in self._dirty if h in self._entries]
+        self._dirty.clear()
+        if not dirty:
+            return
+        await self._replace({self._meta_key(h): dict(self._entries[h]) for h in dirty})
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "graph_generation": self.graph_generation,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def get_response_cache(hashing_kv) -> ResponseCache:
+    """Return the `ResponseCache` over `hashing_kv`, configured from its global config."""
+    cache = hashing_kv.__dict__.get("_response_cache")
+    if cache is None:
+        cache = ResponseCache(
+            hashing_kv, **hashing_kv.global_config.get("llm_response_cache_config", {})
+        )
+        hashing_kv.__dict__["_response_cache"] = cache
+    return cache
+
+
 async def handle_cache(hashing_kv, args_hash, prompt, mode="default"):
 
     if hashing_kv is None:
@@ -441,9 +1585,9 @@ async def handle_cache(hashing_kv, args_hash, prompt, mode="default"):
 
 
     if mode == "naive":
-        mode_cache = await hashing_kv.get_by_id(mode) or {}
-        if args_hash in mode_cache:
-            return mode_cache[args_hash]["return"], None, None, None
+        cache_data = await get_response_cache(hashing_kv).get(args_hash)
+        if cache_data is not None:
+            return cache_data["return"], None, None, None
         return None, None, None, None
 
 
@@ -460,7 +1604,9 @@ async def handle_cache(hashing_kv, args_hash, prompt, mode="default"):
         embedding_model_func = hashing_kv.global_config["embedding_func"]["func"]
         llm_model_func = hashing_kv.global_config.get("llm_model_func")
 
-        current_embedding = await embedding_model_func([prompt])
+        current_embedding = await embed_queries(
+            hashing_kv.global_config, embedding_model_func, [prompt]
+        )
         quantized, min_val, max_val = quantize_embedding(current_embedding[0])
         best_cached_response = await get_best_cached_response(
             hashing_kv,
@@ -475,9 +1621,9 @@ async def handle_cache(hashing_kv, args_hash, prompt, mode="default"):
             return best_cached_response, None, None, None
     else:
 
-        mode_cache = await hashing_kv.get_by_id(mode) or {}
-        if args_hash in mode_cache:
-            return mode_cache[args_hash]["return"], None, None, None
+        cache_data = await get_response_cache(hashing_kv).get(args_hash)
+        if cache_data is not None:
+            return cache_data["return"], None, None, None
 
     return None, quantized, min_val, max_val
 
@@ -497,22 +1643,32 @@ async def save_to_cache(hashing_kv, cache_data: CacheData):
     if hashing_kv is None or hasattr(cache_data.content, "__aiter__"):
         return
 
-    mode_cache = await hashing_kv.get_by_id(cache_data.mode) or {}
-
-    mode_cache[cache_data.args_hash] = {
-        "return": cache_data.content,
-        "embedding": cache_data.quantized.tobytes().hex()
-        if cache_data.quantized is not None
-        else None,
-        "embedding_shape": cache_data.quantized.shape
-        if cache_data.quantized is not None
-        else None,
-        "embedding_min": cache_data.min_val,
-        "embedding_max": cache_data.max_val,
-        "original_prompt": cache_data.prompt,
-    }
-
-    await hashing_kv.upsert({cache_data.mode: mode_cache})
+    await get_response_cache(hashing_kv).put(
+        cache_data.args_hash, cache_data.mode, cache_data.content, cache_data.prompt
+    )
+    if cache_data.quantized is not None:
+        index = await get_semantic_cache_index(
+            hashing_kv, cache_data.mode, cache_data.quantized.size
+        )
+        index.add(
+            cache_data.args_hash,
+            cache_data.quantized,
+            cache_data.min_val,
+            cache_data.max_val,
+        )
+
+
+async def iterate_response(response):
+    """Yield the chunks of an `aquery` answer, streamed or not.
+
+    With ``QueryParam(stream=True)`` the answer is an async iterator, but a
+    cached answer still comes back as one string.
+    """
+    if hasattr(response, "__aiter__"):
+        async for chunk in response:
+            yield chunk
+    else:
+        yield response
 
 
 def safe_unicode_decode(content):
@@ -1,13 +1,16 @@
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 import uuid as uuid_pkg
 import datetime
+import json
 from typing import List, Optional
 
-from models.database import get_db, Chat, User, Thread
+from models.database import get_db, SessionLocal, Chat, User, Thread
 from api.auth.jwt_handler import get_current_active_user
 from .schemas import ChatCreate, ChatResponse, ChatList, ThreadCreate, ThreadResponse, ThreadList, ThreadWithChats
 from PathRAG import QueryParam
+from PathRAG.utils import iterate_response
 from api.features.rag_manager import get_rag_instance
 
 # Get the PathRAG instance from the manager
@@ -150,7 +153,6 @@ async def create_chat(
 ):
     """Create a new chat message and get a response"""
     # Find or create thread
-    thread_id = None
     if thread_uuid:
         # Use existing thread ID
         thread = db.query(Thread).filter(
@@ -162,36 +164,81 @@ async def create_chat(
         if thread is None:
             raise HTTPException(status_code=404, detail="Thread not found")
 
-        thread_id = thread.id
-
     # Query PathRAG
     response_text = await rag.aquery(chat.message, param=QueryParam(mode=chat.search_context))
 
+    # Return the user message
+    return _record_exchange(db, thread, current_user.id, chat.message, response_text)
+
+@router.post("/chat/{thread_uuid}/stream")
+async def create_chat_stream(
+    thread_uuid: str,
+    chat: ChatCreate,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Create a new chat message and stream the response as Server-Sent Events.
+
+    Each event carries a `token`; the final `done` event carries the stored
+    user message once the answer has been written to the thread.
+    """
+    thread = db.query(Thread).filter(
+        Thread.uuid == thread_uuid,
+        Thread.user_id == current_user.id,
+        Thread.is_deleted == False
+    ).first()
+
+    if thread is None:
+        raise HTTPException(status_code=404, detail="Thread not found")
+
+    thread_id = thread.id
+    user_id = current_user.id
+
+    # Retrieval runs before the first byte is sent; only generation is streamed
+    response = await rag.aquery(chat.message, param=QueryParam(mode=chat.search_context, stream=True))
+
+    async def events():
+        chunks = []
+        async for chunk in iterate_response(response):
+            chunks.append(chunk)
+            yield f"data: {json.dumps({'token': chunk})}\n\n"
+
+        # The request's session is closed once streaming starts, so write with a new one
+        stream_db = SessionLocal()
+        try:
+            stream_thread = stream_db.get(Thread, thread_id)
+            user_chat = _record_exchange(stream_db, stream_thread, user_id, chat.message, "".join(chunks))
+            done = ChatResponse.model_validate(user_chat).model_dump(mode="json")
+        finally:
+            stream_db.close()
+        yield f"event: done\ndata: {json.dumps(done)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+def _record_exchange(db: Session, thread: Thread, user_id: int, message: str, response_text: str) -> Chat:
+    """Store a user message and its answer in `thread` and return the user message"""
     # Create user message record
     user_chat = Chat(
-        user_id=current_user.id,
-        thread_id=thread_id,
+        user_id=user_id,
+        thread_id=thread.id,
         role="user",
-        message=chat.message
+        message=message
     )
     db.add(user_chat)
 
     # Create system response record
     system_chat = Chat(
-        user_id=current_user.id,
-        thread_id=thread_id,
+        user_id=user_id,
+        thread_id=thread.id,
         role="system",
         message=response_text
     )
     db.add(system_chat)
 
     # Update thread title and timestamp
-    thread.title = chat.message[:50] if len(chat.message) > 50 else chat.message
+    thread.title = message[:50] if len(message) > 50 else message
     thread.updated_at = datetime.datetime.now(datetime.timezone.utc)
 
     db.commit()
     db.refresh(user_chat)
-
-    # Return the user message
     return user_chat
-
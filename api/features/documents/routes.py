@@ -540,6 +540,9 @@ async def neo4j_upload(
         # Test Neo4j connection
         driver = create_neo4j_session(neo4j_config)
         
+        # PathRAG persists binary snapshots; export the current graph as GraphML first
+        await get_rag_instance().chunk_entity_relation_graph.export_graphml()
+
         # Load GraphML files from /data directory
         graphs = load_graphml_files(WORKING_DIR)
         
@@ -1,10 +1,12 @@
+import json
 import os
 import tempfile
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from PathRAG import PathRAG, QueryParam
-from PathRAG.llm import openai_complete, openai_complete_stream
+from PathRAG.llm import openai_complete
+from PathRAG.utils import iterate_response
 # Additional libraries for file processing
 import PyPDF2
 import docx2txt
@@ -179,15 +181,17 @@ async def query_rag(query: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/query_stream", summary="Stream Query the RAG system", description="Send a query to the RAG system and stream the generated response.")
+@app.post("/query_stream", summary="Stream Query the RAG system", description="Send a query to the RAG system and stream the generated response as Server-Sent Events.")
 async def query_rag_stream(query: str):
+    # retrieval finishes here, so its errors still become a 500
+    try:
+        response = await rag.aquery(query, param=QueryParam(mode="hybrid", stream=True))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
     async def stream_generator():
-        async for chunk in openai_complete_stream(
-            query,
-            system_prompt=None,
-            history_messages=[],
-            keyword_extraction=False,
-            param=QueryParam(mode="hybrid")
-        ):
-            yield chunk
-    return StreamingResponse(stream_generator(), media_type="text/plain")
+        async for chunk in iterate_response(response):
+            yield f"data: {json.dumps({'token': chunk})}\n\n"
+        yield "event: done\ndata: {}\n\n"
+
+    return StreamingResponse(stream_generator(), media_type="text/event-stream")
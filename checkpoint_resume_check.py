@@ -0,0 +1,165 @@
+"""Kill-and-resume check of checkpointed ingestion on the durable KV backends.
+
+Inserts a synthetic corpus once without interruption, using a deterministic
+stand-in LLM and embedding. Then, for each backend, it starts the same insert
+in a child process that exits hard after its Nth write to ``text_chunks``,
+runs the insert again in the same working directory, and checks that the
+resumed graph matches the clean one node for node and edge for edge:
+
+    python checkpoint_resume_check.py --backends SqliteKVStorage LogKVStorage
+"""
+
+import argparse
+import asyncio
+import hashlib
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+from PathRAG import PathRAG
+from PathRAG.utils import EmbeddingFunc
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--backends", nargs="+", default=["SqliteKVStorage", "LogKVStorage"]
+    )
+    parser.add_argument("--docs", type=int, default=30)
+    parser.add_argument("--kill-after", type=int, default=2)
+    parser.add_argument("--child", nargs=2, metavar=("BACKEND", "WORKING_DIR"))
+    return parser
+
+
+def build_docs(count):
+    rng = random.Random(0)
+    names = [f"Person{chr(97 + i % 26)}{chr(97 + i // 26)}" for i in range(60)]
+    return [
+        " ".join(f"{rng.choice(names)} met {rng.choice(names)}." for _ in range(3))
+        + f" Report {i}."
+        for i in range(count)
+    ]
+
+
+async def fake_llm(prompt, system_prompt=None, history_messages=[], **kwargs):
+    if history_messages:
+        # gleaning and the continue question
+        return "no"
+    if "-Real Data-" not in prompt:
+        return ""
+    text = prompt.split("-Real Data-")[-1].split("Text:")[1].split("######")[0]
+    names = list(dict.fromkeys(re.findall(r"\bPerson\w+", text)))
+    records = [
+        f'("entity"<|>"{name}"<|>"person"<|>"{name} is named in a report")'
+        for name in names
+    ]
+    records += [
+        f'("relationship"<|>"{a}"<|>"{b}"<|>"{a} met {b}"<|>"meeting"<|>1)'
+        for a, b in zip(names, names[1:])
+    ]
+    return "##".join(records) + "<|COMPLETE|>"
+
+
+async def fake_embedding(texts):
+    vectors = []
+    for text in texts:
+        seed = int.from_bytes(hashlib.md5(text.encode()).digest()[:8], "little")
+        vectors.append(np.random.default_rng(seed).standard_normal(32))
+    return np.array(vectors, dtype=np.float32)
+
+
+def build_rag(working_dir, backend):
+    return PathRAG(
+        working_dir=working_dir,
+        kv_storage=backend,
+        llm_model_func=fake_llm,
+        embedding_func=EmbeddingFunc(
+            embedding_dim=32, max_token_size=8192, func=fake_embedding
+        ),
+        entity_extract_max_gleaning=0,
+        entity_extract_max_async=2,
+        # small vector rounds, so chunks are marked stored early in the insert
+        embedding_batch_num=4,
+        embedding_func_max_async=1,
+    )
+
+
+def graph_state(rag):
+    graph = rag.chunk_entity_relation_graph._graph
+    nodes = {
+        node: (data["entity_type"], sorted(data["source_id"].split("<SEP>")))
+        for node, data in graph.nodes(data=True)
+    }
+    edges = {
+        tuple(sorted((u, v))): (data["weight"], sorted(data["source_id"].split("<SEP>")))
+        for u, v, data in graph.edges(data=True)
+    }
+    return nodes, edges
+
+
+def run_child(backend, working_dir, docs, kill_after):
+    rag = build_rag(working_dir, backend)
+    upsert = rag.text_chunks.upsert
+    writes = 0
+
+    async def upsert_then_exit(data):
+        nonlocal writes
+        result = await upsert(data)
+        writes += 1
+        if writes >= kill_after:
+            os._exit(1)
+        return result
+
+    rag.text_chunks.upsert = upsert_then_exit
+    asyncio.run(rag.ainsert(docs))
+    # the insert finished before the kill point
+    os._exit(2)
+
+
+def run(args):
+    docs = build_docs(args.docs)
+    with tempfile.TemporaryDirectory() as clean_dir:
+        clean = build_rag(clean_dir, "JsonKVStorage")
+        asyncio.run(clean.ainsert(docs))
+        expected = graph_state(clean)
+    print(f"clean: {len(expected[0])} nodes, {len(expected[1])} edges")
+
+    for backend in args.backends:
+        with tempfile.TemporaryDirectory() as working_dir:
+            child = subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    "--docs",
+                    str(args.docs),
+                    "--kill-after",
+                    str(args.kill_after),
+                    "--child",
+                    backend,
+                    working_dir,
+                ]
+            )
+            assert child.returncode == 1, f"{backend}: the insert was not interrupted"
+            resumed = build_rag(working_dir, backend)
+            asyncio.run(resumed.ainsert(docs))
+            actual = graph_state(resumed)
+            left = len(asyncio.run(resumed.extraction_checkpoints.all_keys()))
+        print(
+            f"{backend}: resumed {len(actual[0])} nodes, {len(actual[1])} edges, "
+            f"{left} checkpoints left"
+        )
+        assert actual == expected, f"{backend}: resumed graph differs from a clean insert"
+        assert left == 0, f"{backend}: checkpoints left after a finished insert"
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    if args.child:
+        run_child(*args.child, build_docs(args.docs), args.kill_after)
+    else:
+        run(args)
@@ -99,6 +99,8 @@ def main():
             username=args.username,
             password=args.password,
         )
+        rag = build_rag_instance(args.working_dir)
+        asyncio.run(rag.chunk_entity_relation_graph.export_graphml())
         total_nodes, total_relationships, files_processed = import_graphml_directory(
             config, args.working_dir
         )
@@ -0,0 +1,121 @@
+"""Parity and latency of flow_weighted_paths against the per-pair bfs_weighted_paths loop.
+
+Builds random graphs, enumerates the candidate paths between random seed
+entities and scores them both ways. Scores must agree for every pair whose
+follow graph reaches each node at a single depth; where a node sits at two
+depths the pairwise loop thresholds partially accumulated weights in set
+order, so those pairs are only counted; that difference is why queries use
+the flow scorer only with QueryParam(path_scorer="flow"). Then times both
+across top_k:
+
+    python path_flow_benchmark.py --graphs 200 --nodes 2000 --top-k 20 40 80
+"""
+
+import argparse
+import random
+import time
+
+import networkx as nx
+import numpy as np
+
+from PathRAG.operate import (
+    find_paths_and_edges_with_stats,
+    flow_weighted_paths,
+    pairwise_weighted_paths,
+)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--graphs", type=int, default=200)
+    parser.add_argument("--parity-nodes", type=int, default=60)
+    parser.add_argument("--parity-edges", type=int, default=150)
+    parser.add_argument("--parity-seeds", type=int, default=6)
+    parser.add_argument("--nodes", type=int, default=2000)
+    parser.add_argument("--degree", type=int, default=12)
+    parser.add_argument("--top-k", type=int, nargs="+", default=[20, 40, 80])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--threshold", type=float, default=0.3)
+    parser.add_argument("--alpha", type=float, default=0.8)
+    return parser
+
+
+def candidate_paths(graph, seeds):
+    adjacency = {n: set(graph[n]) for n in graph}
+    result, *_ = find_paths_and_edges_with_stats(adjacency, seeds, max_hops=3)
+    return result
+
+
+def single_depth(paths):
+    """True when every node of the pair's paths sits at one position only."""
+    depth = {}
+    for path in paths:
+        for position, node in enumerate(path):
+            if depth.setdefault(node, position) != position:
+                return False
+    return True
+
+
+def check_parity(args, rng):
+    compared = differing = mixed_depth_pairs = 0
+    for index in range(args.graphs):
+        graph = nx.gnm_random_graph(args.parity_nodes, args.parity_edges, seed=index)
+        seeds = rng.sample(list(graph.nodes), args.parity_seeds)
+        result = candidate_paths(graph, seeds)
+        expected = pairwise_weighted_paths(None, result, seeds, args.threshold, args.alpha)
+        actual = flow_weighted_paths(result, seeds, args.threshold, args.alpha)
+        assert [p for p, _ in expected] == [p for p, _ in actual]
+
+        position = 0
+        for node1 in seeds:
+            for node2 in seeds:
+                if node1 == node2 or (node1, node2) not in result:
+                    continue
+                paths = result[(node1, node2)]["paths"]
+                pair_expected = np.array([w for _, w in expected[position:position + len(paths)]])
+                pair_actual = np.array([w for _, w in actual[position:position + len(paths)]])
+                position += len(paths)
+                mismatch = int(np.sum(~np.isclose(pair_expected, pair_actual, rtol=1e-9, atol=1e-12)))
+                if single_depth(paths):
+                    assert mismatch == 0, f"graph {index}: {node1}->{node2} scores differ"
+                else:
+                    mixed_depth_pairs += 1
+                compared += len(paths)
+                differing += mismatch
+    print(
+        f"parity: {args.graphs} graphs, {compared} path scores, {differing} differ, "
+        f"all in the {mixed_depth_pairs} pairs with a node at two depths"
+    )
+
+
+def best_ms(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def run_benchmark(args, rng):
+    graph = nx.random_regular_graph(args.degree, args.nodes, seed=0)
+    print(f"{'top_k':>6} {'paths':>8} {'pairwise ms':>12} {'flow ms':>10}")
+    for top_k in args.top_k:
+        seeds = rng.sample(list(graph.nodes), top_k)
+        result = candidate_paths(graph, seeds)
+        n_paths = sum(len(v["paths"]) for v in result.values())
+        pairwise_ms = best_ms(
+            lambda: pairwise_weighted_paths(None, result, seeds, args.threshold, args.alpha),
+            args.repeat,
+        )
+        flow_ms = best_ms(
+            lambda: flow_weighted_paths(result, seeds, args.threshold, args.alpha), args.repeat
+        )
+        print(f"{top_k:>6} {n_paths:>8} {pairwise_ms:>12.1f} {flow_ms:>10.1f}")
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    rng = random.Random(0)
+    check_parity(args, rng)
+    run_benchmark(args, rng)
@@ -0,0 +1,102 @@
+"""Recall@k and latency of IVFVectorDBStorage against the exact scan.
+
+Builds both backends over the same synthetic, clustered vectors in a
+temporary directory and sweeps nprobe:
+
+    python vector_benchmark.py --rows 200000 --dim 384 --nprobe 1 4 8 16 32
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from PathRAG.storage import IVFVectorDBStorage, MmapVectorDBStorage
+from PathRAG.utils import EmbeddingFunc
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--clusters", type=int, default=2000)
+    parser.add_argument("--noise", type=float, default=1.0)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16", "int8"])
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    return parser
+
+
+async def run(args):
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((args.clusters, args.dim)).astype(np.float32)
+    vectors = {}
+    for i in range(args.rows):
+        vectors[f"row-{i}"] = centers[i % args.clusters] + args.noise * rng.standard_normal(args.dim).astype(np.float32)
+    for i in range(args.queries):
+        vectors[f"query-{i}"] = centers[rng.integers(args.clusters)] + args.noise * rng.standard_normal(args.dim).astype(np.float32)
+
+    async def embed(texts):
+        return np.stack([vectors[t] for t in texts])
+
+    embedding_func = EmbeddingFunc(embedding_dim=args.dim, max_token_size=8192, func=embed)
+    data = {f"id-{i}": {"content": f"row-{i}"} for i in range(args.rows)}
+    queries = [f"query-{i}" for i in range(args.queries)]
+
+    def open_storage(cls, working_dir, **kwargs):
+        return cls(
+            namespace="benchmark",
+            global_config={
+                "working_dir": working_dir,
+                "embedding_batch_num": 4096,
+                "cosine_better_than_threshold": -1.0,
+                "vector_db_storage_cls_kwargs": {"dtype": args.dtype, **kwargs},
+            },
+            embedding_func=embedding_func,
+        )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        exact_dir = os.path.join(tmp_dir, "exact")
+        ivf_dir = os.path.join(tmp_dir, "ivf")
+        os.makedirs(exact_dir)
+        os.makedirs(ivf_dir)
+
+        exact = open_storage(MmapVectorDBStorage, exact_dir)
+        await exact.upsert(data)
+        ivf = open_storage(IVFVectorDBStorage, ivf_dir, nlist=args.nlist, min_train_rows=1)
+        start = time.perf_counter()
+        await ivf.upsert(data)
+        build_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        truth = [await exact.query(q, top_k=args.top_k) for q in queries]
+        exact_ms = (time.perf_counter() - start) / len(queries) * 1000
+        truth = [{r["id"] for r in result} for result in truth]
+
+        print(
+            f"{args.rows} x {args.dim} {args.dtype}, {len(ivf._centroids)} lists, "
+            f"insert + train {build_seconds:.1f}s"
+        )
+        print(f"{'search':>10} {'recall@' + str(args.top_k):>10} {'ms/query':>10}")
+        print(f"{'exact':>10} {1.0:>10.3f} {exact_ms:>10.2f}")
+        for nprobe in args.nprobe:
+            ivf.nprobe = nprobe
+            start = time.perf_counter()
+            results = [await ivf.query(q, top_k=args.top_k) for q in queries]
+            ivf_ms = (time.perf_counter() - start) / len(queries) * 1000
+            recall = np.mean(
+                [
+                    len(expected & {r["id"] for r in result}) / len(expected)
+                    for expected, result in zip(truth, results)
+                ]
+            )
+            print(f"{'nprobe=' + str(nprobe):>10} {recall:>10.3f} {ivf_ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(run(build_parser().parse_args()))